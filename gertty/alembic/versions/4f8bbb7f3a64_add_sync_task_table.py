@@ -0,0 +1,27 @@
+"""add sync task table
+
+Revision ID: 4f8bbb7f3a64
+Revises: 7ef7dfa2ca3a
+Create Date: 2026-10-17 10:12:41.318544
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4f8bbb7f3a64'
+down_revision = '7ef7dfa2ca3a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('sync_task',
+    sa.Column('key', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(255), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('priority', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+def downgrade():
+    pass
@@ -0,0 +1,37 @@
+"""add revision.pending_fetch
+
+Revision ID: a2d7e5c1f08b
+Revises: 4f8bbb7f3a64
+Create Date: 2026-10-17 11:02:17.904316
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a2d7e5c1f08b'
+down_revision = '4f8bbb7f3a64'
+
+import warnings
+
+from alembic import op
+import sqlalchemy as sa
+
+from gertty.dbsupport import sqlite_alter_columns
+
+
+def upgrade():
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        op.add_column('revision', sa.Column('pending_fetch', sa.Boolean()))
+
+    connection = op.get_bind()
+    revision = sa.sql.table('revision',
+                            sa.sql.column('pending_fetch', sa.Boolean()))
+    connection.execute(revision.update().values({'pending_fetch':False}))
+
+    sqlite_alter_columns('revision', [
+        sa.Column('pending_fetch', sa.Boolean(), index=True, nullable=False),
+        ])
+
+
+def downgrade():
+    pass
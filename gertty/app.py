@@ -18,6 +18,7 @@ import datetime
 import dateutil
 import fcntl
 import functools
+import json
 import logging
 import os
 import re
@@ -45,6 +46,7 @@ from gertty import sync
 from gertty import search
 from gertty import requestsexceptions
 from gertty.view import change_list as view_change_list
+from gertty.view import sync_status as view_sync_status
 from gertty.view import project_list as view_project_list
 from gertty.view import change as view_change
 import gertty.view
@@ -80,12 +82,13 @@ class StatusHeader(urwid.WidgetWrap):
         self._w.contents.append((self.sync_widget, ('pack', None, False)))
         self.error = None
         self.offline = None
+        self.offline_text = u''
         self.title = None
         self.message = None
         self.sync = None
         self.held = None
         self._error = False
-        self._offline = False
+        self._offline = u''
         self._title = ''
         self._message = ''
         self._sync = 0
@@ -104,6 +107,17 @@ class StatusHeader(urwid.WidgetWrap):
             self.offline = offline
         if held is not None:
             self.held = held
+        if self.offline:
+            if self.app.sync.probing:
+                self.offline_text = u' Reconnecting'
+            elif not self.app.sync.retry_time:
+                self.offline_text = u' Offline'
+            else:
+                retry = datetime.datetime.utcfromtimestamp(self.app.sync.retry_time)
+                self.offline_text = u' Offline (retry at %s)' % (
+                    self.app.time(retry).strftime('%H:%M:%S'),)
+        else:
+            self.offline_text = u''
         self.sync = self.app.sync.queue.qsize()
         if refresh:
             self.refresh()
@@ -126,12 +140,9 @@ class StatusHeader(urwid.WidgetWrap):
                 self.error_widget.set_text(('error', u' Error'))
             else:
                 self.error_widget.set_text(u'')
-        if self._offline != self.offline:
-            self._offline = self.offline
-            if self._offline:
-                self.offline_widget.set_text(u' Offline')
-            else:
-                self.offline_widget.set_text(u'')
+        if self._offline != self.offline_text:
+            self._offline = self.offline_text
+            self.offline_widget.set_text(self._offline)
         if self._sync != self.sync:
             self._sync = self.sync
             self.sync_widget.set_text(u' Sync: %i' % self._sync)
@@ -282,6 +293,8 @@ class App(object):
             print("error: another instance of gertty is running for: %s" % self.config.server['name'])
             sys.exit(1)
 
+        # Fork the intraline workers before any threads are started.
+        gitrepo.start_intraline_pool(self.config.intraline_processes)
         self.project_cache = ProjectCache()
         self.ring = mywid.KillRing()
         self.input_buffer = []
@@ -333,12 +346,14 @@ class App(object):
 
         self.startSocketListener()
 
+        self.sync_threads = []
         if not disable_sync:
-            self.sync_thread = threading.Thread(target=self.sync.run, args=(self.sync_pipe,))
-            self.sync_thread.daemon = True
-            self.sync_thread.start()
+            for i in range(self.config.sync_workers):
+                t = threading.Thread(target=self.sync.run, args=(self.sync_pipe,))
+                t.daemon = True
+                t.start()
+                self.sync_threads.append(t)
         else:
-            self.sync_thread = None
             self.sync.offline = True
             self.status.update(offline=True)
 
@@ -347,6 +362,10 @@ class App(object):
             self.loop.run()
         except KeyboardInterrupt:
             pass
+        try:
+            self.sync.journal.flush()
+        except Exception:
+            self.log.exception("Unable to save the sync task journal")
 
     def _quit(self, widget=None):
         raise urwid.ExitMainLoop()
@@ -381,8 +400,14 @@ class App(object):
                         break
                 buf = buf.strip()
                 self.log.debug("Received %s from socket" % (buf,))
-                s.close()
                 parts = buf.split()
+                if parts[0] == 'sync-stats':
+                    # Answered directly rather than by the UI thread.
+                    s.sendall(six.b(json.dumps(self.sync.getStats(), indent=2,
+                                               sort_keys=True) + '\n'))
+                    s.close()
+                    continue
+                s.close()
                 self.command_queue.put((parts[0], parts[1:]))
                 os.write(self.command_pipe, six.b('command\n'))
             except Exception:
@@ -398,16 +423,26 @@ class App(object):
         self.status.update(error=False, title=widget.title)
         if push:
             self.screens.append(self.frame.body)
+        else:
+            self.closeScreen(self.frame.body)
         self.clearInputBuffer()
         self.frame.body = widget
 
+    def closeScreen(self, widget):
+        # Let a screen which is being discarded stop any work it
+        # still has under way.
+        if hasattr(widget, 'onClose'):
+            widget.onClose()
+
     def backScreen(self, target_widget=None):
         if not self.screens:
             return
+        self.closeScreen(self.frame.body)
         while self.screens:
             widget = self.screens.pop()
             if (not target_widget) or (widget is target_widget):
                 break
+            self.closeScreen(widget)
         self.log.debug("Popping screen to %s" % (widget,))
         if hasattr(widget, 'title'):
             self.status.update(title=widget.title)
@@ -426,6 +461,7 @@ class App(object):
         while self.screens:
             widget = self.screens.pop()
             self.clearInputBuffer()
+            self.closeScreen(self.frame.body)
             self.frame.body = widget
 
     def refresh(self, data=None, force=False):
@@ -681,6 +717,8 @@ class App(object):
             self.searchDialog('')
         elif keymap.LIST_HELD in commands:
             self.doSearch("is:held")
+        elif keymap.SYNC_STATUS in commands:
+            self.changeScreen(view_sync_status.SyncStatusView(self))
         elif key in self.config.dashboards:
             d = self.config.dashboards[key]
             view = view_change_list.ChangeListView(self, d['query'], d['name'],
@@ -769,6 +807,7 @@ class App(object):
 
     def localCheckoutCommit(self, project_name, commit_sha):
         repo = gitrepo.get_repo(project_name, self.config)
+        self.sync.fetcher.fetchMissing(project_name, repo, [commit_sha])
         try:
             repo.checkout(commit_sha)
             dialog = mywid.MessageDialog('Checkout', 'Change checked out in %s' % repo.path)
@@ -782,6 +821,7 @@ class App(object):
 
     def localCherryPickCommit(self, project_name, commit_sha):
         repo = gitrepo.get_repo(project_name, self.config)
+        self.sync.fetcher.fetchMissing(project_name, repo, [commit_sha])
         try:
             repo.cherryPick(commit_sha)
             dialog = mywid.MessageDialog('Cherry-Pick', 'Change cherry-picked in %s' % repo.path)
@@ -877,6 +917,21 @@ class OpenChangeAction(argparse.Action):
         s.sendall('open %s\n' % url)
         sys.exit(0)
 
+class SyncStatsAction(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        cf = config.Config(namespace.server, namespace.palette,
+                           namespace.keymap, namespace.path)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(cf.socket_path)
+        s.sendall(six.b('sync-stats\n'))
+        while True:
+            data = s.recv(4096)
+            if not data:
+                break
+            sys.stdout.write(data.decode('utf8'))
+        s.close()
+        sys.exit(0)
+
 def main():
     parser = argparse.ArgumentParser(
         description='Console client for Gerrit Code Review.')
@@ -901,6 +956,8 @@ def main():
     parser.add_argument('--open', nargs=1, action=OpenChangeAction,
                         metavar='URL',
                         help='open the given URL in a running Gertty')
+    parser.add_argument('--sync-stats', nargs=0, action=SyncStatsAction,
+                        help='print sync statistics from a running Gertty as JSON')
     parser.add_argument('--version', dest='version', action='version',
                         version=version(),
                         help='show Gertty\'s version')
@@ -51,6 +51,7 @@ class ConfigSchema(object):
               'log-file': str,
               'socket': str,
               'auth-type': v.Any('basic', 'digest', 'form'),
+              'partial-clone': v.Any(bool, [str]),
               }
 
     servers = [server]
@@ -116,6 +117,9 @@ class ConfigSchema(object):
                                              'disabled', None),
                    v.Optional('thresholds'): thresholds}
 
+    sync_weights = {'normal': int,
+                    'low': int}
+
     def getSchema(self, data):
         schema = v.Schema({v.Required('servers'): self.servers,
                            'palettes': self.palettes,
@@ -127,6 +131,11 @@ class ConfigSchema(object):
                            'reviewkeys': self.reviewkeys,
                            'change-list-query': str,
                            'diff-view': str,
+                           'diff-cache-size': int,
+                           'precompute-diffs': int,
+                           'intraline-max-lines': int,
+                           'intraline-max-line-length': int,
+                           'intraline-processes': int,
                            'hide-comments': self.hide_comments,
                            'thread-changes': bool,
                            'display-times-in-utc': bool,
@@ -134,6 +143,11 @@ class ConfigSchema(object):
                            'breadcrumbs': bool,
                            'change-list-options': self.change_list_options,
                            'expire-age': str,
+                           'sync-workers': int,
+                           'fetch-workers': int,
+                           'conflict-sync-interval': int,
+                           'sync-weights': self.sync_weights,
+                           'max-poll-interval': int,
                            'size-column': self.size_column,
                            })
         return schema
@@ -189,6 +203,12 @@ class Config(object):
         if not git_url.endswith('/'):
             git_url += '/'
         self.git_url = git_url
+        partial_clone = server.get('partial-clone', False)
+        if isinstance(partial_clone, bool):
+            self.partial_clone = partial_clone
+        else:
+            self.partial_clone = [re.compile('(?:%s)$' % p)
+                                  for p in partial_clone]
         self.dburi = server.get('dburi',
                                 'sqlite:///' + os.path.expanduser('~/.gertty.db'))
         socket_path = server.get('socket', '~/.gertty.sock')
@@ -230,6 +250,12 @@ class Config(object):
         self.project_change_list_query = self.config.get('change-list-query', 'status:open')
 
         self.diff_view = self.config.get('diff-view', 'side-by-side')
+        # In MiB in the config file; stored in bytes.
+        self.diff_cache_size = max(0, self.config.get('diff-cache-size', 256)) * 1024 * 1024
+        self.precompute_diffs = max(0, self.config.get('precompute-diffs', 0))
+        self.intraline_max_lines = self.config.get('intraline-max-lines', 2000)
+        self.intraline_max_line_length = self.config.get('intraline-max-line-length', 1000)
+        self.intraline_processes = max(0, self.config.get('intraline-processes', 0))
 
         self.dashboards = OrderedDict()
         for d in self.config.get('dashboards', []):
@@ -256,6 +282,15 @@ class Config(object):
 
         self.expire_age = self.config.get('expire-age', '2 months')
 
+        self.sync_workers = max(1, self.config.get('sync-workers', 4))
+        self.fetch_workers = max(1, self.config.get('fetch-workers', 2))
+        self.conflict_sync_interval = self.config.get('conflict-sync-interval', 3600)
+        self.max_poll_interval = self.config.get('max-poll-interval', 900)
+        sync_weights = self.config.get('sync-weights', {})
+        self.sync_weights = {
+            'normal': max(1, sync_weights.get('normal', 4)),
+            'low': max(1, sync_weights.get('low', 1))}
+
         self.size_column = self.config.get('size-column', {})
         self.size_column['type'] = self.size_column.get('type', 'graph')
         if self.size_column['type'] == 'graph':
@@ -265,6 +300,14 @@ class Config(object):
             self.size_column['thresholds'] = self.size_column.get('thresholds',
                 [1, 10, 100, 200, 400, 600, 800, 1000])
 
+    def isPartialClone(self, project_name):
+        if isinstance(self.partial_clone, bool):
+            return self.partial_clone
+        for pattern in self.partial_clone:
+            if pattern.match(project_name):
+                return True
+        return False
+
     def getServer(self, name=None):
         for server in self.config['servers']:
             if name is None or name == server['name']:
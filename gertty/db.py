@@ -103,6 +103,7 @@ revision_table = Table(
     Column('fetch_ref', String(255), nullable=False),
     Column('pending_message', Boolean, index=True, nullable=False),
     Column('can_submit', Boolean, nullable=False),
+    Column('pending_fetch', Boolean, index=True, nullable=False),
     )
 message_table = Table(
     'message', metadata,
@@ -175,6 +176,13 @@ sync_query_table = Table(
     Column('name', String(255), index=True, unique=True, nullable=False),
     Column('updated', DateTime, index=True),
     )
+sync_task_table = Table(
+    'sync_task', metadata,
+    Column('key', Integer, primary_key=True),
+    Column('name', String(255), nullable=False),
+    Column('data', Text, nullable=False),
+    Column('priority', Integer, nullable=False),
+    )
 file_table = Table(
     'file', metadata,
     Column('key', Integer, primary_key=True),
@@ -422,7 +430,7 @@ class Change(object):
 class Revision(object):
     def __init__(self, change, number, message, commit, parent,
                  fetch_auth, fetch_ref, pending_message=False,
-                 can_submit=False):
+                 can_submit=False, pending_fetch=False):
         self.change_key = change.key
         self.number = number
         self.message = message
@@ -432,6 +440,7 @@ class Revision(object):
         self.fetch_ref = fetch_ref
         self.pending_message = pending_message
         self.can_submit = can_submit
+        self.pending_fetch = pending_fetch
 
     def createMessage(self, *args, **kw):
         session = Session.object_session(self)
@@ -559,6 +568,12 @@ class SyncQuery(object):
     def __init__(self, name):
         self.name = name
 
+class SyncTask(object):
+    def __init__(self, name, data, priority):
+        self.name = name
+        self.data = data
+        self.priority = priority
+
 class File(object):
     STATUS_ADDED = 'A'
     STATUS_DELETED = 'D'
@@ -714,6 +729,7 @@ mapper(Approval, approval_table, properties=dict(
         reviewer=relationship(Account)))
 mapper(PendingCherryPick, pending_cherry_pick_table)
 mapper(SyncQuery, sync_query_table)
+mapper(SyncTask, sync_task_table)
 
 def match(expr, item):
     if item is None:
@@ -742,10 +758,15 @@ class Database(object):
                                             autoflush=False)
         self.session = scoped_session(self.session_factory)
         self.lock = threading.Lock()
+        self.lock_times = threading.local()
 
     def getSession(self):
         return DatabaseSession(self)
 
+    def getLockTime(self):
+        """Return the total time the current thread has held the lock."""
+        return getattr(self.lock_times, 'total', 0.0)
+
     def migrate(self, app):
         conn = self.engine.connect()
         context = alembic.migration.MigrationContext.configure(conn)
@@ -784,6 +805,7 @@ class DatabaseSession(object):
         self.session = None
         end = time.time()
         self.database.log.debug("Database lock held %s seconds" % (end-self.start,))
+        self.database.lock_times.total = self.database.getLockTime() + (end-self.start)
         self.database.lock.release()
 
     def abort(self):
@@ -848,6 +870,14 @@ class DatabaseSession(object):
         except sqlalchemy.orm.exc.NoResultFound:
             return self.createSyncQuery(name)
 
+    def getSyncTasks(self):
+        return self.session().query(SyncTask).order_by(SyncTask.key).all()
+
+    def deleteSyncTasks(self, keys):
+        for i in range(0, len(keys), 500):
+            self.session().query(SyncTask).filter(
+                SyncTask.key.in_(keys[i:i+500])).delete(synchronize_session=False)
+
     def getChange(self, key, lazy=True):
         query = self.session().query(Change).filter_by(key=key)
         if not lazy:
@@ -872,6 +902,21 @@ class DatabaseSession(object):
         query = self.session().query(Change.id)
         return set(ids).intersection(r[0] for r in query.all())
 
+    def getChangesUpdated(self, ids):
+        # Returns a mapping of change ID to (updated, outdated) for
+        # the supplied IDs that exist in the local database.  This is
+        # used to avoid syncing changes which have not been updated
+        # remotely.
+        ret = {}
+        ids = list(ids)
+        # Stay under the SQLite limit on the number of host parameters.
+        for i in range(0, len(ids), 500):
+            query = self.session().query(Change.id, Change.updated, Change.outdated)
+            query = query.filter(Change.id.in_(ids[i:i+500]))
+            for (id, updated, outdated) in query.all():
+                ret[id] = (updated, outdated)
+        return ret
+
     def getChangesByChangeID(self, change_id):
         try:
             return self.session().query(Change).filter_by(change_id=change_id)
@@ -925,6 +970,30 @@ class DatabaseSession(object):
         except sqlalchemy.orm.exc.NoResultFound:
             return None
 
+    def getFetchedRevisionCommits(self, commits):
+        # Returns the subset of the supplied commits for which a
+        # revision exists in the local database and is not waiting to
+        # be fetched.
+        ret = set()
+        commits = list(commits)
+        for i in range(0, len(commits), 500):
+            query = self.session().query(Revision.commit)
+            query = query.filter(Revision.commit.in_(commits[i:i+500]),
+                                 Revision.pending_fetch==False)
+            ret.update([r[0] for r in query.all()])
+        return ret
+
+    def getOpenRevisionCommits(self, project_key):
+        # Returns (change number, parent, commit) for every revision
+        # of the project's open changes.  Changes without revisions
+        # are included with None for the parent and commit.
+        query = self.session().query(Change.number, Revision.parent,
+                                     Revision.commit).outerjoin(Revision)
+        query = query.filter(Change.project_key==project_key,
+                             Change.status!='MERGED',
+                             Change.status!='ABANDONED')
+        return query.all()
+
     def getRevisionsByParent(self, parent):
         if isinstance(parent, six.string_types):
             parent = (parent,)
@@ -975,6 +1044,10 @@ class DatabaseSession(object):
     def getOutdated(self):
         return self.session().query(Change).filter_by(outdated=True).all()
 
+    def getPendingFetchChanges(self):
+        return self.session().query(Change).join(Revision).filter(
+            Revision.pending_fetch==True).distinct().all()
+
     def getPendingMessages(self):
         return self.session().query(Message).filter_by(pending=True).all()
 
@@ -1036,6 +1109,12 @@ class DatabaseSession(object):
         self.session().flush()
         return o
 
+    def createSyncTask(self, *args, **kw):
+        o = SyncTask(*args, **kw)
+        self.session().add(o)
+        self.session().flush()
+        return o
+
     def createTopic(self, *args, **kw):
         o = Topic(*args, **kw)
         self.session().add(o)
@@ -0,0 +1,237 @@
+# Copyright 2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+
+from six.moves import cPickle as pickle
+
+from gertty import gitrepo
+
+# Increase this whenever the structure of DiffFile or DiffChunk (or
+# the way diffs are computed) changes; entries written with any other
+# version are discarded.
+FORMAT_VERSION = 6
+
+def compact(f):
+    """Return the data for a DiffFile which is stored in the cache.
+
+    The views modify the chunks of the files they display, so this
+    copies them.
+    """
+    chunks = []
+    for chunk in f.chunks:
+        if chunk.context:
+            chunks.append((True, chunk.old_start, chunk.new_start,
+                           list(chunk.texts), chunk.gap and list(chunk.gap)))
+        else:
+            chunks.append((False, chunk.old_start, chunk.new_start,
+                           list(chunk.old_texts), list(chunk.new_texts)))
+    return (f.oldname, f.newname, f.old_empty, f.new_empty, chunks)
+
+def serialize(data):
+    return zlib.compress(pickle.dumps(data, 2))
+
+def deserialize(value):
+    files = []
+    for (oldname, newname, old_empty, new_empty, chunks) in pickle.loads(
+            zlib.decompress(value)):
+        f = gitrepo.DiffFile()
+        f.oldname = oldname
+        f.newname = newname
+        f.old_empty = old_empty
+        f.new_empty = new_empty
+        for i, (context, old_start, new_start, a, b) in enumerate(chunks):
+            if context:
+                chunk = gitrepo.DiffContextChunk(old_start, new_start)
+                chunk.texts = a
+                chunk.gap = b
+            else:
+                chunk = gitrepo.DiffChangedChunk(old_start, new_start)
+                chunk.old_texts = a
+                chunk.new_texts = b
+            chunk.first = (i == 0)
+            chunk.last = (i == len(chunks) - 1)
+            f.chunks.append(chunk)
+        files.append(f)
+    return files
+
+class DiffCache(object):
+    """A size-bounded on-disk cache of parsed diffs.
+
+    Diffs are stored one per file, named by a hash of a key made up of
+    the commits and options which produced them.  The least recently used entries are
+    removed once the total size exceeds max_size bytes.
+    """
+
+    def __init__(self, path, max_size):
+        self.log = logging.getLogger('gertty.diffcache')
+        self.root = path
+        self.path = os.path.join(path, 'v%s' % FORMAT_VERSION)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        try:
+            self._load()
+        except (IOError, OSError):
+            self.log.exception("Unable to read diff cache %s" % (path,))
+
+    def _load(self):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        for name in os.listdir(self.root):
+            if name != os.path.basename(self.path):
+                shutil.rmtree(os.path.join(self.root, name),
+                              ignore_errors=True)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        found = []
+        for name in os.listdir(self.path):
+            st = os.stat(os.path.join(self.path, name))
+            found.append((st.st_mtime, name, st.st_size))
+        for (mtime, name, size) in sorted(found):
+            if name.startswith('tmp'):
+                os.unlink(os.path.join(self.path, name))
+                continue
+            self.entries[name] = size
+            self.size += size
+        self._prune()
+
+    def _key(self, key):
+        key = ' '.join([str(k) for k in key])
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def _prune(self):
+        while self.size > self.max_size and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def contains(self, key):
+        name = self._key(key)
+        with self.lock:
+            return name in self.entries
+
+    def get(self, key):
+        name = self._key(key)
+        with self.lock:
+            size = self.entries.pop(name, None)
+            if size is None:
+                return None
+            self.entries[name] = size
+        path = os.path.join(self.path, name)
+        try:
+            with open(path, 'rb') as f:
+                files = deserialize(f.read())
+            os.utime(path, None)
+            return files
+        except Exception:
+            self.log.exception("Discarding unreadable diff cache entry %s" %
+                               (name,))
+            with self.lock:
+                if self.entries.pop(name, None) is not None:
+                    self.size -= size
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return None
+
+    def put(self, key, data):
+        # data is a list of compact() tuples.
+        name = self._key(key)
+        value = serialize(data)
+        if len(value) > self.max_size:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(prefix='tmp', dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.rename(tmp, os.path.join(self.path, name))
+        except (IOError, OSError):
+            self.log.exception("Unable to write diff cache entry %s" %
+                               (name,))
+            return
+        with self.lock:
+            old_size = self.entries.pop(name, None)
+            if old_size is not None:
+                self.size -= old_size
+            self.entries[name] = len(value)
+            self.size += len(value)
+            self._prune()
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(config):
+    if not config.diff_cache_size:
+        return None
+    path = os.path.join(config.git_root, '.gertty-diff-cache')
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = DiffCache(path, config.diff_cache_size)
+            _caches[path] = cache
+        return cache
+
+def _diff_key(repo, old, new, context, show_old_commit):
+    return (old, new, context, show_old_commit,
+            repo.intraline.max_lines, repo.intraline.max_line_length)
+
+def is_cached(repo, config, old, new, context=10, show_old_commit=False):
+    cache = get_cache(config)
+    if cache is None:
+        return False
+    return cache.contains(_diff_key(repo, old, new, context, show_old_commit))
+
+def get_cached(repo, config, old, new, context=10, show_old_commit=False):
+    """Return the files of the diff from the cache, or None."""
+    cache = get_cache(config)
+    if cache is None:
+        return None
+    return cache.get(_diff_key(repo, old, new, context, show_old_commit))
+
+def iter_diff(repo, config, old, new, context=10, show_old_commit=False):
+    """Yield the files of repo.iterDiff(old, new), using the diff cache
+    if enabled.  The diff is cached once all of it has been read."""
+    cache = get_cache(config)
+    key = _diff_key(repo, old, new, context, show_old_commit)
+    if cache is not None:
+        files = cache.get(key)
+        if files is not None:
+            for f in files:
+                yield f
+            return
+    data = []
+    for f in repo.iterDiff(old, new, context=context,
+                           show_old_commit=show_old_commit):
+        if cache is not None:
+            data.append(compact(f))
+        yield f
+    if cache is not None:
+        cache.put(key, data)
+
+def diff(repo, config, old, new, context=10, show_old_commit=False):
+    """Return repo.diff(old, new), using the diff cache if enabled."""
+    return list(iter_diff(repo, config, old, new, context, show_old_commit))
@@ -17,15 +17,18 @@
 # https://review.openstack.org/119302
 # https://review.openstack.org/133550
 
+import collections
 import datetime
 import logging
 import difflib
-import itertools
+import multiprocessing
 import os
 import re
+import subprocess
+import tempfile
+import threading
 
 import git
-import gitdb
 import six
 
 OLD = 0
@@ -125,14 +128,97 @@ class CommitContext(object):
             fromfile="/a/COMMIT_MSG", tofile="/b/COMMIT_MSG"))
 
 
+def unquote_path(path):
+    """Remove the C-style quoting git uses for unusual file names."""
+    if not (len(path) > 1 and path.startswith('"') and path.endswith('"')):
+        return path
+    escapes = {'a': 7, 'b': 8, 't': 9, 'n': 10, 'v': 11, 'f': 12, 'r': 13,
+               '"': 34, '\\': 92}
+    path = path[1:-1]
+    ret = bytearray()
+    i = 0
+    while i < len(path):
+        c = path[i]
+        if c == '\\' and path[i+1:i+2] in escapes:
+            ret.append(escapes[path[i+1]])
+            i += 2
+        elif c == '\\':
+            ret.append(int(path[i+1:i+4], 8))
+            i += 4
+        else:
+            ret.extend(c.encode('utf-8'))
+            i += 1
+    return ret.decode('utf-8', 'replace')
+
+
+class GitDiffContext(object):
+    """A git.diff.Diff for one file in the output of git diff."""
+
+    def __init__(self, paths):
+        # The a/ and b/ paths on the "diff --git" line are the same
+        # unless the file was renamed, in which case the names are
+        # taken from the rename lines instead.
+        half = len(paths) // 2
+        self.a_path = unquote_path(paths[:half])[2:]
+        self.b_path = unquote_path(paths[half+1:])[2:]
+        self.new_file = False
+        self.deleted_file = False
+        self.rename_from = self.rename_to = None
+        self.mode_changed = False
+        self.diff = []
+
+    def parseHeader(self, line):
+        if line.startswith('new file mode'):
+            self.new_file = True
+        elif line.startswith('deleted file mode'):
+            self.deleted_file = True
+        elif line.startswith('rename from '):
+            self.rename_from = unquote_path(line[len('rename from '):])
+        elif line.startswith('new mode '):
+            self.mode_changed = True
+        elif line.startswith('rename to '):
+            self.rename_to = unquote_path(line[len('rename to '):])
+        elif line.startswith('--- ') and line[4:] != '/dev/null':
+            self.a_path = unquote_path(line[4:])[2:]
+        elif line.startswith('+++ ') and line[4:] != '/dev/null':
+            self.b_path = unquote_path(line[4:])[2:]
+
+
+def _compact_markup(markup, style):
+    # Lines shown entirely in the usual style for their side are
+    # stored as plain text.  The attribute names of other markup are
+    # interned, since markup computed by a worker process would
+    # otherwise carry its own copy of each of them.
+    if isinstance(markup, tuple):
+        if markup[0] == style:
+            return markup[1]
+        return (six.moves.intern(markup[0]), markup[1])
+    if isinstance(markup, list):
+        return [(six.moves.intern(attr), text) for attr, text in markup]
+    return markup
+
+def _expand_markup(text, style):
+    if isinstance(text, six.string_types):
+        return (style, text)
+    return text
+
 class DiffChunk(object):
-    def __init__(self):
-        self.oldlines = []
-        self.newlines = []
+    """A run of context or changed lines of a DiffFile.
+
+    Lines are numbered consecutively within a chunk, so only the
+    number of the first line on each side is stored.  getLines()
+    returns the lines in the form used by the views: a list of
+    ((old lineno, action, markup), (new lineno, action, markup)).
+    """
+
+    __slots__ = ('old_start', 'new_start', 'first', 'last', 'button')
+
+    def __init__(self, old_start=0, new_start=0):
+        self.old_start = old_start
+        self.new_start = new_start
         self.first = False
         self.last = False
-        self.lines = []
-        self.calcRange()
+        self.button = None
 
     def __repr__(self):
         return '<%s old lines %s-%s / new lines %s-%s>' % (
@@ -140,39 +226,138 @@ class DiffChunk(object):
             self.range[OLD][START], self.range[OLD][END],
             self.range[NEW][START], self.range[NEW][END])
 
-    def calcRange(self):
-        self.range = [[0, 0],
-                      [0, 0]]
-        for l in self.lines:
-            if self.range[OLD][START] == 0 and l[OLD][LINENO] is not None:
-                self.range[OLD][START] = l[OLD][LINENO]
-            if self.range[NEW][START] == 0 and l[NEW][LINENO] is not None:
-                self.range[NEW][START] = l[NEW][LINENO]
-            if (self.range[OLD][START] != 0 and
-                self.range[NEW][START] != 0):
-                break
-
-        for l in self.lines[::-1]:
-            if self.range[OLD][END] == 0 and l[OLD][LINENO] is not None:
-                self.range[OLD][END] = l[OLD][LINENO]
-            if self.range[NEW][END] == 0 and l[NEW][LINENO] is not None:
-                self.range[NEW][END] = l[NEW][LINENO]
-            if (self.range[OLD][END] != 0 and
-                self.range[NEW][END] != 0):
-                break
+    def start(self, oldnew):
+        if oldnew == OLD:
+            return self.old_start
+        return self.new_start
+
+    @property
+    def range(self):
+        # A side without any lines ends just before it starts.
+        return [[self.old_start, self.old_start + self.sideCount(OLD) - 1],
+                [self.new_start, self.new_start + self.sideCount(NEW) - 1]]
 
     def indexOfLine(self, oldnew, lineno):
-        for i, l in enumerate(self.lines):
-            if l[oldnew][LINENO] == lineno:
-                return i
+        start = self.start(oldnew)
+        if start <= lineno < start + self.sideCount(oldnew):
+            return lineno - start
 
 class DiffContextChunk(DiffChunk):
+    __slots__ = ('texts', 'gap')
     context = True
 
+    def __init__(self, old_start=0, new_start=0):
+        super(DiffContextChunk, self).__init__(old_start, new_start)
+        self.texts = []
+        # Lines of context which were not part of the output of git
+        # diff, and which are read from the file only when they are
+        # shown: [index in texts, count].
+        self.gap = None
+
+    def lineCount(self):
+        if self.gap:
+            return len(self.texts) + self.gap[1]
+        return len(self.texts)
+
+    def sideCount(self, oldnew):
+        return self.lineCount()
+
+    def _makeLines(self, index, texts):
+        old_lineno = self.old_start + index
+        new_lineno = self.new_start + index
+        return [((old_lineno + i, ' ', text), (new_lineno + i, ' ', text))
+                for i, text in enumerate(texts)]
+
+    def getLines(self, load=None):
+        if self.gap:
+            self.loadGap(load())
+        return self._makeLines(0, self.texts)
+
+    def loadGap(self, text):
+        # text is the list of lines of the file.
+        if not self.gap:
+            return
+        index, count = self.gap
+        start = self.new_start + index - 1
+        self.gap = None
+        texts = text[start:start + count]
+        texts += [''] * (count - len(texts))
+        self.texts[index:index] = texts
+
+    def takeFirst(self, count, load):
+        """Remove and return the first count lines.
+
+        load is called to read the lines of the file if they include
+        the gap.
+        """
+        if self.gap and self.gap[0] < count:
+            self.loadGap(load())
+        texts = self.texts[:count]
+        del self.texts[:count]
+        if self.gap:
+            self.gap[0] -= len(texts)
+        ret = self._makeLines(0, texts)
+        self.old_start += len(texts)
+        self.new_start += len(texts)
+        return ret
+
+    def takeLast(self, count, load):
+        """Remove and return the last count lines."""
+        if self.gap and len(self.texts) - self.gap[0] < count:
+            self.loadGap(load())
+        index = len(self.texts) - max(0, min(count, len(self.texts)))
+        texts = self.texts[index:]
+        del self.texts[index:]
+        if self.gap:
+            return self._makeLines(index + self.gap[1], texts)
+        return self._makeLines(index, texts)
+
+    def takeAll(self, load):
+        """Remove and return all of the lines."""
+        ret = self.getLines(load)
+        self.old_start += len(self.texts)
+        self.new_start += len(self.texts)
+        self.texts = []
+        return ret
+
 class DiffChangedChunk(DiffChunk):
+    __slots__ = ('old_texts', 'new_texts')
     context = False
 
+    def __init__(self, old_start=0, new_start=0):
+        super(DiffChangedChunk, self).__init__(old_start, new_start)
+        self.old_texts = []
+        self.new_texts = []
+
+    def lineCount(self):
+        return max(len(self.old_texts), len(self.new_texts))
+
+    def sideCount(self, oldnew):
+        if oldnew == OLD:
+            return len(self.old_texts)
+        return len(self.new_texts)
+
+    def getLines(self):
+        # The shorter side is padded with empty lines.
+        ret = []
+        for i in range(self.lineCount()):
+            if i < len(self.old_texts):
+                old = (self.old_start + i, '-',
+                       _expand_markup(self.old_texts[i], 'removed-line'))
+            else:
+                old = (None, '', '')
+            if i < len(self.new_texts):
+                new = (self.new_start + i, '+',
+                       _expand_markup(self.new_texts[i], 'added-line'))
+            else:
+                new = (None, '', '')
+            ret.append((old, new))
+        return ret
+
 class DiffFile(object):
+    __slots__ = ('newname', 'oldname', 'old_empty', 'new_empty', 'chunks',
+                 'current_chunk', 'old_lineno', 'new_lineno')
+
     def __init__(self):
         self.newname = 'Unknown File'
         self.oldname = 'Unknown File'
@@ -182,59 +367,75 @@ class DiffFile(object):
         self.current_chunk = None
         self.old_lineno = 0
         self.new_lineno = 0
-        self.offset = 0
 
     def finalize(self):
         if not self.current_chunk:
             return
-        self.current_chunk.lines = list(
-                six.moves.zip(self.current_chunk.oldlines,
-                              self.current_chunk.newlines))
         if not self.chunks:
             self.current_chunk.first = True
         else:
             self.chunks[-1].last = False
         self.current_chunk.last = True
-        self.current_chunk.calcRange()
         self.chunks.append(self.current_chunk)
         self.current_chunk = None
 
-    def addDiffLines(self, old, new):
-        if (self.current_chunk and
-            not isinstance(self.current_chunk, DiffChangedChunk)):
+    def findChunk(self, oldnew, lineno):
+        """Return the chunk which holds the given line, or None."""
+        # The chunks are in order on both sides, so bisect them.
+        lo = 0
+        hi = len(self.chunks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.chunks[mid].start(oldnew) <= lineno:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo and self.chunks[lo - 1].indexOfLine(oldnew, lineno) is not None:
+            return self.chunks[lo - 1]
+        return None
+
+    def _contextChunk(self):
+        chunk = self.current_chunk
+        # A context chunk only holds consecutive lines.
+        if chunk and (not isinstance(chunk, DiffContextChunk) or
+                      chunk.old_start + chunk.lineCount() != self.old_lineno):
             self.finalize()
         if not self.current_chunk:
-            self.current_chunk = DiffChangedChunk()
-        for l in old:
-            self.current_chunk.oldlines.append((self.old_lineno, '-', l))
-            self.old_lineno += 1
-            self.offset -= 1
-        for l in new:
-            self.current_chunk.newlines.append((self.new_lineno, '+', l))
-            self.new_lineno += 1
-            self.offset += 1
-        while self.offset > 0:
-            self.current_chunk.oldlines.append((None, '', ''))
-            self.offset -= 1
-        while self.offset < 0:
-            self.current_chunk.newlines.append((None, '', ''))
-            self.offset += 1
+            self.current_chunk = DiffContextChunk(self.old_lineno,
+                                                  self.new_lineno)
+        return self.current_chunk
+
+    def addDiffLines(self, old, new):
+        # Each run of changed lines is a chunk of its own, so that the
+        # line numbers on each side are consecutive.
+        self.finalize()
+        chunk = DiffChangedChunk(self.old_lineno, self.new_lineno)
+        chunk.old_texts = [_compact_markup(l, 'removed-line') for l in old]
+        chunk.new_texts = [_compact_markup(l, 'added-line') for l in new]
+        self.current_chunk = chunk
+        self.old_lineno += len(old)
+        self.new_lineno += len(new)
+
+    def addGap(self, count):
+        # Adds count lines of context which are not read until shown.
+        chunk = self._contextChunk()
+        if chunk.gap:
+            self.finalize()
+            chunk = self._contextChunk()
+        chunk.gap = [len(chunk.texts), count]
+        self.old_lineno += count
+        self.new_lineno += count
 
     def addNewLine(self, line):
         if (self.current_chunk and
             not isinstance(self.current_chunk, DiffChangedChunk)):
             self.finalize()
         if not self.current_chunk:
-            self.current_chunk = DiffChangedChunk()
+            self.current_chunk = DiffChangedChunk(self.old_lineno,
+                                                  self.new_lineno)
 
     def addContextLine(self, line):
-        if (self.current_chunk and
-            not isinstance(self.current_chunk, DiffContextChunk)):
-            self.finalize()
-        if not self.current_chunk:
-            self.current_chunk = DiffContextChunk()
-        self.current_chunk.oldlines.append((self.old_lineno, ' ', line))
-        self.current_chunk.newlines.append((self.new_lineno, ' ', line))
+        self._contextChunk().texts.append(line)
         self.old_lineno += 1
         self.new_lineno += 1
 
@@ -248,35 +449,440 @@ class GitCloneError(Exception):
         super(GitCloneError, self).__init__(msg)
         self.msg = msg
 
+# Several sync workers may operate on the same repository at once;
+# clones and fetches are serialized per repository path.
+_repo_locks = {}
+_repo_locks_lock = threading.Lock()
+
+def get_repo_lock(path):
+    with _repo_locks_lock:
+        lock = _repo_locks.get(path)
+        if lock is None:
+            lock = threading.Lock()
+            _repo_locks[path] = lock
+        return lock
+
+class IntralineDiffer(object):
+    """Emphasize the words which changed within a hunk.
+
+    Identical lines are found first; each remaining removed line is
+    then paired with the most similar of the next few added lines, so
+    the cost grows linearly with the size of the hunk.  The words of
+    each pair of lines are compared to find the changed ones.  Hunks
+    with more than max_lines lines, and lines longer than
+    max_line_length, are shown without emphasis.
+
+    If a multiprocessing pool is supplied, large batches of hunks are
+    handed to it so that the work is spread across several cores.
+    """
+
+    # How many added lines to consider for each removed line.
+    WINDOW = 8
+    # The minimum similarity of a pair of lines.
+    CUTOFF = 0.75
+    # Batches with fewer lines than this are handled in this process,
+    # where they are done sooner than they could be sent to a worker.
+    PARALLEL_THRESHOLD = 500
+    # How many files of a diff may be waiting on the pool at once.
+    MAX_PENDING = 16
+
+    token_re = re.compile(r'\w+|\s+|.', re.UNICODE)
+    trailing_ws_re = re.compile('\s+$')
+
+    def __init__(self, max_lines=2000, max_line_length=1000, pool=None):
+        self.max_lines = max_lines
+        self.max_line_length = max_line_length
+        self.pool = pool
+
+    def _emph_trail_ws(self, style, line):
+        result = (style, line)
+        re_result = self.trailing_ws_re.search(line)
+        if (re_result):
+            span = re_result.span()
+            if len(line[:span[0]]) == 0:
+                ws_line = ('trailing-ws', line)
+            else:
+                ws_line = [(style, line[:span[0]]),
+                           ('trailing-ws', line[span[0]:span[1]])]
+            result = ws_line
+        return result
+
+    def _tokenize(self, line):
+        if len(line) > self.max_line_length:
+            return None
+        return self.token_re.findall(line)
+
+    def _pair(self, old, new):
+        # Returns a list of (tag, old index, new index) where tag is
+        # 'equal' for identical lines and 'pair' for similar ones.
+        ret = []
+        old_tokens = {}
+        new_tokens = {}
+        matcher = difflib.SequenceMatcher(None, old, new)
+        cruncher = difflib.SequenceMatcher(None, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                for i in range(i2 - i1):
+                    ret.append(('equal', i1 + i, j1 + i))
+                continue
+            if tag != 'replace':
+                continue
+            j = j1
+            for i in range(i1, i2):
+                a = old_tokens[i] = self._tokenize(old[i])
+                if not a:
+                    continue
+                cruncher.set_seq2(a)
+                best = None
+                best_ratio = self.CUTOFF - 0.01
+                for k in range(j, min(j2, j + self.WINDOW)):
+                    if k not in new_tokens:
+                        new_tokens[k] = self._tokenize(new[k])
+                    b = new_tokens[k]
+                    if not b:
+                        continue
+                    cruncher.set_seq1(b)
+                    if (cruncher.real_quick_ratio() > best_ratio and
+                        cruncher.quick_ratio() > best_ratio):
+                        ratio = cruncher.ratio()
+                        if ratio > best_ratio:
+                            best = k
+                            best_ratio = ratio
+                if best is not None:
+                    ret.append(('pair', i, best))
+                    j = best + 1
+        return ret, old_tokens, new_tokens
+
+    def _markup(self, style, spans):
+        result = []
+        prev_emphasis = None
+        accumulator = ''
+        for emphasis, text in spans:
+            if not text:
+                continue
+            if emphasis != prev_emphasis and accumulator:
+                result.append((style + ('-word' if prev_emphasis else '-line'),
+                               accumulator))
+                accumulator = ''
+            prev_emphasis = emphasis
+            accumulator += text
+        if accumulator:
+            result.append(self._emph_trail_ws(
+                style + ('-word' if prev_emphasis else '-line'), accumulator))
+        return result
+
+    def _emphasize(self, a, b):
+        cruncher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+        old_spans = []
+        new_spans = []
+        for tag, i1, i2, j1, j2 in cruncher.get_opcodes():
+            old_spans.append((tag != 'equal', ''.join(a[i1:i2])))
+            new_spans.append((tag != 'equal', ''.join(b[j1:j2])))
+        return (self._markup('removed', old_spans),
+                self._markup('added', new_spans))
+
+    def diff(self, old, new):
+        # takes a list of old lines and a list of new lines
+        output_old = [('removed-line', l) for l in old]
+        output_new = [self._emph_trail_ws('added-line', l) for l in new]
+        if not old or not new or len(old) + len(new) > self.max_lines:
+            return output_old, output_new
+        pairs, old_tokens, new_tokens = self._pair(old, new)
+        for tag, i, j in pairs:
+            if tag == 'equal':
+                output_old[i] = ('context-line', old[i])
+                output_new[j] = self._emph_trail_ws('context-line', new[j])
+            else:
+                output_old[i], output_new[j] = self._emphasize(
+                    old_tokens[i], new_tokens[j])
+        return output_old, output_new
+
+    def diffMany(self, hunks):
+        # takes a list of (old lines, new lines)
+        return [self.diff(old, new) for old, new in hunks]
+
+    def submit(self, hunks):
+        """Start the intraline pass for a list of hunks.
+
+        Returns an object whose get() method returns the result of
+        diffMany(hunks) once it is available.
+        """
+        size = 0
+        for old, new in hunks:
+            if len(old) + len(new) <= self.max_lines:
+                size += len(old) + len(new)
+        if self.pool is None or size < self.PARALLEL_THRESHOLD:
+            return IntralineResult(self.diffMany(hunks))
+        return self.pool.apply_async(
+            _intraline_worker, (self.max_lines, self.max_line_length, hunks))
+
+class IntralineResult(object):
+    # A result computed in this process, with the interface of
+    # multiprocessing's AsyncResult.
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        return self.value
+
+def _intraline_worker(max_lines, max_line_length, hunks):
+    return IntralineDiffer(max_lines, max_line_length).diffMany(hunks)
+
+_intraline_pool = None
+
+def start_intraline_pool(processes):
+    """Start the worker processes used for intraline highlighting.
+
+    This forks, so it should be called before any threads are started.
+    A single worker could not run in parallel with anything and would
+    only add overhead, so no pool is started for fewer than two.
+    """
+    global _intraline_pool
+    if processes >= 2 and _intraline_pool is None:
+        _intraline_pool = multiprocessing.Pool(processes)
+    return _intraline_pool
+
+class ObjectReader(object):
+    """Look up objects through long-running git cat-file processes.
+
+    Each query is a single round trip over a pipe rather than a new
+    process or a walk through GitPython's object database.
+    """
+
+    def __init__(self, path):
+        self.log = logging.getLogger('gertty.gitrepo')
+        self.path = path
+        self.lock = threading.Lock()
+        self.check_proc = None
+        self.batch_proc = None
+
+    def _start(self, mode):
+        env = os.environ.copy()
+        if mode == '--batch-check':
+            # Existence checks should not make a partial clone ask the
+            # server for objects we do not have.
+            env['GIT_NO_LAZY_FETCH'] = '1'
+        executable = git.Git.GIT_PYTHON_GIT_EXECUTABLE or 'git'
+        return subprocess.Popen([executable, 'cat-file', mode],
+                                cwd=self.path, env=env,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+
+    def _stop(self, proc):
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+            proc.wait()
+        except Exception:
+            self.log.exception("Error stopping git cat-file")
+
+    def close(self):
+        with self.lock:
+            self._stop(self.check_proc)
+            self._stop(self.batch_proc)
+            self.check_proc = None
+            self.batch_proc = None
+
+    object_types = ('blob', 'tree', 'commit', 'tag')
+
+    def _parseHeader(self, header):
+        if not header:
+            raise IOError("git cat-file exited unexpectedly")
+        header = header.decode('utf-8', 'replace').rstrip('\n')
+        # Objects which do not exist are reported as "<name> missing"
+        # or "<name> ambiguous", and names may contain spaces.
+        if header.endswith(' missing') or header.endswith(' ambiguous'):
+            return None
+        parts = header.rsplit(' ', 2)
+        if (len(parts) != 3 or parts[1] not in self.object_types or
+            not parts[2].isdigit()):
+            raise IOError("Unexpected output from git cat-file: %s" % header)
+        return (parts[0], parts[1], int(parts[2]))
+
+    def _encode(self, name):
+        if isinstance(name, six.text_type):
+            return name.encode('utf-8') + b'\n'
+        return name + b'\n'
+
+    def _query(self, proc, name):
+        proc.stdin.write(self._encode(name))
+        proc.stdin.flush()
+        return self._parseHeader(proc.stdout.readline())
+
+    # Queries are written in batches small enough that neither the
+    # requests nor the responses can fill a pipe buffer.
+    BATCH_SIZE = 256
+
+    def _queryMany(self, proc, names):
+        ret = {}
+        for i in range(0, len(names), self.BATCH_SIZE):
+            batch = names[i:i+self.BATCH_SIZE]
+            proc.stdin.write(b''.join([self._encode(n) for n in batch]))
+            proc.stdin.flush()
+            for name in batch:
+                info = self._parseHeader(proc.stdout.readline())
+                if info is not None:
+                    ret[name] = info
+        return ret
+
+    def _request(self, mode, name):
+        if not name or '\n' in name:
+            return None, None
+        attr = 'check_proc' if mode == '--batch-check' else 'batch_proc'
+        for attempt in range(2):
+            proc = getattr(self, attr)
+            if proc is None:
+                proc = self._start(mode)
+                setattr(self, attr, proc)
+            try:
+                info = self._query(proc, name)
+                data = None
+                if info is not None and mode == '--batch':
+                    data = proc.stdout.read(info[2] + 1)[:-1]
+                return info, data
+            except (IOError, OSError, ValueError):
+                setattr(self, attr, None)
+                self._stop(proc)
+                if attempt:
+                    raise
+
+    def info(self, name):
+        """Return (sha, type, size) for an object, or None if missing."""
+        with self.lock:
+            return self._request('--batch-check', name)[0]
+
+    def infoMany(self, names):
+        """Return a mapping of name to (sha, type, size) for the objects
+        which exist."""
+        names = [n for n in set(names) if n and '\n' not in n]
+        with self.lock:
+            for attempt in range(2):
+                if self.check_proc is None:
+                    self.check_proc = self._start('--batch-check')
+                proc = self.check_proc
+                try:
+                    return self._queryMany(proc, names)
+                except (IOError, OSError, ValueError):
+                    self.check_proc = None
+                    self._stop(proc)
+                    if attempt:
+                        raise
+
+    def read(self, name):
+        """Return (sha, type, data) for an object, or None if missing."""
+        with self.lock:
+            info, data = self._request('--batch', name)
+        if info is None:
+            return None
+        return (info[0], info[1], data)
+
 class Repo(object):
-    def __init__(self, url, path):
+    def __init__(self, url, path, partial=False, intraline=None):
         self.log = logging.getLogger('gertty.gitrepo')
         self.url = url
         self.path = path
-        self.differ = difflib.Differ()
-        if not os.path.exists(path):
-            if url is None:
-                raise GitCloneError("No URL available for git clone")
-            git.Repo.clone_from(self.url, self.path)
+        self.intraline = IntralineDiffer(**(intraline or {}))
+        self.lock = get_repo_lock(path)
+        self.lines_lock = threading.Lock()
+        self.lines_cache = collections.OrderedDict()
+        with self.lock:
+            if not os.path.exists(path):
+                if url is None:
+                    raise GitCloneError("No URL available for git clone")
+                if partial:
+                    # Omit file contents; git fetches the blobs it
+                    # lacks from the origin when a diff or checkout
+                    # needs them.
+                    git.Repo.clone_from(self.url, self.path,
+                                        filter='blob:none')
+                else:
+                    git.Repo.clone_from(self.url, self.path)
+        self.reader = ObjectReader(path)
 
     def checkCommits(self, shas):
         invalid = set()
-        repo = git.Repo(self.path)
+        found = self.reader.infoMany(shas)
         for sha in shas:
-            try:
-                repo.commit(sha)
-            except gitdb.exc.BadObject:
-                invalid.add(sha)
-            except ValueError:
+            info = found.get(sha)
+            if info is None or info[1] != 'commit':
                 invalid.add(sha)
         return invalid
 
+    def readBlob(self, commit, path):
+        obj = self.reader.read('%s:%s' % (commit, path))
+        if obj is None or obj[1] != 'blob':
+            return None
+        return obj[2]
+
+    def countLines(self, commit, path):
+        # Counts the lines without decoding or keeping them.
+        data = self.readBlob(commit, path) or b''
+        count = data.count(b'\n')
+        if data and not data.endswith(b'\n'):
+            count += 1
+        return count
+
+    # The number of files kept by readLines.
+    MAX_CACHED_FILES = 16
+
+    def readLines(self, commit, path):
+        """Return the lines of a file as text."""
+        key = (commit, path)
+        with self.lines_lock:
+            lines = self.lines_cache.pop(key, None)
+            if lines is not None:
+                self.lines_cache[key] = lines
+                return lines
+        data = self.readBlob(commit, path) or b''
+        lines = data.decode('utf-8', 'replace').split('\n')
+        if not lines[-1]:
+            lines.pop()
+        with self.lines_lock:
+            self.lines_cache[key] = lines
+            while len(self.lines_cache) > self.MAX_CACHED_FILES:
+                self.lines_cache.popitem(last=False)
+        return lines
+
+    # Keep git command lines well under the usual argument size limits.
+    MAX_FETCH_ARGS_LENGTH = 64 * 1024
+
     def fetch(self, url, refspec):
-        repo = git.Repo(self.path)
+        if isinstance(refspec, six.string_types):
+            refspecs = [refspec]
+        else:
+            refspecs = list(refspec)
+        with self.lock:
+            repo = git.Repo(self.path)
+            length = sum([len(r) + 1 for r in refspecs])
+            if (length > self.MAX_FETCH_ARGS_LENGTH and
+                repo.git.version_info >= (2, 29)):
+                # Newer versions of git can read the refspecs from stdin.
+                with tempfile.TemporaryFile() as f:
+                    f.write(six.b('\n'.join(refspecs) + '\n'))
+                    f.seek(0)
+                    self._fetch(repo, '--stdin', url, istream=f)
+                return
+            chunk = []
+            length = 0
+            for r in refspecs:
+                if chunk and length + len(r) + 1 > self.MAX_FETCH_ARGS_LENGTH:
+                    self._fetch(repo, url, *chunk)
+                    chunk = []
+                    length = 0
+                chunk.append(r)
+                length += len(r) + 1
+            if chunk:
+                self._fetch(repo, url, *chunk)
+
+    def _fetch(self, repo, *args, **kw):
         try:
-            repo.git.fetch(url, refspec)
+            repo.git.fetch(*args, **kw)
         except AssertionError:
-            repo.git.fetch(url, refspec)
+            repo.git.fetch(*args, **kw)
 
     def deleteRef(self, ref):
         repo = git.Repo(self.path)
@@ -305,218 +911,240 @@ class Repo(object):
             ret.append(x.split('\t'))
         return ret
 
-    trailing_ws_re = re.compile('\s+$')
-    def _emph_trail_ws(self, style, line):
-        result = (style, line)
-        re_result = self.trailing_ws_re.search(line)
-        if (re_result):
-            span = re_result.span()
-            if len(line[:span[0]]) == 0:
-                ws_line = ('trailing-ws', line)
-            else:
-                ws_line = [(style, line[:span[0]]),
-                           ('trailing-ws', line[span[0]:span[1]])]
-            result = ws_line
-        return result
-
     def intralineDiff(self, old, new):
         # takes a list of old lines and a list of new lines
-        prevline = None
-        prevstyle = None
-        output_old = []
-        output_new = []
-        #self.log.debug('startold' + repr(old))
-        #self.log.debug('startnew' + repr(new))
-        for line in self.differ.compare(old, new):
-            #self.log.debug('diff output: ' + line)
-            key = line[0]
-            rest = line[2:]
-            if key == '?':
-                result = []
-                accumulator = ''
-                emphasis = False
-                rest = rest[:-1]  # It has a newline.
-                for i, c in enumerate(prevline):
-                    if i >= len(rest):
-                        indicator = ' '
-                    else:
-                        indicator = rest[i]
-                    #self.log.debug('%s %s %s %s %s' % (i, c, indicator, emphasis, accumulator))
-                    if indicator != ' ' and not emphasis:
-                        # changing from not emph to emph
-                        if accumulator:
-                            result.append((prevstyle+'-line', accumulator))
-                        accumulator = ''
-                        emphasis = True
-                    elif indicator == ' ' and emphasis:
-                        # changing from emph to not emph
-                        if accumulator:
-                            result.append((prevstyle+'-word', accumulator))
-                        accumulator = ''
-                        emphasis = False
-                    accumulator += c
-                if accumulator:
-                    if emphasis:
-                        result.append(self._emph_trail_ws(prevstyle+'-word',
-                                                          accumulator))
-                    else:
-                        result.append(self._emph_trail_ws(prevstyle+'-line',
-                                                          accumulator))
-                if prevstyle == 'added':
-                    output_new.append(result)
-                elif prevstyle == 'removed':
-                    output_old.append(result)
-                prevline = None
-                continue
-            if prevline is not None:
-                if prevstyle == 'added' or prevstyle == 'context':
-                    output_new.append(self._emph_trail_ws(prevstyle+'-line',
-                                                          prevline))
-                if prevstyle == 'removed' or prevstyle == 'context':
-                    output_old.append((prevstyle+'-line', prevline))
-            if key == '+':
-                prevstyle = 'added'
-            elif key == '-':
-                prevstyle = 'removed'
-            elif key == ' ':
-                prevstyle = 'context'
-            prevline = rest
-        #self.log.debug('prev'+repr(prevline))
-        if prevline is not None:
-            if prevstyle == 'added':
-                output_new.append(self._emph_trail_ws(prevstyle+'-line',
-                                                      prevline))
-            elif prevstyle == 'removed':
-                output_old.append((prevstyle+'-line', prevline))
-        #self.log.debug(repr(output_old))
-        #self.log.debug(repr(output_new))
-        return output_old, output_new
+        return self.intraline.diff(old, new)
 
     header_re = re.compile('@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@')
-    def diff(self, old, new, context=10000, show_old_commit=False):
+    def diff(self, old, new, context=10, show_old_commit=False):
         """Create a diff from old to new.
 
         Note that the commit message is also diffed, and listed as /COMMIT_MSG.
         """
+        return list(self.iterDiff(old, new, context, show_old_commit))
+
+    def iterDiff(self, old, new, context=10, show_old_commit=False):
+        """Create a diff from old to new, yielding one DiffFile at a time.
+
+        The output of git diff is parsed as it is produced, so the
+        first files are available before the whole diff is computed.
+        Unchanged lines beyond the given context are left as gaps in
+        the context chunks, which are read from the file if they are
+        expanded.
+        """
         repo = git.Repo(self.path)
-        #'-y', '-x', 'diff -C10', old, new, path).split('\n'):
         oldc = repo.commit(old)
         newc = repo.commit(new)
-        files = []
-        extra_contexts = []
         if show_old_commit:
-            extra_contexts.append(CommitContext(oldc, newc))
+            diff_context = CommitContext(oldc, newc)
         else:
-            extra_contexts.append(CommitContext(None, newc))
-        contexts = itertools.chain(
-            extra_contexts, oldc.diff(
-                newc, color='never', create_patch=True, unified=context))
-        for diff_context in contexts:
-            # Each iteration of this is a file
-            f = DiffFile()
-            f.oldname = diff_context.a_path
-            f.newname = diff_context.b_path
-            if diff_context.new_file:
-                f.oldname = 'Empty file'
-                f.old_empty = True
-            if diff_context.deleted_file:
-                f.newname = 'Empty file'
-                f.new_empty = True
-            files.append(f)
-            if diff_context.rename_from:
-                f.oldname = diff_context.rename_from
-            if diff_context.rename_to:
-                f.newname = diff_context.rename_to
-            oldchunk = []
-            newchunk = []
-            prev_key = ''
-            if isinstance(diff_context.diff, six.string_types):
-                diff_text = diff_context.diff
+            diff_context = CommitContext(None, newc)
+        yield self._makeDiffFile(diff_context, diff_context.diff.split('\n'))
+        executable = git.Git.GIT_PYTHON_GIT_EXECUTABLE or 'git'
+        cmd = [executable, '-c', 'core.quotepath=false', 'diff', '-M',
+               '--no-color', '--no-ext-diff', '-U%s' % (context,),
+               oldc.hexsha, newc.hexsha, '--']
+        proc = subprocess.Popen(cmd, cwd=self.path, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        # The intraline pass of several files may be under way in the
+        # pool at once; the files are still yielded in order.
+        if self.intraline.pool is None:
+            lookahead = 1
+        else:
+            lookahead = self.intraline.MAX_PENDING
+        pending = collections.deque()
+        try:
+            for diff_context in self._iterGitDiff(proc.stdout):
+                f, ops, hunks = self._parseDiffFile(
+                    diff_context, diff_context.diff + [''], context)
+                pending.append((f, ops, self.intraline.submit(hunks)))
+                while pending and (len(pending) >= lookahead or
+                                   pending[0][2].ready()):
+                    f, ops, result = pending.popleft()
+                    yield self._buildDiffFile(f, ops, result.get(),
+                                              newc.hexsha)
+            while pending:
+                f, ops, result = pending.popleft()
+                yield self._buildDiffFile(f, ops, result.get(), newc.hexsha)
+            stderr = proc.stderr.read()
+            if proc.wait():
+                raise git.exc.GitCommandError(cmd, proc.returncode, stderr)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+
+    def _iterGitDiff(self, stream):
+        # Yields a GitDiffContext for each file in the output of git diff.
+        diff_context = None
+        in_header = False
+        for line in stream:
+            line = line.decode('utf-8', 'replace')
+            if line.endswith('\n'):
+                line = line[:-1]
+            if line.startswith('diff --git '):
+                if diff_context:
+                    yield diff_context
+                diff_context = GitDiffContext(line[len('diff --git '):])
+                in_header = True
+            elif in_header and not (line.startswith('@@') or
+                                    line.startswith('Binary files')):
+                diff_context.parseHeader(line)
             else:
-                diff_text = diff_context.diff.decode('utf-8')
-            diff_lines = diff_text.split('\n')
-            for i, line in enumerate(diff_lines):
-                last_line = (i == len(diff_lines)-1)
-                if line.startswith('---'):
-                    continue
-                if line.startswith('+++'):
-                    continue
-                if line.startswith('@@'):
-                    #socket.sendall(line)
-                    m = self.header_re.match(line)
-                    #socket.sendall(str(m.groups()))
-                    f.old_lineno = int(m.group(1))
-                    f.new_lineno = int(m.group(3))
-                    continue
-                if not line:
-                    if prev_key != '\\':
-                        # Strangely, we get an extra newline in the
-                        # diff in the case that the last line is "\ No
-                        # newline at end of file".  This is a
-                        # workaround for that.
-                        prev_key = ''
-                        line = 'X '
-                    else:
-                        line = ' '
-                key = line[0]
-                rest = line[1:]
-                if key == '\\':
-                    # This is for "\ No newline at end of file" which
-                    # follows either a -, + or ' ' line to indicate
-                    # which file it's talking about (or both).  For
-                    # now, treat it like normal text and let the user
-                    # infer from context that it's not actually in the
-                    # file.  Potential TODO: highlight it to make that
-                    # more clear.
-                    if prev_key:
-                        key = prev_key
-                    else:
-                        key = ' '
-                    prev_key = '\\'
-                if key == '-':
-                    prev_key = '-'
-                    oldchunk.append(rest)
-                    if not last_line:
-                        continue
-                if key == '+':
-                    prev_key = '+'
-                    newchunk.append(rest)
-                    if not last_line:
-                        continue
-                prev_key = ''
-                # end of chunk
-                if oldchunk or newchunk:
-                    oldchunk, newchunk = self.intralineDiff(oldchunk, newchunk)
-                    f.addDiffLines(oldchunk, newchunk)
-                oldchunk = []
-                newchunk = []
-                if key == ' ':
-                    f.addContextLine(rest)
-                    continue
-                if line.startswith("similarity index"):
-                    continue
-                if line.startswith("rename"):
-                    continue
-                if line.startswith("index"):
+                in_header = False
+                diff_context.diff.append(line)
+        if diff_context:
+            yield diff_context
+
+    def _makeDiffFile(self, diff_context, diff_lines):
+        f, ops, hunks = self._parseDiffFile(diff_context, diff_lines)
+        return self._buildDiffFile(f, ops, self.intraline.diffMany(hunks))
+
+    def _parseDiffFile(self, diff_context, diff_lines, context=None):
+        # Returns a DiffFile with only its names filled in, a list of
+        # the operations which add its lines, and the changed hunks,
+        # which are left for the intraline pass.  If the diff was made
+        # with the given number of lines of context, the operations
+        # end with 'eof' when git's output does not show whether the
+        # file continues past the last hunk.
+        f = DiffFile()
+        ops = []
+        hunks = []
+        f.oldname = diff_context.a_path
+        f.newname = diff_context.b_path
+        if diff_context.new_file:
+            f.oldname = 'Empty file'
+            f.old_empty = True
+        if diff_context.deleted_file:
+            f.newname = 'Empty file'
+            f.new_empty = True
+        if diff_context.rename_from:
+            f.oldname = diff_context.rename_from
+        if diff_context.rename_to:
+            f.newname = diff_context.rename_to
+        oldchunk = []
+        newchunk = []
+        prev_key = ''
+        in_hunk = False
+        trailing = 0
+        at_eof = False
+        for i, line in enumerate(diff_lines):
+            last_line = (i == len(diff_lines)-1)
+            # Only the file header precedes the first hunk; later
+            # lines starting with these are removed or added lines.
+            if not in_hunk and line.startswith('---'):
+                continue
+            if not in_hunk and line.startswith('+++'):
+                continue
+            if line.startswith('@@'):
+                #socket.sendall(line)
+                m = self.header_re.match(line)
+                #socket.sendall(str(m.groups()))
+                ops.append(('hunk', int(m.group(1)), int(m.group(3))))
+                in_hunk = True
+                continue
+            if not line:
+                if prev_key != '\\':
+                    # Strangely, we get an extra newline in the
+                    # diff in the case that the last line is "\ No
+                    # newline at end of file".  This is a
+                    # workaround for that.
+                    prev_key = ''
+                    line = 'X '
+                else:
+                    line = ' '
+            key = line[0]
+            rest = line[1:]
+            if key == '\\':
+                # This is for "\ No newline at end of file" which
+                # follows either a -, + or ' ' line to indicate
+                # which file it's talking about (or both).  For
+                # now, treat it like normal text and let the user
+                # infer from context that it's not actually in the
+                # file.  Potential TODO: highlight it to make that
+                # more clear.
+                at_eof = True
+                if not prev_key:
+                    # It follows a context line, so it tells us
+                    # nothing about the change; leave it out rather
+                    # than number it as a line of both files.
                     continue
-                if line.startswith("Binary files"):
+                key = prev_key
+                prev_key = '\\'
+            if key == '-':
+                prev_key = '-'
+                oldchunk.append(rest)
+                if not last_line:
                     continue
+            if key == '+':
+                prev_key = '+'
+                newchunk.append(rest)
                 if not last_line:
-                    raise Exception("Unhandled line: %s" % line)
-            if not diff_context.diff:
-                # There is no diff, possibly because this is simply a
-                # rename.  Include context lines so that comments may
-                # appear.
-                if not f.new_empty:
-                    blob = newc.tree[f.newname]
-                else:
-                    blob = oldc.tree[f.oldname]
-                f.old_lineno = 1
-                f.new_lineno = 1
-                for line in blob.data_stream.read().splitlines():
-                    f.addContextLine(line)
-            f.finalize()
-        return files
+                    continue
+            prev_key = ''
+            # end of chunk
+            if oldchunk or newchunk:
+                ops.append(('change',))
+                hunks.append((oldchunk, newchunk))
+                trailing = 0
+            oldchunk = []
+            newchunk = []
+            if key == ' ':
+                ops.append(('context', rest))
+                trailing += 1
+                continue
+            if line.startswith("similarity index"):
+                continue
+            if line.startswith("rename"):
+                continue
+            if line.startswith("index"):
+                continue
+            if line.startswith("Binary files"):
+                continue
+            if not last_line:
+                raise Exception("Unhandled line: %s" % line)
+        if not diff_context.diff:
+            # There is no diff, possibly because this is simply a
+            # rename.  Include context lines so that comments may
+            # appear, unless only the mode changed.
+            if not (f.new_empty or (diff_context.mode_changed and
+                                    not diff_context.rename_to)):
+                ops.append(('hunk', 1, 1))
+                ops.append(('eof',))
+        elif (context is not None and in_hunk and not at_eof and
+              not f.new_empty and trailing >= context):
+            # git would have shown fewer lines of context after the
+            # last change if the file ended sooner.
+            ops.append(('eof',))
+        return f, ops, hunks
+
+    def _buildDiffFile(self, f, ops, changes, commit=None):
+        # changes holds the intraline markup of each changed hunk.  If
+        # commit is supplied, the unchanged lines of the file at that
+        # commit which git diff left out become gaps in the context.
+        changes = iter(changes)
+        for op in ops:
+            if op[0] == 'hunk':
+                old_lineno, new_lineno = op[1], op[2]
+                if commit and old_lineno > max(f.old_lineno, 1):
+                    f.old_lineno = max(f.old_lineno, 1)
+                    f.new_lineno = max(f.new_lineno, 1)
+                    f.addGap(old_lineno - f.old_lineno)
+                f.old_lineno, f.new_lineno = old_lineno, new_lineno
+            elif op[0] == 'context':
+                f.addContextLine(op[1])
+            elif op[0] == 'change':
+                f.addDiffLines(*next(changes))
+            elif commit:
+                f.old_lineno = max(f.old_lineno, 1)
+                f.new_lineno = max(f.new_lineno, 1)
+                count = self.countLines(commit, f.newname) - f.new_lineno + 1
+                if count > 0:
+                    f.addGap(count)
+        f.finalize()
+        return f
 
     def getFile(self, old, new, path):
         f = DiffFile()
@@ -524,19 +1152,41 @@ class Repo(object):
         f.newname = path
         f.old_lineno = 1
         f.new_lineno = 1
-        repo = git.Repo(self.path)
-        newc = repo.commit(new)
-        try:
-            blob = newc.tree[path]
-        except KeyError:
+        if self.readBlob(new, path) is None:
             return None
-        for line in blob.data_stream.read().splitlines():
+        for line in self.readLines(new, path):
             f.addContextLine(line)
         f.finalize()
         return f
 
+# Recently used repositories are kept open so that their cat-file
+# processes can be reused.
+MAX_OPEN_REPOS = 32
+_open_repos = collections.OrderedDict()
+_open_repos_lock = threading.Lock()
+
 def get_repo(project_name, config):
     local_path = os.path.join(config.git_root, project_name)
     local_root = os.path.abspath(config.git_root)
     assert os.path.commonprefix((local_root, local_path)) == local_root
-    return Repo(config.git_url + project_name, local_path)
+    with _open_repos_lock:
+        repo = _open_repos.pop(local_path, None)
+        if repo is not None:
+            if os.path.exists(local_path):
+                _open_repos[local_path] = repo
+                return repo
+            repo.reader.close()
+    intraline = dict(max_lines=config.intraline_max_lines,
+                     max_line_length=config.intraline_max_line_length,
+                     pool=_intraline_pool)
+    repo = Repo(config.git_url + project_name, local_path,
+                partial=config.isPartialClone(project_name),
+                intraline=intraline)
+    closed = []
+    with _open_repos_lock:
+        _open_repos[local_path] = repo
+        while len(_open_repos) > MAX_OPEN_REPOS:
+            closed.append(_open_repos.popitem(last=False)[1])
+    for old in closed:
+        old.reader.close()
+    return repo
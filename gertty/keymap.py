@@ -41,6 +41,7 @@ QUIT = 'quit'
 CHANGE_SEARCH = 'change search'
 REFINE_CHANGE_SEARCH = 'refine change search'
 LIST_HELD = 'list held changes'
+SYNC_STATUS = 'sync status'
 # Change screen:
 TOGGLE_REVIEWED = 'toggle reviewed'
 TOGGLE_HIDDEN = 'toggle hidden'
@@ -82,6 +83,7 @@ SELECT_PATCHSETS = 'select patchsets'
 NEXT_SELECTABLE = 'next selectable'
 PREV_SELECTABLE = 'prev selectable'
 INTERACTIVE_SEARCH = 'interactive search'
+CANCEL_DIFF = 'cancel diff'
 # Special:
 FURTHER_INPUT = 'further input'
 
@@ -107,6 +109,7 @@ DEFAULT_KEYMAP = {
     CHANGE_SEARCH: 'ctrl o',
     REFINE_CHANGE_SEARCH: 'meta o',
     LIST_HELD: 'f12',
+    SYNC_STATUS: 'meta s',
 
     TOGGLE_REVIEWED: 'v',
     TOGGLE_HIDDEN: 'k',
@@ -148,6 +151,7 @@ DEFAULT_KEYMAP = {
     NEXT_SELECTABLE: 'tab',
     PREV_SELECTABLE: 'shift tab',
     INTERACTIVE_SEARCH: 'ctrl s',
+    CANCEL_DIFF: 'ctrl g',
 }
 
 # Hi vi users!  Add more things here!  This overrides the default
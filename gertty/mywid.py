@@ -30,6 +30,8 @@ GLOBAL_HELP = (
      "Search for changes"),
     (keymap.LIST_HELD,
      "List held changes"),
+    (keymap.SYNC_STATUS,
+     "Show sync status and statistics"),
     (keymap.KILL,
      "Kill to end of line (editing)"),
     (keymap.YANK,
@@ -331,6 +333,10 @@ class Searchable(object):
             self.app.status.update(title=("Search: " + search))
         self.results = []
         self.current_result = 0
+        if hasattr(self.listbox.body, 'search'):
+            # The list walker can search items it has not built.
+            self.results = self.listbox.body.search(search, 'search-result')
+            return
         for i, line in enumerate(self.listbox.body):
             if hasattr(line, 'search'):
                 if line.search(search, 'search-result'):
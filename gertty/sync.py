@@ -14,16 +14,17 @@
 # under the License.
 
 import collections
+import email.utils
 import errno
 import logging
 import math
 import os
+import random
 import re
 import threading
 import json
 import time
 import datetime
-import warnings
 
 import dateutil.parser
 try:
@@ -37,6 +38,7 @@ from six.moves import queue
 from six.moves.urllib import parse as urlparse
 
 import gertty.version
+from gertty import diffcache
 from gertty import gitrepo
 from gertty.auth import FormAuth
 
@@ -48,19 +50,179 @@ TIMEOUT=30
 
 CLOSED_STATUSES = ['MERGED', 'ABANDONED']
 
+# The query options needed to sync everything about a change.
+CHANGE_DETAIL_OPTIONS = '&'.join(['o=%s' % x for x in [
+    'DETAILED_LABELS', 'ALL_REVISIONS', 'ALL_COMMITS', 'MESSAGES',
+    'DETAILED_ACCOUNTS', 'CURRENT_ACTIONS', 'ALL_FILES']])
+# The query options for listings passed to _syncListedChanges, which
+# compares each change's current revision with the local db.
+CHANGE_LIST_OPTIONS = 'o=CURRENT_REVISION'
+
 class OfflineError(Exception):
-    pass
+    def __init__(self, message, retry_after=None):
+        super(OfflineError, self).__init__(message)
+        # The number of seconds the server asked us to wait, if any.
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    # The Retry-After header holds either a number of seconds or an
+    # HTTP date.
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+OFFLINE_EXCEPTIONS = (requests.ConnectionError, OfflineError,
+                      requests.exceptions.ChunkedEncodingError,
+                      requests.exceptions.ReadTimeout)
+
+class OfflineBackoff(object):
+    # Decide how long to wait before checking whether the server is
+    # reachable again.  The delay doubles with each consecutive
+    # failure, up to a maximum, and is randomized so that clients
+    # which went offline at the same time do not retry in lockstep.
+    # A Retry-After value from the server is always honored.
+    def __init__(self, initial=5, maximum=300):
+        self.initial = initial
+        self.maximum = maximum
+        self.failures = 0
+
+    def failed(self, retry_after=None):
+        self.failures += 1
+        delay = min(self.maximum, self.initial * 2 ** (self.failures - 1))
+        delay = random.uniform(delay / 2.0, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def succeeded(self):
+        self.failures = 0
+
+class SyncMetrics(object):
+    # Record where sync spends its time: how long each class of task
+    # waited in the queue, ran, and held the database lock, and how
+    # many HTTP requests of each method were made, how much data they
+    # returned and how long they took.  Only the most recent request
+    # latencies are kept for computing percentiles.
+    LATENCY_SAMPLES = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.tasks = {}
+        self.requests = {}
+
+    def recordTask(self, name, run_time, wait_time, db_time, succeeded):
+        with self.lock:
+            stats = self.tasks.get(name)
+            if stats is None:
+                stats = dict(count=0, failures=0, run_time=0.0, max_run_time=0.0,
+                             wait_time=0.0, db_time=0.0)
+                self.tasks[name] = stats
+            stats['count'] += 1
+            if not succeeded:
+                stats['failures'] += 1
+            stats['run_time'] += run_time
+            stats['max_run_time'] = max(stats['max_run_time'], run_time)
+            stats['wait_time'] += wait_time
+            stats['db_time'] += db_time
+
+    def recordRequest(self, method, latency, size, status_code):
+        with self.lock:
+            stats = self.requests.get(method)
+            if stats is None:
+                stats = dict(count=0, errors=0, bytes=0,
+                             latencies=collections.deque(maxlen=self.LATENCY_SAMPLES))
+                self.requests[method] = stats
+            stats['count'] += 1
+            if status_code >= 400:
+                stats['errors'] += 1
+            stats['bytes'] += size
+            stats['latencies'].append(latency)
+
+    def _percentile(self, values, fraction):
+        if not values:
+            return 0.0
+        return values[int(round(fraction * (len(values) - 1)))]
+
+    def getStats(self):
+        # Return a copy of the metrics suitable for serializing as JSON.
+        with self.lock:
+            tasks = {}
+            for name, stats in self.tasks.items():
+                tasks[name] = dict(stats)
+            requests = {}
+            for method, stats in self.requests.items():
+                latencies = sorted(stats['latencies'])
+                requests[method] = dict(count=stats['count'],
+                                        errors=stats['errors'],
+                                        bytes=stats['bytes'],
+                                        p50=self._percentile(latencies, 0.5),
+                                        p90=self._percentile(latencies, 0.9),
+                                        p99=self._percentile(latencies, 0.99),
+                                        max=self._percentile(latencies, 1.0))
+        return dict(uptime=time.time() - self.start,
+                    tasks=tasks, requests=requests)
+
+class QueueWaitStats(object):
+    # How long items of one priority have waited in the queue before
+    # being handed to a worker.
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, wait):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
 
 class MultiQueue(object):
-    def __init__(self, priorities):
-        try:
-            self.queues = collections.OrderedDict()
-        except AttributeError:
-            self.queues = ordereddict.OrderedDict()
+    # Items are indexed by their class and identity (see
+    # Task.identity) so that finding duplicates, finding items of a
+    # class and completing items do not require scanning the queues.
+    #
+    # Priorities without a weight are strict: they are served before
+    # any others, and nothing of a lower priority is started while
+    # one of their items is in flight.  The remaining priorities share
+    # the workers in proportion to their weights, so that a steady
+    # stream of higher priority work can not starve lower priority
+    # work indefinitely.
+    def __init__(self, priorities, weights=None):
+        self.queues = self._makeQueue()
+        self.classes = {}
+        self.weights = weights or {}
+        self.passes = {}
+        self.stats = {}
         for key in priorities:
-            self.queues[key] = collections.deque()
+            self.queues[key] = self._makeQueue()
+            self.classes[key] = {}
+            self.stats[key] = QueueWaitStats()
+            if key in self.weights:
+                self.passes[key] = 0.0
         self.condition = threading.Condition()
-        self.incomplete = []
+        self.incomplete = {}
+
+    def _makeQueue(self):
+        try:
+            return collections.OrderedDict()
+        except AttributeError:
+            return ordereddict.OrderedDict()
+
+    def _key(self, item):
+        return (item.__class__, item.identity())
 
     def qsize(self):
         count = 0
@@ -76,8 +238,13 @@ class MultiQueue(object):
         added = False
         self.condition.acquire()
         try:
-            if item not in self.queues[priority]:
-                self.queues[priority].append(item)
+            key = self._key(item)
+            if key not in self.queues[priority]:
+                self.queues[priority][key] = (item, time.time())
+                classes = self.classes[priority]
+                if item.__class__ not in classes:
+                    classes[item.__class__] = self._makeQueue()
+                classes[item.__class__][key] = item
                 added = True
             self.condition.notify()
         finally:
@@ -88,24 +255,90 @@ class MultiQueue(object):
         self.condition.acquire()
         try:
             while True:
-                for queue in self.queues.values():
-                    try:
-                        ret = queue.popleft()
-                        self.incomplete.append(ret)
-                        return ret
-                    except IndexError:
-                        pass
+                ret = self._get()
+                if ret is not None:
+                    return ret
                 self.condition.wait()
         finally:
             self.condition.release()
 
+    def _get(self):
+        # Several workers may be pulling from this queue.  Never hand
+        # out an item equal to one that is already in flight, so that
+        # the same work is never performed concurrently.
+        busy = None
+        if self.incomplete:
+            busy = min(self.incomplete.values())
+        for priority in self.queues.keys():
+            if priority in self.weights:
+                continue
+            if busy is not None and busy < priority:
+                return None
+            item = self._take(priority)
+            if item is not None:
+                return item
+        if busy is not None and busy not in self.weights:
+            return None
+        # Serve the weighted priorities in order of the least service
+        # received relative to their weights.  Don't let a queue bank
+        # credit while it has nothing to do.
+        waiting = [p for p in self.passes if self.queues[p]]
+        if not waiting:
+            return None
+        floor = min([self.passes[p] for p in waiting])
+        for priority in self.passes:
+            if priority not in waiting:
+                self.passes[priority] = max(self.passes[priority], floor)
+        for priority in sorted(waiting, key=lambda p: (self.passes[p], p)):
+            item = self._take(priority)
+            if item is not None:
+                self.passes[priority] += 1.0 / self.weights[priority]
+                return item
+        return None
+
+    def _take(self, priority):
+        queue = self.queues[priority]
+        for key, (item, queued) in queue.items():
+            if key in self.incomplete:
+                continue
+            del queue[key]
+            del self.classes[priority][item.__class__][key]
+            self.incomplete[key] = priority
+            item.wait_time = time.time() - queued
+            self.stats[priority].add(item.wait_time)
+            return item
+        return None
+
+    def getWaitStats(self):
+        # Return, for each priority, the number of items started, the
+        # mean and maximum time they waited, and how many items are
+        # waiting now along with the age of the oldest.
+        ret = {}
+        now = time.time()
+        self.condition.acquire()
+        try:
+            for priority, queue in self.queues.items():
+                stats = self.stats[priority]
+                oldest = 0.0
+                for item, queued in queue.values():
+                    oldest = now - queued
+                    break
+                ret[priority] = dict(started=stats.count,
+                                     mean_wait=stats.mean,
+                                     max_wait=stats.max,
+                                     waiting=len(queue),
+                                     oldest_wait=oldest)
+        finally:
+            self.condition.release()
+        return ret
+
     def find(self, klass, priority):
         results = []
         self.condition.acquire()
         try:
-            for item in self.queues[priority]:
-                if isinstance(item, klass):
-                    results.append(item)
+            for item_class, items in self.classes[priority].items():
+                if issubclass(item_class, klass):
+                    results.extend(items.values())
         finally:
             self.condition.release()
         return results
@@ -113,12 +346,52 @@ class MultiQueue(object):
     def complete(self, item):
         self.condition.acquire()
         try:
-            if item in self.incomplete:
-                self.incomplete.remove(item)
+            self.incomplete.pop(self._key(item), None)
+            # Completing an item may unblock work for any of the
+            # waiting workers.
+            self.condition.notify_all()
         finally:
             self.condition.release()
 
 
+class ProjectPollSchedule(object):
+    # Decide when each subscribed project should next be polled for
+    # updated changes.  A project whose last poll found updated
+    # changes is polled again after the minimum interval; each poll
+    # which finds nothing doubles the interval, up to the maximum.
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.lock = threading.Lock()
+        self.intervals = {}
+        self.next_poll = {}
+
+    def due(self, keys, now=None):
+        if now is None:
+            now = time.time()
+        # Polls are started on a fixed tick, a little after the time
+        # the previous poll was recorded, so allow some slack in order
+        # not to leave a project waiting for an extra tick.
+        now += self.minimum / 2.0
+        with self.lock:
+            return [k for k in keys if self.next_poll.get(k, 0) <= now]
+
+    def polled(self, key, changed, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if changed:
+                interval = self.minimum
+            else:
+                interval = min(self.maximum,
+                               self.intervals.get(key, self.minimum / 2.0) * 2)
+            self.intervals[key] = interval
+            self.next_poll[key] = now + interval
+
+    def getInterval(self, key):
+        with self.lock:
+            return self.intervals.get(key)
+
 class UpdateEvent(object):
     def updateRelatedChanges(self, session, change):
         related_change_keys = set()
@@ -165,11 +438,89 @@ class ChangeUpdatedEvent(UpdateEvent):
         self.status_changed = False
         self.held_changed = False
 
+class TaskJournal(object):
+    # Record the tasks in the sync queue in the database so that work
+    # interrupted by quitting can be resumed at the next startup.
+    # Submitted and completed tasks are noted in memory and written to
+    # the database periodically by flush() rather than as they happen,
+    # to avoid contending for the database lock.  Batch tasks may grow
+    # until they start, so they are serialized when flushed.
+    TASK_CLASSES = {}
+
+    def __init__(self, app):
+        self.app = app
+        self.log = logging.getLogger('gertty.sync')
+        self.lock = threading.Lock()
+        self.tasks = {}
+        # id(task) -> (sync_task key, name, data) as written to the db
+        self.written = {}
+
+    @classmethod
+    def register(cls, klass):
+        cls.TASK_CLASSES[klass.__name__] = klass
+        return klass
+
+    def add(self, task):
+        if task.__class__.__name__ not in self.TASK_CLASSES:
+            return
+        with self.lock:
+            self.tasks[id(task)] = task
+
+    def remove(self, task):
+        with self.lock:
+            self.tasks.pop(id(task), None)
+
+    def flush(self):
+        with self.lock:
+            current = {}
+            for task_id, task in self.tasks.items():
+                current[task_id] = (task.__class__.__name__,
+                                    json.dumps(task.getJournalData(), sort_keys=True),
+                                    task.priority)
+            written = dict(self.written)
+        delete = []
+        for task_id, (key, name, data) in list(written.items()):
+            if current.get(task_id, (None, None))[:2] != (name, data):
+                delete.append(key)
+                del written[task_id]
+        if not delete and len(written) == len(current):
+            return
+        with self.app.db.getSession() as session:
+            session.deleteSyncTasks(delete)
+            for task_id, (name, data, priority) in current.items():
+                if task_id not in written:
+                    sync_task = session.createSyncTask(name, data, priority)
+                    written[task_id] = (sync_task.key, name, data)
+        with self.lock:
+            self.written = written
+
+    def replay(self):
+        # Return the tasks recorded by a previous run and clear them
+        # from the journal; they are recorded again when submitted.
+        tasks = []
+        with self.app.db.getSession() as session:
+            sync_tasks = session.getSyncTasks()
+            for sync_task in sync_tasks:
+                klass = self.TASK_CLASSES.get(sync_task.name)
+                if klass is None:
+                    self.log.warning("Unable to replay unknown task %s" % (sync_task.name,))
+                    continue
+                try:
+                    kw = dict([(str(k), v) for (k, v) in json.loads(sync_task.data).items()])
+                    tasks.append(klass(priority=sync_task.priority, **kw))
+                except Exception:
+                    self.log.exception("Unable to replay task %s %s" % (
+                        sync_task.name, sync_task.data))
+            session.deleteSyncTasks([t.key for t in sync_tasks])
+        return tasks
+
 class Task(object):
     def __init__(self, priority=NORMAL_PRIORITY):
         self.log = logging.getLogger('gertty.sync')
         self.priority = priority
         self.succeeded = None
+        # How long this task waited in the sync queue.
+        self.wait_time = 0.0
         self.event = threading.Event()
         self.tasks = []
         self.results = []
@@ -182,17 +533,32 @@ class Task(object):
         self.event.wait(timeout)
         return self.succeeded
 
-    def __eq__(self, other):
+    def identity(self):
+        # Return a hashable value which, along with the class,
+        # identifies the work this task performs.  The sync queue uses
+        # it to avoid queuing the same work twice.
         raise NotImplementedError()
 
+    def getJournalData(self):
+        # Return the arguments (other than the priority) needed to
+        # recreate this task after a restart, as a dict which can be
+        # serialized as JSON, or None if the task should not be
+        # recorded in the journal (see TaskJournal).
+        return None
+
+    def __eq__(self, other):
+        return (other.__class__ == self.__class__ and
+                other.identity() == self.identity())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
 class SyncOwnAccountTask(Task):
     def __repr__(self):
         return '<SyncOwnAccountTask>'
 
-    def __eq__(self, other):
-        if other.__class__ == self.__class__:
-            return True
-        return False
+    def identity(self):
+        return None
 
     def run(self, sync):
         app = sync.app
@@ -208,10 +574,8 @@ class GetVersionTask(Task):
     def __repr__(self):
         return '<GetVersionTask>'
 
-    def __eq__(self, other):
-        if other.__class__ == self.__class__:
-            return True
-        return False
+    def identity(self):
+        return None
 
     def run(self, sync):
         version = sync.get('config/server/version')
@@ -221,10 +585,8 @@ class SyncProjectListTask(Task):
     def __repr__(self):
         return '<SyncProjectListTask>'
 
-    def __eq__(self, other):
-        if other.__class__ == self.__class__:
-            return True
-        return False
+    def identity(self):
+        return None
 
     def run(self, sync):
         app = sync.app
@@ -251,10 +613,8 @@ class SyncSubscribedProjectBranchesTask(Task):
     def __repr__(self):
         return '<SyncSubscribedProjectBranchesTask>'
 
-    def __eq__(self, other):
-        if other.__class__ == self.__class__:
-            return True
-        return False
+    def identity(self):
+        return None
 
     def run(self, sync):
         app = sync.app
@@ -263,6 +623,7 @@ class SyncSubscribedProjectBranchesTask(Task):
         for p in projects:
             sync.submitTask(SyncProjectBranchesTask(p.name, self.priority))
 
+@TaskJournal.register
 class SyncProjectBranchesTask(Task):
     branch_re = re.compile(r'refs/heads/(.*)')
 
@@ -273,11 +634,11 @@ class SyncProjectBranchesTask(Task):
     def __repr__(self):
         return '<SyncProjectBranchesTask %s>' % (self.project_name,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.project_name == self.project_name):
-            return True
-        return False
+    def identity(self):
+        return self.project_name
+
+    def getJournalData(self):
+        return dict(project_name=self.project_name)
 
     def run(self, sync):
         app = sync.app
@@ -303,71 +664,80 @@ class SyncProjectBranchesTask(Task):
                 self.log.info("Added branch %s to project %s in local DB.", name, project.name)
 
 class SyncSubscribedProjectsTask(Task):
+    def __init__(self, priority=NORMAL_PRIORITY, force=False):
+        super(SyncSubscribedProjectsTask, self).__init__(priority)
+        self.force = force
+
     def __repr__(self):
         return '<SyncSubscribedProjectsTask>'
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__):
-            return True
-        return False
+    def identity(self):
+        return self.force
 
     def run(self, sync):
         app = sync.app
         with app.db.getSession() as session:
             keys = [p.key for p in session.getProjects(subscribed=True)]
+        if not self.force:
+            # Only poll the projects which are due (see
+            # ProjectPollSchedule).
+            due = sync.poll_schedule.due(keys)
+            self.log.debug("Polling %s of %s subscribed projects" % (len(due), len(keys)))
+            keys = due
         for i in range(0, len(keys), 10):
-            t = SyncProjectTask(keys[i:i+10], self.priority)
+            t = SyncProjectTask(keys[i:i+10], self.priority, force=self.force)
             self.tasks.append(t)
             sync.submitTask(t)
-        t = SyncQueriedChangesTask('owner', 'is:owner', self.priority)
+        t = SyncQueriedChangesTask('owner', 'is:owner', self.priority,
+                                   force=self.force)
         self.tasks.append(t)
         sync.submitTask(t)
-        t = SyncQueriedChangesTask('starred', 'is:starred', self.priority)
+        t = SyncQueriedChangesTask('starred', 'is:starred', self.priority,
+                                   force=self.force)
         self.tasks.append(t)
         sync.submitTask(t)
 
+@TaskJournal.register
 class SyncProjectTask(Task):
-    def __init__(self, project_keys, priority=NORMAL_PRIORITY):
+    def __init__(self, project_keys, priority=NORMAL_PRIORITY, force=False):
         super(SyncProjectTask, self).__init__(priority)
         if type(project_keys) == int:
             project_keys = [project_keys]
         self.project_keys = project_keys
+        # If set, sync every listed change even if it appears to be
+        # up to date locally.
+        self.force = force
 
     def __repr__(self):
         return '<SyncProjectTask %s>' % (self.project_keys,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.project_keys == self.project_keys):
-            return True
-        return False
+    def identity(self):
+        return (tuple(self.project_keys), self.force)
+
+    def getJournalData(self):
+        return dict(project_keys=list(self.project_keys), force=self.force)
 
     def run(self, sync):
         app = sync.app
         now = datetime.datetime.utcnow()
         queries = []
+        project_names = {}
         with app.db.getSession() as session:
             for project_key in self.project_keys:
                 project = session.getProject(project_key)
+                project_names[project_key] = project.name
                 query = 'q=project:%s' % project.name
                 if project.updated:
                     # Allow 4 seconds for request time, etc.
                     query += ' -age:%ss' % (int(math.ceil((now-project.updated).total_seconds())) + 4,)
                 else:
                     query += ' status:open'
-                queries.append(query)
+                queries.append('%s&%s' % (query, CHANGE_LIST_OPTIONS))
         changes = sync.query(queries)
-        change_ids = [c['id'] for c in changes]
-        with app.db.getSession() as session:
-            # Winnow the list of IDs to only the ones in the local DB.
-            change_ids = session.getChangeIDs(change_ids)
-
-        for c in changes:
-            # For now, just sync open changes or changes already
-            # in the db optionally we could sync all changes ever
-            if c['id'] in change_ids or (c['status'] not in CLOSED_STATUSES):
-                sync.submitTask(SyncChangeTask(c['id'], priority=self.priority))
+        sync._syncListedChanges(changes, self.priority, self.force)
+        updated_projects = set([c['project'] for c in changes])
         for key in self.project_keys:
+            sync.poll_schedule.polled(key, project_names[key] in updated_projects)
             sync.submitTask(SetProjectUpdatedTask(key, now, priority=self.priority))
 
 class SetProjectUpdatedTask(Task):
@@ -379,12 +749,8 @@ class SetProjectUpdatedTask(Task):
     def __repr__(self):
         return '<SetProjectUpdatedTask %s %s>' % (self.project_key, self.updated)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.project_key == self.project_key and
-            other.updated == self.updated):
-            return True
-        return False
+    def identity(self):
+        return (self.project_key, self.updated)
 
     def run(self, sync):
         app = sync.app
@@ -393,20 +759,17 @@ class SetProjectUpdatedTask(Task):
             project.updated = self.updated
 
 class SyncQueriedChangesTask(Task):
-    def __init__(self, query_name, query, priority=NORMAL_PRIORITY):
+    def __init__(self, query_name, query, priority=NORMAL_PRIORITY, force=False):
         super(SyncQueriedChangesTask, self).__init__(priority)
         self.query_name = query_name
         self.query = query
+        self.force = force
 
     def __repr__(self):
         return '<SyncQueriedChangesTask %s>' % self.query_name
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.query_name == self.query_name and
-            other.query == self.query):
-            return True
-        return False
+    def identity(self):
+        return (self.query_name, self.query, self.force)
 
     def run(self, sync):
         app = sync.app
@@ -421,6 +784,7 @@ class SyncQueriedChangesTask(Task):
                 query += ' status:open'
             for project in session.getProjects(subscribed=True):
                 query += ' -project:%s' % project.name
+        query += '&' + CHANGE_LIST_OPTIONS
         changes = []
         sortkey = ''
         done = False
@@ -441,16 +805,7 @@ class SyncQueriedChangesTask(Task):
                     else:
                         offset += len(batch)
                         sortkey = '&start=%s' % (offset,)
-        change_ids = [c['id'] for c in changes]
-        with app.db.getSession() as session:
-            # Winnow the list of IDs to only the ones in the local DB.
-            change_ids = session.getChangeIDs(change_ids)
-
-        for c in changes:
-            # For now, just sync open changes or changes already
-            # in the db optionally we could sync all changes ever
-            if c['id'] in change_ids or (c['status'] not in CLOSED_STATUSES):
-                sync.submitTask(SyncChangeTask(c['id'], priority=self.priority))
+        sync._syncListedChanges(changes, self.priority, self.force)
         sync.submitTask(SetSyncQueryUpdatedTask(self.query_name, now, priority=self.priority))
 
 class SetSyncQueryUpdatedTask(Task):
@@ -462,12 +817,8 @@ class SetSyncQueryUpdatedTask(Task):
     def __repr__(self):
         return '<SetSyncQueryUpdatedTask %s %s>' % (self.query_name, self.updated)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.query_name == self.query_name and
-            other.updated == self.updated):
-            return True
-        return False
+    def identity(self):
+        return (self.query_name, self.updated)
 
     def run(self, sync):
         app = sync.app
@@ -475,6 +826,7 @@ class SetSyncQueryUpdatedTask(Task):
             sync_query = session.getSyncQueryByName(self.query_name)
             sync_query.updated = self.updated
 
+@TaskJournal.register
 class SyncChangesByCommitsTask(Task):
     def __init__(self, commits, priority=NORMAL_PRIORITY):
         super(SyncChangesByCommitsTask, self).__init__(priority)
@@ -483,11 +835,13 @@ class SyncChangesByCommitsTask(Task):
     def __repr__(self):
         return '<SyncChangesByCommitsTask %s>' % (self.commits,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.commits == self.commits):
-            return True
-        return False
+    def identity(self):
+        # Commits are added to the batch while it is queued, so it is
+        # only ever equal to itself.
+        return id(self)
+
+    def getJournalData(self):
+        return dict(commits=list(self.commits))
 
     def run(self, sync):
         query = ' OR '.join(['commit:%s' % x for x in self.commits])
@@ -506,6 +860,56 @@ class SyncChangesByCommitsTask(Task):
         self.commits.append(commit)
         return True
 
+@TaskJournal.register
+class SyncChangesByNumbersTask(Task):
+    def __init__(self, numbers, force_fetch=False, priority=NORMAL_PRIORITY):
+        super(SyncChangesByNumbersTask, self).__init__(priority)
+        self.numbers = numbers
+        self.force_fetch = force_fetch
+
+    def __repr__(self):
+        return '<SyncChangesByNumbersTask %s>' % (self.numbers,)
+
+    def identity(self):
+        # Numbers are added to the batch while it is queued, so it is
+        # only ever equal to itself.
+        return id(self)
+
+    def getJournalData(self):
+        return dict(numbers=list(self.numbers), force_fetch=self.force_fetch)
+
+    def run(self, sync):
+        # Fetch the details of every change in the batch with a single
+        # query, then apply each of them as SyncChangeTask would.
+        query = ' OR '.join(['change:%s' % x for x in self.numbers])
+        self.log.debug('Query: %s ' % (query,))
+        remote_changes = sync.query(['q=%s&%s' % (query, CHANGE_DETAIL_OPTIONS)])
+        seen = set()
+        for remote_change in remote_changes:
+            seen.add(remote_change['_number'])
+            task = SyncChangeTask(remote_change['id'], force_fetch=self.force_fetch,
+                                  priority=self.priority)
+            try:
+                task.run(sync, remote_change)
+            except OFFLINE_EXCEPTIONS:
+                raise
+            except Exception:
+                self.log.exception("Exception syncing change %s" % (remote_change['id'],))
+            self.results += task.results
+        for number in self.numbers:
+            if number not in seen:
+                self.log.warning("Change %s was not returned by the server" % (number,))
+
+    def addNumber(self, number):
+        if number in self.numbers:
+            return True
+        # Every change in the result carries all of its revisions,
+        # files and messages, so keep the batches fairly small.
+        if len(self.numbers) >= 50:
+            return False
+        self.numbers.append(number)
+        return True
+
 class SyncChangeByNumberTask(Task):
     def __init__(self, number, priority=NORMAL_PRIORITY):
         super(SyncChangeByNumberTask, self).__init__(priority)
@@ -514,11 +918,8 @@ class SyncChangeByNumberTask(Task):
     def __repr__(self):
         return '<SyncChangeByNumberTask %s>' % (self.number,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.number == self.number):
-            return True
-        return False
+    def identity(self):
+        return self.number
 
     def run(self, sync):
         query = '%s' % self.number
@@ -534,20 +935,138 @@ class SyncOutdatedChangesTask(Task):
     def __init__(self, priority=NORMAL_PRIORITY):
         super(SyncOutdatedChangesTask, self).__init__(priority)
 
-    def __eq__(self, other):
-        if other.__class__ == self.__class__:
-            return True
-        return False
+    def identity(self):
+        return None
 
     def __repr__(self):
         return '<SyncOutdatedChangesTask>'
 
     def run(self, sync):
+        numbers = []
         with sync.app.db.getSession() as session:
             for change in session.getOutdated():
                 self.log.debug("Sync outdated change %s" % (change.id,))
-                sync.submitTask(SyncChangeTask(change.id, priority=self.priority))
+                numbers.append(change.number)
+            # Also retry fetches which never completed (for instance,
+            # because Gertty was stopped first).
+            for change in session.getPendingFetchChanges():
+                if change.number not in numbers:
+                    self.log.debug("Sync change %s with pending fetches" % (change.id,))
+                    numbers.append(change.number)
+        sync._syncChangesByNumber(numbers, self.priority)
+
+class SyncSubscribedProjectConflictsTask(Task):
+    def __init__(self, priority=NORMAL_PRIORITY):
+        super(SyncSubscribedProjectConflictsTask, self).__init__(priority)
+
+    def __repr__(self):
+        return '<SyncSubscribedProjectConflictsTask>'
+
+    def identity(self):
+        return None
+
+    def run(self, sync):
+        app = sync.app
+        with app.db.getSession() as session:
+            keys = [p.key for p in session.getProjects(subscribed=True)]
+        for key in keys:
+            t = SyncProjectConflictsTask(key, self.priority)
+            self.tasks.append(t)
+            sync.submitTask(t)
+
+class SyncProjectConflictsTask(Task):
+    def __init__(self, project_key, priority=NORMAL_PRIORITY):
+        super(SyncProjectConflictsTask, self).__init__(priority)
+        self.project_key = project_key
+
+    def __repr__(self):
+        return '<SyncProjectConflictsTask %s>' % (self.project_key,)
+
+    def identity(self):
+        return self.project_key
+
+    def run(self, sync):
+        app = sync.app
+        with app.db.getSession() as session:
+            project = session.getProject(self.project_key)
+            if not project:
+                return
+            numbers = [c.number for c in project.open_changes]
+        for i in range(0, len(numbers), SyncConflictsTask.BATCH_SIZE):
+            t = SyncConflictsTask(numbers[i:i+SyncConflictsTask.BATCH_SIZE], self.priority)
+            self.tasks.append(t)
+            sync.submitTask(t)
+
+@TaskJournal.register
+class SyncConflictsTask(Task):
+    # Each change needs its own conflicts query, but several of them
+    # can be sent in one request.
+    BATCH_SIZE = 10
+
+    def __init__(self, numbers, priority=NORMAL_PRIORITY):
+        super(SyncConflictsTask, self).__init__(priority)
+        self.numbers = numbers
+
+    def __repr__(self):
+        return '<SyncConflictsTask %s>' % (self.numbers,)
 
+    def identity(self):
+        return tuple(self.numbers)
+
+    def getJournalData(self):
+        return dict(numbers=list(self.numbers))
+
+    def run(self, sync):
+        app = sync.app
+        query = '&'.join(['q=status:open+is:mergeable+conflicts:%s' % x
+                          for x in self.numbers])
+        self.log.debug('Query: %s ' % (query,))
+        results = sync.get('changes/?n=500&%s' % (query,))
+        if len(self.numbers) == 1:
+            results = [results]
+        with app.db.getSession() as session:
+            for number, remote_conflicts in zip(self.numbers, results):
+                change = session.getChangeByNumber(number)
+                if not change:
+                    continue
+                self._syncConflicts(sync, session, change, remote_conflicts)
+
+    def _syncConflicts(self, sync, session, change, remote_conflicts):
+        changed = set()
+        unseen_conflicts = [x.id for x in change.conflicts]
+        for remote_conflict in remote_conflicts:
+            conflict_id = remote_conflict['id']
+            conflict = session.getChangeByID(conflict_id)
+            if not conflict:
+                self.log.info("Need to sync conflicting change %s for change %s.",
+                              conflict_id, change.number)
+                sync.submitTask(SyncChangeTask(conflict_id, priority=self.priority))
+            else:
+                if conflict not in change.conflicts:
+                    self.log.info("Added conflict %s for change %s in local DB.",
+                                  conflict.number, change.number)
+                    change.addConflict(conflict)
+                    changed.add(conflict)
+            if conflict_id in unseen_conflicts:
+                unseen_conflicts.remove(conflict_id)
+        for conflict_id in unseen_conflicts:
+            conflict = session.getChangeByID(conflict_id)
+            self.log.info("Deleted conflict %s for change %s in local DB.",
+                          conflict.number, change.number)
+            change.delConflict(conflict)
+            changed.add(conflict)
+        if not changed:
+            return
+        event = ChangeUpdatedEvent(change)
+        event.related_change_keys = set([change.key])
+        self.results.append(event)
+        for conflict in changed:
+            event.related_change_keys.add(conflict.key)
+            conflict_event = ChangeUpdatedEvent(conflict)
+            conflict_event.related_change_keys = set([conflict.key, change.key])
+            self.results.append(conflict_event)
+
+@TaskJournal.register
 class SyncChangeTask(Task):
     def __init__(self, change_id, force_fetch=False, priority=NORMAL_PRIORITY):
         super(SyncChangeTask, self).__init__(priority)
@@ -557,17 +1076,16 @@ class SyncChangeTask(Task):
     def __repr__(self):
         return '<SyncChangeTask %s>' % (self.change_id,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.change_id == self.change_id and
-            other.force_fetch == self.force_fetch):
-            return True
-        return False
+    def identity(self):
+        return (self.change_id, self.force_fetch)
 
-    def run(self, sync):
+    def getJournalData(self):
+        return dict(change_id=self.change_id, force_fetch=self.force_fetch)
+
+    def run(self, sync, remote_change=None):
         start_time = time.time()
         try:
-            self._syncChange(sync)
+            self._syncChange(sync, remote_change)
             end_time = time.time()
             total_time = end_time - start_time
             self.log.info("Synced change %s in %0.5f seconds.", self.change_id, total_time)
@@ -582,22 +1100,45 @@ class SyncChangeTask(Task):
                 self.log.exception("Error while marking change %s as outdated" % (self.change_id,))
             raise
 
-    def _syncChange(self, sync):
+    def _getComments(self, sync, remote_change):
+        # Attach the published comments for each revision to that
+        # revision's entry in the remote change.
+        remote_revisions = remote_change.get('revisions', {})
+        remote_comments_data = None
+        if sync.version >= (2, 10, 0):
+            # Fetch the comments for every revision in one request.
+            remote_comments_data = sync.get('changes/%s/comments' % (self.change_id,))
+        if remote_comments_data is None:
+            # Older servers can only list comments per revision.
+            for remote_commit, remote_revision in remote_revisions.items():
+                remote_comments_data = sync.get('changes/%s/revisions/%s/comments' % (self.change_id, remote_commit))
+                remote_revision['_gertty_remote_comments_data'] = remote_comments_data
+            return
+        # Split the comments up by patchset.
+        revisions_by_number = {}
+        for remote_revision in remote_revisions.values():
+            remote_revision['_gertty_remote_comments_data'] = {}
+            revisions_by_number[remote_revision['_number']] = remote_revision
+        for remote_file, remote_comments in remote_comments_data.items():
+            for remote_comment in remote_comments:
+                remote_revision = revisions_by_number.get(remote_comment.get('patch_set'))
+                if remote_revision is None:
+                    self.log.debug("Ignoring comment %s on unknown patchset %s of change %s" % (
+                        remote_comment['id'], remote_comment.get('patch_set'), self.change_id))
+                    continue
+                file_comments = remote_revision['_gertty_remote_comments_data'].setdefault(
+                    remote_file, [])
+                file_comments.append(remote_comment)
+
+    def _syncChange(self, sync, remote_change=None):
         app = sync.app
-        remote_change = sync.get('changes/%s?o=DETAILED_LABELS&o=ALL_REVISIONS&o=ALL_COMMITS&o=MESSAGES&o=DETAILED_ACCOUNTS&o=CURRENT_ACTIONS&o=ALL_FILES' % self.change_id)
+        if remote_change is None:
+            remote_change = sync.get('changes/%s?%s' % (self.change_id, CHANGE_DETAIL_OPTIONS))
         # Perform subqueries this task will need outside of the db session
-        for remote_commit, remote_revision in remote_change.get('revisions', {}).items():
-            remote_comments_data = sync.get('changes/%s/revisions/%s/comments' % (self.change_id, remote_commit))
-            remote_revision['_gertty_remote_comments_data'] = remote_comments_data
-        try:
-            remote_conflicts = sync.query(['q=status:open+is:mergeable+conflicts:%s' %
-                                           remote_change['_number']])
-        except Exception:
-            self.log.exception("Unable to sync conflicts for change %s" % self.change_id)
-            warnings.warn("Unable to sync conflicts for change %s" % self.change_id)
-            remote_conflicts = []
+        self._getComments(sync, remote_change)
 
         fetches = collections.defaultdict(list)
+        precompute = []
         parent_commits = set()
         with app.db.getSession() as session:
             change = session.getChangeByID(self.change_id)
@@ -643,30 +1184,20 @@ class SyncChangeTask(Task):
             change.subject = remote_change['subject']
             change.updated = dateutil.parser.parse(remote_change['updated'])
             change.topic = remote_change.get('topic')
-            unseen_conflicts = [x.id for x in change.conflicts]
-            for remote_conflict in remote_conflicts:
-                conflict_id = remote_conflict['id']
-                conflict = session.getChangeByID(conflict_id)
-                if not conflict:
-                    self.log.info("Need to sync conflicting change %s for change %s.",
-                                  conflict_id, change.number)
-                    sync.submitTask(SyncChangeTask(conflict_id, priority=self.priority))
-                else:
-                    if conflict not in change.conflicts:
-                        self.log.info("Added conflict %s for change %s in local DB.",
-                                      conflict.number, change.number)
-                        change.addConflict(conflict)
-                        self.results.append(ChangeUpdatedEvent(conflict))
-                if conflict_id in unseen_conflicts:
-                    unseen_conflicts.remove(conflict_id)
-            for conflict_id in unseen_conflicts:
-                conflict = session.getChangeByID(conflict_id)
-                self.log.info("Deleted conflict %s for change %s in local DB.",
-                              conflict.number, change.number)
-                change.delConflict(conflict)
-                self.results.append(ChangeUpdatedEvent(conflict))
-            repo = gitrepo.get_repo(change.project.name, app.config)
+            if change.status in CLOSED_STATUSES:
+                # Closed changes no longer conflict with anything.
+                # Conflicts between open changes are synced
+                # separately by SyncConflictsTask.
+                for conflict in change.conflicts:
+                    self.log.info("Deleted conflict %s for closed change %s in local DB.",
+                                  conflict.number, change.number)
+                    change.delConflict(conflict)
+                    event = ChangeUpdatedEvent(conflict)
+                    event.related_change_keys = set([conflict.key, change.key])
+                    self.results.append(event)
+            project_name = change.project.name
             new_revision = False
+            new_commits = set()
             for remote_commit, remote_revision in remote_change.get('revisions', {}).items():
                 revision = session.getRevisionByCommit(remote_commit)
                 # TODO: handle multiple parents
@@ -698,8 +1229,9 @@ class SyncChangeTask(Task):
                     else:
                         errMessage = "The server is missing the download-commands plugin."
                     raise Exception(errMessage)
-                if (not revision) or self.force_fetch:
-                    fetches[url].append('+%(ref)s:%(ref)s' % dict(ref=ref))
+                fetch = (not revision) or self.force_fetch or revision.pending_fetch
+                if fetch:
+                    fetches[url].append(('+%(ref)s:%(ref)s' % dict(ref=ref), remote_commit))
                 if not revision:
                     revision = change.createRevision(remote_revision['_number'],
                                                      remote_revision['commit']['message'], remote_commit,
@@ -708,6 +1240,10 @@ class SyncChangeTask(Task):
                     self.log.info("Created new revision %s for change %s revision %s in local DB.",
                                   revision.key, self.change_id, remote_revision['_number'])
                     new_revision = True
+                    new_commits.add(remote_commit)
+                if fetch:
+                    # Cleared by the fetcher once the objects are present.
+                    revision.pending_fetch = True
                 revision.message = remote_revision['commit']['message']
                 actions = remote_revision.get('actions', {})
                 revision.can_submit = 'submit' in actions
@@ -914,17 +1450,315 @@ class SyncChangeTask(Task):
                         result.review_flag_changed = True
                         app.project_cache.clear(change.project)
             change.outdated = False
+            if (sync.precomputer and new_commits and not change.reviewed and
+                change.status not in CLOSED_STATUSES and
+                change.project.subscribed):
+                # Diff each new revision against its base and the
+                # previous patchset, as the diff view would.
+                previous = None
+                for revision in change.revisions:
+                    if revision.commit in new_commits:
+                        precompute.append((revision.parent, revision.commit, False))
+                        if previous:
+                            precompute.append((previous.commit, revision.commit, True))
+                    previous = revision
         for url, refs in fetches.items():
-            self.log.debug("Fetching from %s with refs %s", url, refs)
+            sync.fetcher.add(project_name, url, refs, self.change_id, self.priority)
+        if precompute:
+            sync.precomputer.add(project_name, precompute)
+
+class FetchCoalescer(object):
+    # Sync tasks hand the refs they need fetched to this object, which
+    # fetches them on its own pool of threads so that slow git
+    # transfers do not hold up syncing with the REST API.  All of the
+    # refs pending for a repository are fetched with a single git
+    # fetch rather than one per change, and only one fetch per
+    # repository runs at a time.  Refs are fetched no more than DELAY
+    # seconds after they are added (sooner if MAX_REFS accumulate for
+    # a repository, or if they were added by a high priority task), or
+    # as soon as flush() is called for their commits because someone
+    # needs them now.  Repositories with higher priority refs are
+    # fetched first.
+    #
+    # Revisions are marked pending_fetch until their objects arrive.
+    DELAY = 5
+    MAX_REFS = 1000
+
+    missing_ref_re = re.compile(r"couldn't find remote ref ([^\s']+)")
+
+    def __init__(self, app):
+        self.app = app
+        self.log = logging.getLogger('gertty.sync')
+        self.condition = threading.Condition()
+        # project name -> url -> refspec -> set of (change id, commit)
+        self.pending = {}
+        self.deadlines = {}
+        self.priorities = {}
+        self.counts = {}
+        # project name -> list of batches being fetched
+        self.fetching = {}
+        self.threads = []
+
+    def start(self, workers):
+        for i in range(workers):
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def add(self, project_name, url, refs, change_id, priority=NORMAL_PRIORITY):
+        # refs is a list of (refspec, commit) tuples.
+        with self.condition:
+            urls = self.pending.setdefault(project_name, {})
+            pending_refs = urls.setdefault(url, {})
+            for ref, commit in refs:
+                if ref not in pending_refs:
+                    pending_refs[ref] = set()
+                    self.counts[project_name] = self.counts.get(project_name, 0) + 1
+                pending_refs[ref].add((change_id, commit))
+            deadline = time.time()
+            if priority != HIGH_PRIORITY:
+                deadline += self.DELAY
+            self.deadlines[project_name] = min(
+                deadline, self.deadlines.get(project_name, deadline))
+            self.priorities[project_name] = min(
+                priority, self.priorities.get(project_name, priority))
+            self.condition.notify_all()
+
+    def qsize(self):
+        with self.condition:
+            return sum(self.counts.values())
+
+    def _forget(self, project_name):
+        self.deadlines.pop(project_name, None)
+        self.priorities.pop(project_name, None)
+        self.counts.pop(project_name, None)
+        return self.pending.pop(project_name, {})
+
+    def _take(self, project_name):
+        batch = self._forget(project_name)
+        self.fetching.setdefault(project_name, []).append(batch)
+        return batch
+
+    def _takeCommits(self, project_name, commits):
+        # Take only the pending refs of the given commits.
+        batch = {}
+        urls = self.pending.get(project_name, {})
+        for url, refs in list(urls.items()):
+            for ref, revisions in list(refs.items()):
+                if [x for x in revisions if x[1] in commits]:
+                    batch.setdefault(url, {})[ref] = refs.pop(ref)
+                    self.counts[project_name] -= 1
+            if not refs:
+                del urls[url]
+        if not urls:
+            self._forget(project_name)
+        if batch:
+            self.fetching.setdefault(project_name, []).append(batch)
+        return batch
+
+    def _inFlight(self, project_name, commits):
+        for batch in self.fetching.get(project_name, []):
+            for refs in batch.values():
+                for revisions in refs.values():
+                    if [x for x in revisions if x[1] in commits]:
+                        return True
+        return False
+
+    def flush(self, project_name, commits):
+        # Fetch any refs pending for the given commits of the project
+        # now, and wait for any fetch of them already under way to
+        # finish.
+        with self.condition:
+            while self._inFlight(project_name, commits):
+                self.condition.wait()
+            batch = self._takeCommits(project_name, commits)
+            if not batch:
+                return
+        self._fetch(project_name, batch)
+
+    def fetchMissing(self, project_name, repo, shas):
+        # Make sure the given commits are present in the repository,
+        # fetching them first if their refs are waiting to be fetched.
+        # Returns the commits which are still missing.
+        missing = repo.checkCommits(shas)
+        if missing:
+            self.flush(project_name, missing)
+            missing = repo.checkCommits(shas)
+        return missing
+
+    def run(self):
+        while True:
+            try:
+                project_name, batch = self._next()
+                self._fetch(project_name, batch)
+            except Exception:
+                self.log.exception('Exception in FetchCoalescer')
+
+    def _next(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                timeout = None
+                due = []
+                for project_name, deadline in self.deadlines.items():
+                    if project_name in self.fetching:
+                        continue
+                    if (deadline <= now or
+                        self.counts.get(project_name, 0) >= self.MAX_REFS):
+                        due.append((self.priorities[project_name], deadline,
+                                    project_name))
+                    elif timeout is None or deadline - now < timeout:
+                        timeout = deadline - now
+                if due:
+                    project_name = min(due)[2]
+                    return (project_name, self._take(project_name))
+                self.condition.wait(timeout)
+
+    def _fetch(self, project_name, batch):
+        try:
+            failed = set()
+            fetched = set()
+            try:
+                repo = gitrepo.get_repo(project_name, self.app.config)
+            except Exception:
+                self.log.exception("Unable to open repository for %s" % (project_name,))
+                for refs in batch.values():
+                    for revisions in refs.values():
+                        failed |= revisions
+                repo = None
+            if repo:
+                for url, refs in batch.items():
+                    self.log.debug("Fetching %s refs for %s", len(refs), project_name)
+                    failed_refs = self._fetchRefs(repo, url, list(refs.keys()))
+                    for ref, revisions in refs.items():
+                        if ref in failed_refs:
+                            failed |= revisions
+                        else:
+                            fetched |= revisions
+            with self.app.db.getSession() as session:
+                for change_id, commit in fetched:
+                    revision = session.getRevisionByCommit(commit)
+                    if revision:
+                        revision.pending_fetch = False
+                # Try again when outdated changes are next synced.
+                for change_id in set([x[0] for x in failed]):
+                    change = session.getChangeByID(change_id)
+                    if change:
+                        change.outdated = True
+        finally:
+            with self.condition:
+                batches = self.fetching.get(project_name, [])
+                for i, b in enumerate(batches):
+                    if b is batch:
+                        del batches[i]
+                        break
+                if not batches:
+                    self.fetching.pop(project_name, None)
+                self.condition.notify_all()
+
+    def _fetchRefs(self, repo, url, refs):
+        # Returns the set of refs which could not be fetched.  git
+        # fetches nothing if the remote lacks one of the refs, and
+        # names the first such ref; that ref is dropped and the rest
+        # are fetched again.  Any other error fails all of them.
+        failed = set()
+        while refs:
             try:
                 repo.fetch(url, refs)
+                break
+            except Exception as e:
+                m = self.missing_ref_re.search(str(e))
+                bad = None
+                if m:
+                    for ref in refs:
+                        if ref.lstrip('+').split(':')[0] == m.group(1):
+                            bad = ref
+                            break
+                if bad is None:
+                    self.log.exception("Error fetching refs from %s" % (url,))
+                    failed |= set(refs)
+                    break
+                self.log.warning("Unable to fetch %s from %s" % (bad, url))
+                failed.add(bad)
+                refs = [ref for ref in refs if ref is not bad]
+        return failed
+
+class DiffPrecomputer(object):
+    # Diffs for newly synced revisions are computed and stored in the
+    # diff cache on a single background thread so that they are ready
+    # when the user opens them.  Each diff is attempted once the
+    # fetcher has had a chance to fetch its commits, and the thread
+    # sleeps after each one so that it uses no more than cpu_share
+    # percent of a CPU.  Only the most recent MAX_PENDING diffs are
+    # kept; the diff cache's own size limit bounds the results.
+    RETRY_DELAY = 10
+    MAX_ATTEMPTS = 3
+    MAX_PENDING = 1000
+
+    def __init__(self, app, cpu_share):
+        self.app = app
+        self.log = logging.getLogger('gertty.sync')
+        self.cpu_share = min(100, cpu_share)
+        self.condition = threading.Condition()
+        # (due time, attempts, project name, (old, new, show old commit))
+        self.pending = collections.deque()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, project_name, diffs, attempts=0):
+        with self.condition:
+            due = time.time() + self.RETRY_DELAY
+            for diff in diffs:
+                self.pending.append((due, attempts, project_name, diff))
+            while len(self.pending) > self.MAX_PENDING:
+                self.pending.popleft()
+            self.condition.notify_all()
+
+    def qsize(self):
+        with self.condition:
+            return len(self.pending)
+
+    def run(self):
+        while True:
+            try:
+                (due, attempts, project_name, diff) = self._next()
+                elapsed = self._compute(attempts, project_name, diff)
+                if elapsed:
+                    time.sleep(elapsed * (100 - self.cpu_share) / self.cpu_share)
             except Exception:
-                # Backwards compat with GitPython before the multi-ref fetch
-                # patch.
-                # (https://github.com/gitpython-developers/GitPython/pull/170)
-                for ref in refs:
-                    self.log.debug("git fetch %s %s" % (url, ref))
-                    repo.fetch(url, ref)
+                self.log.exception('Exception in DiffPrecomputer')
+
+    def _next(self):
+        with self.condition:
+            while True:
+                timeout = None
+                if self.pending:
+                    timeout = self.pending[0][0] - time.time()
+                    if timeout <= 0:
+                        return self.pending.popleft()
+                self.condition.wait(timeout)
+
+    def _compute(self, attempts, project_name, diff):
+        old, new, show_old_commit = diff
+        repo = gitrepo.get_repo(project_name, self.app.config)
+        if diffcache.is_cached(repo, self.app.config, old, new,
+                               show_old_commit=show_old_commit):
+            return None
+        if repo.checkCommits([old, new]):
+            # Not fetched yet (or the fetch failed); try again later.
+            if attempts + 1 < self.MAX_ATTEMPTS:
+                self.add(project_name, [diff], attempts + 1)
+            return None
+        start = time.time()
+        diffcache.diff(repo, self.app.config, old, new,
+                       show_old_commit=show_old_commit)
+        self.log.debug("Precomputed diff %s..%s for %s", old, new, project_name)
+        return time.time() - start
 
 class CheckReposTask(Task):
     # on startup, check all projects
@@ -934,31 +1768,52 @@ class CheckReposTask(Task):
     def __repr__(self):
         return '<CheckReposTask>'
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__):
-            return True
-        return False
+    def identity(self):
+        return None
 
     def run(self, sync):
         app = sync.app
         with app.db.getSession() as session:
             projects = session.getProjects(subscribed=True)
-        for project in projects:
+            keys = [project.key for project in projects]
+        # Each project is checked by its own task so that the sync
+        # workers can clone and check several repositories at once.
+        for key in keys:
+            sync.submitTask(CheckRepoTask(key, LOW_PRIORITY))
+
+class CheckRepoTask(Task):
+    def __init__(self, project_key, priority=NORMAL_PRIORITY):
+        super(CheckRepoTask, self).__init__(priority)
+        self.project_key = project_key
+
+    def __repr__(self):
+        return '<CheckRepoTask %s>' % (self.project_key,)
+
+    def identity(self):
+        return self.project_key
+
+    def run(self, sync):
+        app = sync.app
+        with app.db.getSession() as session:
+            project = session.getProject(self.project_key)
+            if not project:
+                return
+            project_name = project.name
+        try:
+            missing = False
             try:
-                missing = False
-                try:
-                    repo = gitrepo.get_repo(project.name, app.config)
-                except gitrepo.GitCloneError:
-                    missing = True
-                if missing or app.fetch_missing_refs:
-                    sync.submitTask(
-                        CheckRevisionsTask(project.key,
-                                           force_fetch=app.fetch_missing_refs,
-                                           priority=LOW_PRIORITY)
-                    )
-            except Exception:
-                self.log.exception("Exception checking repo %s" %
-                                   (project.name,))
+                gitrepo.get_repo(project_name, app.config)
+            except gitrepo.GitCloneError:
+                missing = True
+            if missing or app.fetch_missing_refs:
+                sync.submitTask(
+                    CheckRevisionsTask(self.project_key,
+                                       force_fetch=app.fetch_missing_refs,
+                                       priority=LOW_PRIORITY)
+                )
+        except Exception:
+            self.log.exception("Exception checking repo %s" %
+                               (project_name,))
 
 class CheckRevisionsTask(Task):
     def __init__(self, project_key, force_fetch=False,
@@ -970,42 +1825,45 @@ class CheckRevisionsTask(Task):
     def __repr__(self):
         return '<CheckRevisionsTask %s>' % (self.project_key,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.project_key == self.project_key):
-            return True
-        return False
+    def identity(self):
+        return self.project_key
 
     def run(self, sync):
         app = sync.app
-        to_sync = set()
         with app.db.getSession() as session:
             project = session.getProject(self.project_key)
-            repo = None
-            try:
-                repo = gitrepo.get_repo(project.name, app.config)
-            except gitrepo.GitCloneError:
-                pass
-            for change in project.open_changes:
-                if repo:
-                    for revision in change.revisions:
-                        if repo.checkCommits([revision.parent, revision.commit]):
-                            to_sync.add(change.id)
-                else:
-                    to_sync.add(change.id)
-        for change_id in to_sync:
-            sync.submitTask(SyncChangeTask(change_id,
-                                           force_fetch=self.force_fetch,
-                                           priority=self.priority))
+            if not project:
+                return
+            project_name = project.name
+            revisions = session.getOpenRevisionCommits(self.project_key)
+        # Check the repository only after the database session is
+        # closed; this may take a while for a large project.
+        repo = None
+        try:
+            repo = gitrepo.get_repo(project_name, app.config)
+        except gitrepo.GitCloneError:
+            pass
+        if repo:
+            shas = set()
+            for (number, parent, commit) in revisions:
+                if parent:
+                    shas.add(parent)
+                if commit:
+                    shas.add(commit)
+            invalid = repo.checkCommits(shas)
+            to_sync = set([number for (number, parent, commit) in revisions
+                           if commit and (parent in invalid or commit in invalid)])
+        else:
+            to_sync = set([number for (number, parent, commit) in revisions])
+        sync._syncChangesByNumber(sorted(to_sync), self.priority,
+                                  force_fetch=self.force_fetch)
 
 class UploadReviewsTask(Task):
     def __repr__(self):
         return '<UploadReviewsTask>'
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__):
-            return True
-        return False
+    def identity(self):
+        return None
 
     def run(self, sync):
         app = sync.app
@@ -1033,11 +1891,8 @@ class SetTopicTask(Task):
     def __repr__(self):
         return '<SetTopicTask %s>' % (self.change_key,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.change_key == self.change_key):
-            return True
-        return False
+    def identity(self):
+        return self.change_key
 
     def run(self, sync):
         app = sync.app
@@ -1058,11 +1913,8 @@ class RebaseChangeTask(Task):
     def __repr__(self):
         return '<RebaseChangeTask %s>' % (self.change_key,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.change_key == self.change_key):
-            return True
-        return False
+    def identity(self):
+        return self.change_key
 
     def run(self, sync):
         app = sync.app
@@ -1081,11 +1933,8 @@ class ChangeStarredTask(Task):
     def __repr__(self):
         return '<ChangeStarredTask %s>' % (self.change_key,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.change_key == self.change_key):
-            return True
-        return False
+    def identity(self):
+        return self.change_key
 
     def run(self, sync):
         app = sync.app
@@ -1108,11 +1957,8 @@ class ChangeStatusTask(Task):
     def __repr__(self):
         return '<ChangeStatusTask %s>' % (self.change_key,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.change_key == self.change_key):
-            return True
-        return False
+    def identity(self):
+        return self.change_key
 
     def run(self, sync):
         app = sync.app
@@ -1143,11 +1989,8 @@ class SendCherryPickTask(Task):
     def __repr__(self):
         return '<SendCherryPickTask %s>' % (self.cp_key,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.cp_key == self.cp_key):
-            return True
-        return False
+    def identity(self):
+        return self.cp_key
 
     def run(self, sync):
         app = sync.app
@@ -1171,11 +2014,8 @@ class ChangeCommitMessageTask(Task):
     def __repr__(self):
         return '<ChangeCommitMessageTask %s>' % (self.revision_key,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.revision_key == self.revision_key):
-            return True
-        return False
+    def identity(self):
+        return self.revision_key
 
     def run(self, sync):
         app = sync.app
@@ -1206,11 +2046,8 @@ class UploadReviewTask(Task):
     def __repr__(self):
         return '<UploadReviewTask %s>' % (self.message_key,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.message_key == self.message_key):
-            return True
-        return False
+    def identity(self):
+        return self.message_key
 
     def run(self, sync):
         app = sync.app
@@ -1284,11 +2121,8 @@ class PruneDatabaseTask(Task):
     def __repr__(self):
         return '<PruneDatabaseTask %s>' % (self.age,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.age == self.age):
-            return True
-        return False
+    def identity(self):
+        return self.age
 
     def run(self, sync):
         if not self.age:
@@ -1311,11 +2145,8 @@ class PruneChangeTask(Task):
     def __repr__(self):
         return '<PruneChangeTask %s>' % (self.key,)
 
-    def __eq__(self, other):
-        if (other.__class__ == self.__class__ and
-            other.key == self.key):
-            return True
-        return False
+    def identity(self):
+        return self.key
 
     def run(self, sync):
         app = sync.app
@@ -1349,10 +2180,8 @@ class VacuumDatabaseTask(Task):
     def __repr__(self):
         return '<VacuumDatabaseTask>'
 
-    def __eq__(self, other):
-        if other.__class__ == self.__class__:
-            return True
-        return False
+    def identity(self):
+        return None
 
     def run(self, sync):
         app = sync.app
@@ -1365,11 +2194,29 @@ class Sync(object):
                                             requests.utils.default_user_agent())
         self.version = (0, 0, 0)
         self.offline = False
+        # While offline, workers wait until retry_time, then one of
+        # them checks whether the server is reachable (probing) before
+        # the rest continue.
+        self.offline_condition = threading.Condition()
+        self.backoff = OfflineBackoff()
+        self.retry_time = 0
+        self.probing = False
         self.account_id = None
         self.app = app
         self.log = logging.getLogger('gertty.sync')
-        self.queue = MultiQueue([HIGH_PRIORITY, NORMAL_PRIORITY, LOW_PRIORITY])
+        self.queue = MultiQueue([HIGH_PRIORITY, NORMAL_PRIORITY, LOW_PRIORITY],
+                                weights={NORMAL_PRIORITY: app.config.sync_weights['normal'],
+                                         LOW_PRIORITY: app.config.sync_weights['low']})
         self.result_queue = queue.Queue()
+        self.metrics = SyncMetrics()
+        self.journal = TaskJournal(app)
+        self.fetcher = FetchCoalescer(app)
+        self.fetcher.start(app.config.fetch_workers)
+        self.poll_schedule = ProjectPollSchedule(60, app.config.max_poll_interval)
+        self.precomputer = None
+        if app.config.precompute_diffs and diffcache.get_cache(app.config):
+            self.precomputer = DiffPrecomputer(app, app.config.precompute_diffs)
+            self.precomputer.start()
         self.session = requests.Session()
         if self.app.config.auth_type == 'basic':
             authclass = requests.auth.HTTPBasicAuth
@@ -1382,6 +2229,14 @@ class Sync(object):
         self.submitTask(GetVersionTask(HIGH_PRIORITY))
         self.submitTask(SyncOwnAccountTask(HIGH_PRIORITY))
         if not disable_background_sync:
+            # Resume work left over from the last run before starting
+            # the usual discovery, which will skip whatever is then
+            # already queued.
+            for task in self.journal.replay():
+                self.submitTask(task)
+            self.journal_thread = threading.Thread(target=self.flushJournal)
+            self.journal_thread.daemon = True
+            self.journal_thread.start()
             self.submitTask(CheckReposTask(HIGH_PRIORITY))
             self.submitTask(UploadReviewsTask(HIGH_PRIORITY))
             self.submitTask(SyncProjectListTask(HIGH_PRIORITY))
@@ -1393,8 +2248,17 @@ class Sync(object):
             self.periodic_thread.daemon = True
             self.periodic_thread.start()
 
+    def flushJournal(self):
+        while True:
+            try:
+                time.sleep(10)
+                self.journal.flush()
+            except Exception:
+                self.log.exception('Exception in flushJournal')
+
     def periodicSync(self):
         hourly = time.time()
+        conflicts = time.time()
         while True:
             try:
                 time.sleep(60)
@@ -1402,19 +2266,40 @@ class Sync(object):
                 now = time.time()
                 if now-hourly > 3600:
                     hourly = now
+                    self.logQueueStats()
                     self.pruneDatabase()
                     self.syncOutdatedChanges()
+                interval = self.app.config.conflict_sync_interval
+                if interval and now-conflicts > interval:
+                    conflicts = now
+                    self.submitTask(SyncSubscribedProjectConflictsTask(LOW_PRIORITY))
             except Exception:
                 self.log.exception('Exception in periodicSync')
 
+    def logQueueStats(self):
+        names = {HIGH_PRIORITY: 'high', NORMAL_PRIORITY: 'normal',
+                 LOW_PRIORITY: 'low'}
+        for priority, stats in sorted(self.queue.getWaitStats().items()):
+            self.log.info("Sync queue %s priority: %s started, mean wait %0.1fs, "
+                          "max wait %0.1fs, %s waiting, oldest %0.1fs",
+                          names[priority], stats['started'], stats['mean_wait'],
+                          stats['max_wait'], stats['waiting'], stats['oldest_wait'])
+
     def submitTask(self, task):
         if not self.offline:
             if not self.queue.put(task, task.priority):
                 task.complete(False)
+            else:
+                self.journal.add(task)
         else:
             task.complete(False)
 
     def run(self, pipe):
+        # This is the main loop of a sync worker.  Several of these
+        # may run at once (see the sync-workers option); the queue
+        # keeps them from running higher and lower priority work at
+        # the same time, and the database lock serializes their
+        # database sessions.
         task = None
         while True:
             task = self._run(pipe, task)
@@ -1422,53 +2307,133 @@ class Sync(object):
     def _run(self, pipe, task=None):
         if not task:
             task = self.queue.get()
+        self._waitOnline(pipe)
         self.log.debug('Run: %s' % (task,))
+        start = time.time()
+        db_start = self.app.db.getLockTime()
         try:
             task.run(self)
             task.complete(True)
             self.queue.complete(task)
-        except (requests.ConnectionError, OfflineError,
-                requests.exceptions.ChunkedEncodingError,
-                requests.exceptions.ReadTimeout
-        ) as e:
+            self.journal.remove(task)
+            self._recordTask(task, start, db_start)
+        except OFFLINE_EXCEPTIONS as e:
             self.log.warning("Offline due to: %s" % (e,))
-            if not self.offline:
-                self.submitTask(GetVersionTask(HIGH_PRIORITY))
-                self.submitTask(UploadReviewsTask(HIGH_PRIORITY))
-            self.offline = True
-            self.app.status.update(offline=True, refresh=False)
-            os.write(pipe, six.b('refresh\n'))
-            time.sleep(30)
+            self._setOffline(pipe, getattr(e, 'retry_after', None))
             return task
         except Exception:
             task.complete(False)
             self.queue.complete(task)
+            self.journal.remove(task)
+            self._recordTask(task, start, db_start)
             self.log.exception('Exception running task %s' % (task,))
             self.app.status.update(error=True, refresh=False)
-        self.offline = False
-        self.app.status.update(offline=False, refresh=False)
+        self.app.status.update(refresh=False)
         for r in task.results:
             self.result_queue.put(r)
         os.write(pipe, six.b('refresh\n'))
         return None
 
+    def _recordTask(self, task, start, db_start):
+        self.metrics.recordTask(task.__class__.__name__, time.time() - start,
+                                task.wait_time,
+                                self.app.db.getLockTime() - db_start,
+                                task.succeeded)
+
+    def _recordRequest(self, method, start, response):
+        self.metrics.recordRequest(method, time.time() - start,
+                                   len(response.content), response.status_code)
+
+    def getStats(self):
+        # The sync metrics along with the state of the queue.
+        names = {HIGH_PRIORITY: 'high', NORMAL_PRIORITY: 'normal',
+                 LOW_PRIORITY: 'low'}
+        stats = self.metrics.getStats()
+        stats['queue'] = dict([(names[p], v) for (p, v) in
+                               self.queue.getWaitStats().items()])
+        stats['offline'] = self.offline
+        stats['pending_fetches'] = self.fetcher.qsize()
+        return stats
+
+    def _setOffline(self, pipe, retry_after=None):
+        with self.offline_condition:
+            if self.offline and (self.probing or time.time() < self.retry_time):
+                # Another worker has already scheduled the next check.
+                return
+            if not self.offline:
+                # Reviews left while offline are uploaded once the
+                # server is reachable.
+                self.submitTask(UploadReviewsTask(HIGH_PRIORITY))
+                self.offline = True
+            delay = self.backoff.failed(retry_after)
+            self.retry_time = time.time() + delay
+            self.log.warning("Sync offline; next check in %0.1f seconds" % (delay,))
+        self.app.status.update(offline=True, refresh=False)
+        os.write(pipe, six.b('refresh\n'))
+
+    def _waitOnline(self, pipe):
+        # Block while the server is unreachable.  Once the retry time
+        # arrives, a single worker sends a cheap request to see if the
+        # server is back; the others continue only if it succeeds.
+        while True:
+            with self.offline_condition:
+                if not self.offline:
+                    return
+                now = time.time()
+                if self.probing or now < self.retry_time:
+                    if self.probing:
+                        self.offline_condition.wait()
+                    else:
+                        self.offline_condition.wait(self.retry_time - now)
+                    continue
+                self.probing = True
+            self.app.status.update(refresh=False)
+            os.write(pipe, six.b('refresh\n'))
+            retry_after = None
+            try:
+                GetVersionTask(HIGH_PRIORITY).run(self)
+                online = True
+            except OFFLINE_EXCEPTIONS as e:
+                self.log.warning("Still offline due to: %s" % (e,))
+                retry_after = getattr(e, 'retry_after', None)
+                online = False
+            except Exception:
+                self.log.exception("Error checking whether the server is reachable")
+                online = False
+            with self.offline_condition:
+                self.probing = False
+                if online:
+                    self.log.info("Sync online")
+                    self.offline = False
+                    self.backoff.succeeded()
+                else:
+                    delay = self.backoff.failed(retry_after)
+                    self.retry_time = time.time() + delay
+                    self.log.warning("Sync offline; next check in %0.1f seconds" % (delay,))
+                self.offline_condition.notify_all()
+            self.app.status.update(offline=self.offline, refresh=False)
+            os.write(pipe, six.b('refresh\n'))
+
     def url(self, path):
         return self.app.config.url + 'a/' + path
 
     def checkResponse(self, response):
         self.log.debug('HTTP status code: %d', response.status_code)
-        if response.status_code == 503:
-            raise OfflineError("Received 503 status code")
+        if response.status_code in (429, 503):
+            raise OfflineError("Received %s status code" % (response.status_code,),
+                               parse_retry_after(response.headers.get('Retry-After')))
 
     def get(self, path):
         url = self.url(path)
         self.log.debug('GET: %s' % (url,))
+        start = time.time()
         r = self.session.get(url,
                              verify=self.app.config.verify_ssl,
                              auth=self.auth, timeout=TIMEOUT,
                              headers = {'Accept': 'application/json',
                                         'Accept-Encoding': 'gzip',
                                         'User-Agent': self.user_agent})
+        self._recordRequest('GET', start, r)
         self.checkResponse(r)
         if r.status_code == 200:
             ret = json.loads(r.text[4:])
@@ -1482,11 +2447,13 @@ class Sync(object):
         url = self.url(path)
         self.log.debug('POST: %s' % (url,))
         self.log.debug('data: %s' % (data,))
+        start = time.time()
         r = self.session.post(url, data=json.dumps(data).encode('utf8'),
                               verify=self.app.config.verify_ssl,
                               auth=self.auth, timeout=TIMEOUT,
                               headers = {'Content-Type': 'application/json;charset=UTF-8',
                                          'User-Agent': self.user_agent})
+        self._recordRequest('POST', start, r)
         self.checkResponse(r)
         self.log.debug('Received: %s' % (r.text,))
         ret = None
@@ -1503,11 +2470,13 @@ class Sync(object):
         url = self.url(path)
         self.log.debug('PUT: %s' % (url,))
         self.log.debug('data: %s' % (data,))
+        start = time.time()
         r = self.session.put(url, data=json.dumps(data).encode('utf8'),
                              verify=self.app.config.verify_ssl,
                              auth=self.auth, timeout=TIMEOUT,
                              headers = {'Content-Type': 'application/json;charset=UTF-8',
                                         'User-Agent': self.user_agent})
+        self._recordRequest('PUT', start, r)
         self.checkResponse(r)
         self.log.debug('Received: %s' % (r.text,))
 
@@ -1515,11 +2484,13 @@ class Sync(object):
         url = self.url(path)
         self.log.debug('DELETE: %s' % (url,))
         self.log.debug('data: %s' % (data,))
+        start = time.time()
         r = self.session.delete(url, data=json.dumps(data).encode('utf8'),
                                 verify=self.app.config.verify_ssl,
                                 auth=self.auth, timeout=TIMEOUT,
                                 headers = {'Content-Type': 'application/json;charset=UTF-8',
                                            'User-Agent': self.user_agent})
+        self._recordRequest('DELETE', start, r)
         self.checkResponse(r)
         self.log.debug('Received: %s' % (r.text,))
 
@@ -1546,15 +2517,69 @@ class Sync(object):
 
     def _syncChangeByCommit(self, commit, priority):
         # Accumulate sync change by commit tasks because they often
-        # come in batches.  This method assumes it is being called
-        # from within the run queue already and therefore does not
-        # need to worry about locking the queue.
+        # come in batches.  Hold the queue lock while doing so, since
+        # another worker may otherwise start running the task we are
+        # about to add a commit to.
         task = None
-        for task in self.queue.find(SyncChangesByCommitsTask, priority):
-            if task.addCommit(commit):
-                return
-        task = SyncChangesByCommitsTask([commit], priority)
-        self.submitTask(task)
+        self.queue.condition.acquire()
+        try:
+            for task in self.queue.find(SyncChangesByCommitsTask, priority):
+                if task.addCommit(commit):
+                    return
+            task = SyncChangesByCommitsTask([commit], priority)
+            self.submitTask(task)
+        finally:
+            self.queue.condition.release()
+
+    def _syncListedChanges(self, changes, priority, force=False):
+        # Sync the changes from a query listing.  For now, just sync
+        # open changes or changes already in the db; optionally we
+        # could sync all changes ever.  The listing includes each
+        # change's updated time, so unless forced, skip changes which
+        # are already up to date in the local db: their updated time
+        # matches and their current revision is present and fetched.
+        with self.app.db.getSession() as session:
+            local = session.getChangesUpdated([c['id'] for c in changes])
+            commits = session.getFetchedRevisionCommits(
+                [c['current_revision'] for c in changes if 'current_revision' in c])
+        numbers = []
+        skipped = 0
+        for c in changes:
+            if c['id'] in local:
+                updated, outdated = local[c['id']]
+                current_revision = c.get('current_revision')
+                if (not force and not outdated and
+                    updated == dateutil.parser.parse(c['updated']) and
+                    (current_revision is None or current_revision in commits)):
+                    skipped += 1
+                    continue
+            elif c['status'] in CLOSED_STATUSES:
+                continue
+            numbers.append(c['_number'])
+        if skipped:
+            self.log.debug("Skipped %s changes which are already up to date" % (skipped,))
+        self._syncChangesByNumber(numbers, priority)
+
+    def _syncChangesByNumber(self, numbers, priority, force_fetch=False):
+        # Accumulate changes to sync into batches so that their
+        # details may be fetched with a few queries rather than one
+        # request per change.  As with _syncChangeByCommit, hold the
+        # queue lock so that no worker starts a batch while we are
+        # still adding to it.
+        self.queue.condition.acquire()
+        try:
+            tasks = [t for t in self.queue.find(SyncChangesByNumbersTask, priority)
+                     if t.force_fetch == force_fetch]
+            for number in numbers:
+                for task in tasks:
+                    if task.addNumber(number):
+                        break
+                else:
+                    task = SyncChangesByNumbersTask([number], force_fetch, priority)
+                    tasks.append(task)
+                    self.submitTask(task)
+        finally:
+            self.queue.condition.release()
 
     def setRemoteVersion(self, version):
         base = version.split('-')[0]
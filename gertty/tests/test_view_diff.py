@@ -0,0 +1,59 @@
+# Copyright 2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+import urwid
+
+from gertty.view.diff import DiffListWalker, LazyDiffLine
+
+
+class TestDiffListWalker(unittest.TestCase):
+    def makeWalker(self, count):
+        lines = [LazyDiffLine(['line %d' % i], urwid.Text, 'line %d' % i)
+                 for i in range(count)]
+        return DiffListWalker(lines)
+
+    def test_index_of_built_widget(self):
+        walker = self.makeWalker(10)
+        self.assertEqual(walker.index(walker[3]), 3)
+
+    def test_index_of_evicted_widget(self):
+        # The list box may still hold a widget, such as the focus
+        # widget, after the walker has evicted it.
+        walker = self.makeWalker(DiffListWalker.MAX_WIDGETS + 10)
+        held = walker[0]
+        for i in range(1, len(walker)):
+            walker[i]
+        self.assertNotIn(walker.items[0], walker.widgets)
+        self.assertEqual(walker.index(held), 0)
+        walker.insert(0, urwid.Text('header'))
+        self.assertEqual(walker.index(held), 1)
+
+    def test_index_of_rebuilt_widget(self):
+        walker = self.makeWalker(DiffListWalker.MAX_WIDGETS + 10)
+        held = walker[0]
+        for i in range(1, len(walker)):
+            walker[i]
+        rebuilt = walker[0]
+        self.assertIsNot(rebuilt, held)
+        self.assertEqual(walker.index(held), 0)
+        self.assertEqual(walker.index(rebuilt), 0)
+
+    def test_index_of_removed_widget(self):
+        walker = self.makeWalker(10)
+        held = walker[3]
+        walker.remove(held)
+        self.assertEqual(len(walker), 9)
+        self.assertRaises(ValueError, walker.index, held)
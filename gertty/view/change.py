@@ -584,9 +584,21 @@ class ChangeView(urwid.WidgetWrap):
 
         self.checkGitRepo()
         self.refresh()
+        self.syncConflicts()
         self.listbox.set_focus(0)
         self.grid.set_focus(1)
 
+    def syncConflicts(self):
+        # Conflicts are not updated every time a change is synced, so
+        # ask for them now that someone is looking.
+        with self.app.db.getSession() as session:
+            change = session.getChange(self.change_key)
+            if change.status in sync.CLOSED_STATUSES:
+                return
+            change_number = change.number
+        self.app.sync.submitTask(
+            sync.SyncConflictsTask([change_number], priority=sync.HIGH_PRIORITY))
+
     def checkGitRepo(self):
         missing_revisions = set()
         change_number = None
@@ -601,7 +613,9 @@ class ChangeView(urwid.WidgetWrap):
                 shas.add(revision.parent)
                 shas.add(revision.commit)
         repo = gitrepo.get_repo(change_project_name, self.app.config)
-        missing_revisions = repo.checkCommits(shas)
+        # Fetch any of the commits whose refs are waiting to be fetched.
+        fetcher = self.app.sync.fetcher
+        missing_revisions = fetcher.fetchMissing(change_project_name, repo, shas)
         if missing_revisions:
             if self.app.sync.offline:
                 raise gertty.view.DisplayError("Git commits not present in local repository")
@@ -611,6 +625,10 @@ class ChangeView(urwid.WidgetWrap):
                                        priority=sync.HIGH_PRIORITY)
             self.app.sync.submitTask(task)
             succeeded = task.wait(300)
+            # The task only queues the refs with the fetcher.
+            if succeeded:
+                succeeded = not fetcher.fetchMissing(change_project_name,
+                                                     repo, shas)
             if not succeeded:
                 raise gertty.view.DisplayError("Git commits not present in local repository")
 
@@ -974,6 +992,7 @@ class ChangeView(urwid.WidgetWrap):
         if keymap.REFRESH in commands:
             self.app.sync.submitTask(
                 sync.SyncChangeTask(self.change_rest_id, priority=sync.HIGH_PRIORITY))
+            self.syncConflicts()
             self.app.status.update()
             return None
         if keymap.SUBMIT_CHANGE in commands:
@@ -422,6 +422,8 @@ class ChangeListView(urwid.WidgetWrap, mywid.Searchable):
         self.header = ChangeListHeader(self.enabled_columns)
         self.categories = []
         self.refresh()
+        if project_key is not None:
+            self.pollProject()
         self._w.contents.append((app.header, ('pack', 1)))
         self._w.contents.append((urwid.Divider(), ('pack', 1)))
         self._w.contents.append((urwid.AttrWrap(self.header, 'table-header'), ('pack', 1)))
@@ -443,6 +445,17 @@ class ChangeListView(urwid.WidgetWrap, mywid.Searchable):
         self.log.debug("Refreshing change list due to event %s" % (event,))
         return True
 
+    def pollProject(self):
+        # Quiet projects are only polled occasionally in the
+        # background, so check for updates as soon as someone looks.
+        with self.app.db.getSession() as session:
+            project = session.getProject(self.project_key)
+            if not project.subscribed:
+                return
+        if not self.app.sync.offline:
+            self.app.sync.submitTask(
+                sync.SyncProjectTask(self.project_key, sync.HIGH_PRIORITY))
+
     def refresh(self):
         unseen_keys = set(self.change_rows.keys())
         with self.app.db.getSession() as session:
@@ -758,10 +771,12 @@ class ChangeListView(urwid.WidgetWrap, mywid.Searchable):
         if keymap.REFRESH in commands:
             if self.project_key:
                 self.app.sync.submitTask(
-                    sync.SyncProjectTask(self.project_key, sync.HIGH_PRIORITY))
+                    sync.SyncProjectTask(self.project_key, sync.HIGH_PRIORITY,
+                                         force=True))
             else:
                 self.app.sync.submitTask(
-                    sync.SyncSubscribedProjectsTask(sync.HIGH_PRIORITY))
+                    sync.SyncSubscribedProjectsTask(sync.HIGH_PRIORITY,
+                                                    force=True))
             self.app.status.update()
             return True
         if keymap.REVIEW in commands:
@@ -12,11 +12,19 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
 import datetime
+import functools
 import logging
+import os
+import threading
+import weakref
 
+import six
+from six.moves import queue
 import urwid
 
+from gertty import diffcache
 from gertty import gitrepo
 from gertty import keymap
 from gertty import mywid
@@ -96,6 +104,160 @@ class LineContext(object):
         self.new_ln = new_ln
         self.header = header
 
+class LazyDiffLine(object):
+    """A placeholder for a diff line whose widget is built on demand.
+
+    markups are the text markups displayed by the line, used to search
+    it without building the widget; factory(*args) builds the widget.
+    """
+
+    def __init__(self, markups, factory, *args):
+        self.markups = markups
+        self.factory = factory
+        self.args = args
+        self.text = None
+
+    def build(self):
+        return self.factory(*self.args)
+
+    def matches(self, search):
+        if not search:
+            return False
+        if self.text is None:
+            self.text = [urwid.util.decompose_tagmarkup(m)[0]
+                         for m in self.markups]
+        for text in self.text:
+            if search in text:
+                return True
+        return False
+
+class DiffListWalker(urwid.ListWalker):
+    """A list walker which builds diff line widgets as they are shown.
+
+    The items of the list are either widgets or LazyDiffLine
+    placeholders.  Widgets are built for placeholders when the list box
+    asks for them, and only the MAX_WIDGETS most recently used are
+    kept, so memory use depends on the size of the screen rather than
+    the size of the diff.  The positions of items are indexed so that
+    widgets such as context buttons can be located without scanning
+    the list.  The subset of list methods used by the diff views is
+    supported.
+    """
+
+    MAX_WIDGETS = 500
+
+    def __init__(self, items):
+        self.items = list(items)
+        self.focus = 0
+        # placeholder -> widget, in order of use
+        self.widgets = collections.OrderedDict()
+        # widget -> placeholder, for every built widget still in use;
+        # the list box may hold widgets after they are evicted above
+        self.owners = weakref.WeakKeyDictionary()
+        # id(item) -> position, rebuilt after the list changes
+        self.positions_index = None
+        self.search_term = None
+        self.search_attribute = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, position):
+        if position < 0 or position >= len(self.items):
+            raise IndexError(position)
+        item = self.items[position]
+        if not isinstance(item, LazyDiffLine):
+            return item
+        widget = self.widgets.pop(item, None)
+        if widget is None:
+            widget = item.build()
+            if self.search_term:
+                widget.search(self.search_term, self.search_attribute)
+            self.owners[widget] = item
+        self.widgets[item] = widget
+        while len(self.widgets) > self.MAX_WIDGETS:
+            self.widgets.popitem(last=False)
+        return widget
+
+    def next_position(self, position):
+        if position + 1 >= len(self.items):
+            raise IndexError(position)
+        return position + 1
+
+    def prev_position(self, position):
+        if position <= 0:
+            raise IndexError(position)
+        return position - 1
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(len(self.items) - 1, -1, -1)
+        return range(len(self.items))
+
+    def set_focus(self, position):
+        if position < 0 or position >= len(self.items):
+            raise IndexError(position)
+        self.focus = position
+        self._modified()
+
+    def index(self, widget):
+        try:
+            item = self.owners.get(widget, widget)
+        except TypeError:
+            # Not weakly referenceable, so not one of ours.
+            item = widget
+        if self.positions_index is None:
+            self.positions_index = dict(
+                [(id(x), i) for i, x in enumerate(self.items)])
+        try:
+            return self.positions_index[id(item)]
+        except KeyError:
+            raise ValueError("%r is not in list" % (widget,))
+
+    def __setitem__(self, index, items):
+        # Only slice insertion (walker[i:i] = items) is supported.
+        if (not isinstance(index, slice) or
+            index.start != index.stop or index.step is not None):
+            raise TypeError("Only slice insertion is supported")
+        self.insert(index.start, *items)
+
+    def insert(self, position, *items):
+        self.items[position:position] = items
+        if position <= self.focus and len(self.items) > len(items):
+            self.focus += len(items)
+        self.positions_index = None
+        self._modified()
+
+    def remove(self, widget):
+        position = self.index(widget)
+        item = self.items.pop(position)
+        self.widgets.pop(item, None)
+        if position < self.focus:
+            self.focus -= 1
+        self.focus = max(0, min(self.focus, len(self.items) - 1))
+        self.positions_index = None
+        self._modified()
+
+    def search(self, search, attribute):
+        # Returns the positions of the items which match.
+        self.search_term = search
+        self.search_attribute = attribute
+        results = []
+        for i, item in enumerate(self.items):
+            if isinstance(item, LazyDiffLine):
+                widget = self.widgets.get(item)
+                if widget is not None:
+                    found = widget.search(search, attribute)
+                else:
+                    found = item.matches(search)
+            elif hasattr(item, 'search'):
+                found = item.search(search, attribute)
+            else:
+                continue
+            if found:
+                results.append(i)
+        return results
+
 class BaseDiffCommentEdit(urwid.Columns):
     pass
 
@@ -144,7 +306,7 @@ class DiffContextButton(urwid.WidgetWrap):
 
     def update(self):
         self._buttons[1].set_label("Expand %s lines of context" %
-                                   (len(self.chunk.lines)),)
+                                   (self.chunk.lineCount()),)
 
     def prev(self, button):
         self.view.expandChunk(self.diff, self.chunk, from_start=10)
@@ -155,6 +317,91 @@ class DiffContextButton(urwid.WidgetWrap):
     def next(self, button):
         self.view.expandChunk(self.diff, self.chunk, from_end=-10)
 
+class DiffLoader(object):
+    """Compute a diff on a background thread.
+
+    The files of the diff are handed to callback(loader, kind, value)
+    in the main loop, through a pipe watched by the main loop, as they
+    are computed.  kind is 'total' (the number of files, which is only
+    an estimate unless the diff is cached), 'file' (a DiffFile), and
+    finally one of 'done', 'cancelled' or 'error'.
+    Cancelling stops the computation after the current file.
+    """
+
+    def __init__(self, app, project_name, repo, old, new, show_old_commit,
+                 total, callback):
+        self.log = logging.getLogger('gertty.view.diff')
+        self.app = app
+        self.project_name = project_name
+        self.repo = repo
+        self.old = old
+        self.new = new
+        self.show_old_commit = show_old_commit
+        self.total = total
+        self.callback = callback
+        self.cancelled = False
+        self.queue = queue.Queue()
+        self.pipe = app.loop.watch_pipe(self._pipeInput)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _send(self, kind, value=None):
+        self.queue.put((kind, value))
+        os.write(self.pipe, six.b('x'))
+
+    def _run(self):
+        try:
+            try:
+                # Fetch the commits first if their refs are waiting to
+                # be fetched.
+                self.app.sync.fetcher.fetchMissing(self.project_name, self.repo,
+                                                   [self.old, self.new])
+                diffs = diffcache.get_cached(self.repo, self.app.config,
+                                             self.old, self.new,
+                                             show_old_commit=self.show_old_commit)
+                if diffs is not None:
+                    self._send('total', len(diffs))
+                    diffs = iter(diffs)
+                else:
+                    self._send('total', self.total)
+                    diffs = diffcache.iter_diff(self.repo, self.app.config,
+                                                self.old, self.new,
+                                                show_old_commit=self.show_old_commit)
+                try:
+                    for diff in diffs:
+                        if self.cancelled:
+                            break
+                        self._send('file', diff)
+                finally:
+                    if hasattr(diffs, 'close'):
+                        diffs.close()
+                if self.cancelled:
+                    self._send('cancelled')
+                else:
+                    self._send('done')
+            except Exception as e:
+                self.log.exception("Error computing diff")
+                self._send('error', e)
+        finally:
+            os.close(self.pipe)
+
+    def _pipeInput(self, data=None):
+        while True:
+            try:
+                kind, value = self.queue.get_nowait()
+            except queue.Empty:
+                return True
+            if kind == 'file' and self.cancelled:
+                continue
+            self.callback(self, kind, value)
+            if kind in ('done', 'cancelled', 'error'):
+                # Stop watching the pipe.
+                return False
+
 @mouse_scroll_decorator.ScrollByWheel
 class BaseDiffView(urwid.WidgetWrap, mywid.Searchable):
     def getCommands(self):
@@ -165,6 +412,8 @@ class BaseDiffView(urwid.WidgetWrap, mywid.Searchable):
              "Select old/new patchsets to diff"),
             (keymap.INTERACTIVE_SEARCH,
              "Interactive search"),
+            (keymap.CANCEL_DIFF,
+             "Stop computing the diff"),
             ]
 
     def help(self):
@@ -178,9 +427,11 @@ class BaseDiffView(urwid.WidgetWrap, mywid.Searchable):
         self.app = app
         self.old_revision_key = None  # Base
         self.new_revision_key = new_revision_key
+        self.diff_loader = None
         self._init()
 
     def _init(self):
+        self.cancelDiff()
         del self._w.contents[:]
         self.searchInit()
         with self.app.db.getSession() as session:
@@ -224,6 +475,12 @@ class BaseDiffView(urwid.WidgetWrap, mywid.Searchable):
             for f in new_revision.files:
                 new_comments += f.comments
                 self.new_file_keys[f.path] = f.key
+            # The number of files in the diff, for the progress line;
+            # the file lists include the commit message.
+            file_paths = set(self.new_file_keys)
+            if old_revision:
+                file_paths |= set([f.path for f in old_revision.files])
+            file_count = len(file_paths)
             comment_lists = {}
             comment_filenames = set()
             for comment in new_comments:
@@ -268,57 +525,114 @@ class BaseDiffView(urwid.WidgetWrap, mywid.Searchable):
                 comment_lists[key] = comment_list
                 comment_filenames.add(path)
         repo = gitrepo.get_repo(self.project_name, self.app.config)
+        self.repo = repo
         self._w.contents.append((self.app.header, ('pack', 1)))
         self.file_reminder = self.makeFileReminder()
         self._w.contents.append((self.file_reminder, ('pack', 1)))
-        lines = []  # The initial set of lines to display
         self.file_diffs = [{}, {}]  # Mapping of fn -> DiffFile object (old, new)
-        # this is a list of files:
-        diffs = repo.diff(self.base_commit, self.commit,
-                          show_old_commit=show_old_commit)
-        for diff in diffs:
-            comment_filenames.discard(diff.oldname)
-            comment_filenames.discard(diff.newname)
+        self.listbox = urwid.ListBox(DiffListWalker([]))
+        self._w.contents.append((self.listbox, ('weight', 1)))
+        self.old_focus = 2
+        self.draft_comments = []
+        self._w.set_focus(self.old_focus)
+        self.app.status.update(title=self.title)
+        # The diff is computed on a background thread; files are
+        # added to the view as they arrive.
+        self.comment_lists = comment_lists
+        self.comment_filenames = comment_filenames
+        self.diff_files_loaded = 0
+        self.diff_files_total = None
+        self.progress = urwid.Text(u'')
+        self._w.contents.append((self.progress, ('pack', 1)))
+        self.diff_loader = DiffLoader(self.app, self.project_name, repo,
+                                      self.base_commit, self.commit,
+                                      show_old_commit, file_count,
+                                      self.onDiffLoaded)
+        self.updateProgress()
+
+    def updateProgress(self, diff=None):
+        if self.diff_files_total is None:
+            total = u'?'
+        else:
+            total = u'%s' % (max(self.diff_files_total,
+                                 self.diff_files_loaded),)
+        text = u'Computing diff: %s of %s files' % (self.diff_files_loaded, total)
+        if diff is not None:
+            text += u' (%s)' % (diff.newname,)
+        key = self.app.config.keymap.formatKeys(keymap.CANCEL_DIFF)
+        text += u'; press %s to cancel' % (key,)
+        self.progress.set_text(('footer', text))
+
+    def cancelDiff(self):
+        if self.diff_loader:
+            self.diff_loader.cancel()
+
+    def onClose(self):
+        self.cancelDiff()
+
+    def onDiffLoaded(self, loader, kind, value):
+        if loader is not self.diff_loader:
+            return
+        if kind == 'total':
+            self.diff_files_total = value
+            self.updateProgress()
+            return
+        if kind == 'file':
+            self.comment_filenames.discard(value.oldname)
+            self.comment_filenames.discard(value.newname)
+            self.addFile(value, self.comment_lists)
+            self.diff_files_loaded += 1
+            self.updateProgress(value)
+            return
+        # The diff is complete, or was cancelled or failed.
+        self.diff_loader = None
+        for i, (w, options) in enumerate(self._w.contents):
+            if w is self.progress:
+                del self._w.contents[i]
+                break
+        if kind == 'error':
+            self.app.error(str(value))
+            return
+        if kind == 'cancelled':
+            self.app.status.update(message='Diff incomplete; it was cancelled')
+            return
         # There are comments referring to these files which do not
         # appear in the diff so we should create fake diff objects
         # that contain the full text.
-        for filename in comment_filenames:
-            diff = repo.getFile(self.base_commit, self.commit, filename)
+        for filename in self.comment_filenames:
+            diff = loader.repo.getFile(self.base_commit, self.commit, filename)
             if diff:
-                diffs.append(diff)
+                self.addFile(diff, self.comment_lists)
             else:
                 self.log.debug("Unable to find file %s in commit %s" % (filename, self.commit))
-        for i, diff in enumerate(diffs):
-            if i > 0:
-                lines.append(urwid.Text(''))
-            self.file_diffs[gitrepo.OLD][diff.oldname] = diff
-            self.file_diffs[gitrepo.NEW][diff.newname] = diff
-            lines.extend(self.makeFileHeader(diff, comment_lists))
-            for chunk in diff.chunks:
-                if chunk.context:
-                    if not chunk.first:
-                        lines += self.makeLines(diff, chunk.lines[:10], comment_lists)
-                        del chunk.lines[:10]
-                    button = DiffContextButton(self, diff, chunk)
-                    chunk.button = button
-                    lines.append(button)
-                    if not chunk.last:
-                        lines += self.makeLines(diff, chunk.lines[-10:], comment_lists)
-                        del chunk.lines[-10:]
-                    chunk.calcRange()
-                    chunk.button.update()
-                    if not chunk.lines:
-                        lines.remove(button)
-                else:
-                    lines += self.makeLines(diff, chunk.lines, comment_lists)
-        listwalker = urwid.SimpleFocusListWalker(lines)
-        self.listbox = urwid.ListBox(listwalker)
-        self._w.contents.append((self.listbox, ('weight', 1)))
-        self.old_focus = 2
-        self.draft_comments = []
-        self._w.set_focus(self.old_focus)
-        self.handleUndisplayedComments(comment_lists)
-        self.app.status.update(title=self.title)
+        self.handleUndisplayedComments(self.comment_lists)
+
+    def addFile(self, diff, comment_lists):
+        lines = []
+        if self.file_diffs[gitrepo.OLD] or self.file_diffs[gitrepo.NEW]:
+            lines.append(urwid.Text(''))
+        self.file_diffs[gitrepo.OLD][diff.oldname] = diff
+        self.file_diffs[gitrepo.NEW][diff.newname] = diff
+        lines.extend(self.makeFileHeader(diff, comment_lists))
+        for chunk in diff.chunks:
+            if chunk.context:
+                load = self.contextLoader(diff)
+                if not chunk.first:
+                    lines += self.makeLines(diff, chunk.takeFirst(10, load),
+                                            comment_lists)
+                button = DiffContextButton(self, diff, chunk)
+                chunk.button = button
+                lines.append(button)
+                if not chunk.last:
+                    lines += self.makeLines(diff, chunk.takeLast(10, load),
+                                            comment_lists)
+                chunk.button.update()
+                if not chunk.lineCount():
+                    lines.remove(button)
+            else:
+                lines += self.makeLines(diff, chunk.getLines(), comment_lists)
+        body = self.listbox.body
+        body[len(body):len(body)] = lines
 
     def handleUndisplayedComments(self, comment_lists):
         # Handle comments that landed outside our default diff context
@@ -343,49 +657,50 @@ class BaseDiffView(urwid.WidgetWrap, mywid.Searchable):
                 del comment_lists[key]
                 continue
             diff = self.file_diffs[oldnew][path]
-            for chunk in diff.chunks:
-                if (chunk.range[oldnew][gitrepo.START] <= lineno and
-                    chunk.range[oldnew][gitrepo.END]   >= lineno):
-                    i = chunk.indexOfLine(oldnew, lineno)
-                    if i < (len(chunk.lines) / 2):
-                        from_start = True
-                    else:
-                        from_start = False
-                    if chunk.first and from_start:
-                        from_start = False
-                    if chunk.last and (not from_start):
-                        from_start = True
-                    if from_start:
-                        self.expandChunk(diff, chunk, comment_lists, from_start=i+10)
-                    else:
-                        self.expandChunk(diff, chunk, comment_lists, from_end=0-(len(chunk.lines)-i)-10)
-                    break
+            chunk = diff.findChunk(oldnew, lineno)
+            if chunk and chunk.context:
+                i = chunk.indexOfLine(oldnew, lineno)
+                if i < (chunk.lineCount() / 2):
+                    from_start = True
+                else:
+                    from_start = False
+                if chunk.first and from_start:
+                    from_start = False
+                if chunk.last and (not from_start):
+                    from_start = True
+                if from_start:
+                    self.expandChunk(diff, chunk, comment_lists, from_start=i+10)
+                else:
+                    self.expandChunk(diff, chunk, comment_lists, from_end=0-(chunk.lineCount()-i)-10)
 
     def expandChunk(self, diff, chunk, comment_lists={}, from_start=None, from_end=None,
                     expand_all=None):
         self.log.debug("Expand chunk %s %s %s" % (chunk, from_start, from_end))
         add_lines = []
+        load = self.contextLoader(diff)
         if from_start is not None:
             index = self.listbox.body.index(chunk.button)
-            add_lines = chunk.lines[:from_start]
-            del chunk.lines[:from_start]
+            add_lines = chunk.takeFirst(from_start, load)
         if from_end is not None:
             index = self.listbox.body.index(chunk.button)+1
-            add_lines = chunk.lines[from_end:]
-            del chunk.lines[from_end:]
+            add_lines = chunk.takeLast(-from_end, load)
         if expand_all:
             index = self.listbox.body.index(chunk.button)
-            add_lines = chunk.lines[:]
-            del chunk.lines[:]
+            add_lines = chunk.takeAll(load)
         if add_lines:
             lines = self.makeLines(diff, add_lines, comment_lists)
             self.listbox.body[index:index] = lines
-        chunk.calcRange()
-        if not chunk.lines:
+        if not chunk.lineCount():
             self.listbox.body.remove(chunk.button)
         else:
             chunk.button.update()
 
+    def contextLoader(self, diff):
+        # Context lines which were not part of the diff are read from
+        # the new version of the file when they are expanded.
+        return functools.partial(self.repo.readLines, self.commit,
+                                 diff.newname)
+
     def makeContext(self, diff, old_ln, new_ln, header=False):
         old_key = None
         new_key = None
@@ -426,23 +741,25 @@ class BaseDiffView(urwid.WidgetWrap, mywid.Searchable):
         pass
 
     def getContextAtTop(self, size):
+        if not len(self.listbox.body):
+            # The diff is still being loaded.
+            return None
         middle, top, bottom = self.listbox.calculate_visible(size, True)
         if top and top[1]:
             (widget, pos, rows) = top[1][-1]
         elif middle:
             pos = middle[2]
+        else:
+            return None
         # Make sure the first header shows up as soon as it scrolls up
         if pos > 1:
             pos -= 1
-        context = None
-        while True:
+        while pos > 0:
             item = self.listbox.body[pos]
             if hasattr(item, 'context'):
-                break
+                return item.context
             pos -= 1
-        if pos > 0:
-            context = item.context
-        return context
+        return None
 
     def keypress(self, size, key):
         if self.searchKeypress(size, key):
@@ -471,6 +788,9 @@ class BaseDiffView(urwid.WidgetWrap, mywid.Searchable):
         if keymap.INTERACTIVE_SEARCH in commands:
             self.searchStart()
             return None
+        if keymap.CANCEL_DIFF in commands:
+            self.cancelDiff()
+            return None
         return key
 
     def mouse_event(self, size, event, button, x, y, focus):
@@ -587,7 +587,8 @@ class ProjectListView(urwid.WidgetWrap, mywid.Searchable):
             return True
         if keymap.REFRESH in commands:
             self.app.sync.submitTask(
-                sync.SyncSubscribedProjectsTask(sync.HIGH_PRIORITY))
+                sync.SyncSubscribedProjectsTask(sync.HIGH_PRIORITY,
+                                                force=True))
             self.app.status.update()
             self.refresh()
             return True
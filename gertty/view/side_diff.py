@@ -18,6 +18,7 @@ from gertty import keymap
 from gertty import mywid
 from gertty.view.diff import BaseDiffComment, BaseDiffCommentEdit, BaseDiffLine
 from gertty.view.diff import BaseFileHeader, BaseFileReminder, BaseDiffView
+from gertty.view.diff import LazyDiffLine
 
 LN_COL_WIDTH = 5
 
@@ -141,30 +142,31 @@ class SideFileReminder(BaseFileReminder):
         self.new_text.set_text(('filename', new))
 
 class SideDiffView(BaseDiffView):
+    def makeDiffLine(self, diff, old, new):
+        context = self.makeContext(diff, old[0], new[0])
+        return SideDiffLine(self.app, context, old, new,
+                            callback=self.onSelect)
+
     def makeLines(self, diff, lines_to_add, comment_lists):
         lines = []
         for old, new in lines_to_add:
-            context = self.makeContext(diff, old[0], new[0])
-            lines.append(SideDiffLine(self.app, context, old, new,
-                                      callback=self.onSelect))
+            lines.append(LazyDiffLine([old[2], new[2]], self.makeDiffLine,
+                                      diff, old, new))
+            if not comment_lists:
+                continue
             # see if there are any comments for this line
             key = 'old-%s-%s' % (old[0], diff.oldname)
             old_list = comment_lists.pop(key, [])
             key = 'new-%s-%s' % (new[0], diff.newname)
             new_list = comment_lists.pop(key, [])
-            while old_list or new_list:
-                old_comment_key = new_comment_key = None
-                old_comment = new_comment = u''
-                if old_list:
-                    (old_comment_key, old_comment) = old_list.pop(0)
-                if new_list:
-                    (new_comment_key, new_comment) = new_list.pop(0)
-                lines.append(SideDiffComment(context, old_comment, new_comment))
             # see if there are any draft comments for this line
             key = 'olddraft-%s-%s' % (old[0], diff.oldname)
-            old_list = comment_lists.pop(key, [])
+            old_draft_list = comment_lists.pop(key, [])
             key = 'newdraft-%s-%s' % (new[0], diff.newname)
-            new_list = comment_lists.pop(key, [])
+            new_draft_list = comment_lists.pop(key, [])
+            if not (old_list or new_list or old_draft_list or new_draft_list):
+                continue
+            context = self.makeContext(diff, old[0], new[0])
             while old_list or new_list:
                 old_comment_key = new_comment_key = None
                 old_comment = new_comment = u''
@@ -172,6 +174,14 @@ class SideDiffView(BaseDiffView):
                     (old_comment_key, old_comment) = old_list.pop(0)
                 if new_list:
                     (new_comment_key, new_comment) = new_list.pop(0)
+                lines.append(SideDiffComment(context, old_comment, new_comment))
+            while old_draft_list or new_draft_list:
+                old_comment_key = new_comment_key = None
+                old_comment = new_comment = u''
+                if old_draft_list:
+                    (old_comment_key, old_comment) = old_draft_list.pop(0)
+                if new_draft_list:
+                    (new_comment_key, new_comment) = new_draft_list.pop(0)
                 lines.append(SideDiffCommentEdit(self.app, context,
                                                  old_comment_key,
                                                  new_comment_key,
@@ -0,0 +1,122 @@
+# Copyright 2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+
+import urwid
+
+from gertty import keymap
+from gertty import mywid
+from gertty.view import mouse_scroll_decorator
+
+def format_seconds(value):
+    return u'%0.2fs' % (value,)
+
+def format_size(value):
+    for unit in [u'B', u'KiB', u'MiB']:
+        if value < 1024:
+            return u'%0.0f%s' % (value, unit)
+        value /= 1024.0
+    return u'%0.1fGiB' % (value,)
+
+@mouse_scroll_decorator.ScrollByWheel
+class SyncStatusView(urwid.WidgetWrap):
+    def getCommands(self):
+        return [
+            (keymap.REFRESH,
+             "Refresh the sync statistics"),
+            ]
+
+    def help(self):
+        key = self.app.config.keymap.formatKeys
+        commands = self.getCommands()
+        return [(c[0], key(c[0]), c[1]) for c in commands]
+
+    def __init__(self, app):
+        super(SyncStatusView, self).__init__(urwid.Pile([]))
+        self.log = logging.getLogger('gertty.view.sync_status')
+        self.app = app
+        self.title = u'Sync status'
+        self.short_title = self.title[:]
+        self.listbox = urwid.ListBox(urwid.SimpleFocusListWalker([]))
+        self._w.contents.append((app.header, ('pack', 1)))
+        self._w.contents.append((urwid.Divider(), ('pack', 1)))
+        self._w.contents.append((self.listbox, ('weight', 1)))
+        self._w.set_focus(2)
+        self.refresh()
+
+    def interested(self, event):
+        return True
+
+    def _table(self, headers, rows):
+        table = mywid.Table([urwid.Text(('table-header', h)) for h in headers])
+        for row in rows:
+            table.addRow([urwid.Text(cell) for cell in row])
+        return table
+
+    def refresh(self):
+        stats = self.app.sync.getStats()
+        self.app.status.update(title=self.title)
+        widgets = []
+
+        rows = []
+        for name in ['high', 'normal', 'low']:
+            queue = stats['queue'][name]
+            rows.append([name, str(queue['waiting']), format_seconds(queue['oldest_wait']),
+                         str(queue['started']), format_seconds(queue['mean_wait']),
+                         format_seconds(queue['max_wait'])])
+        widgets.append(urwid.Text(u'Queue (up %s, %s refs waiting to be fetched)' % (
+            format_seconds(stats['uptime']), stats['pending_fetches'])))
+        widgets.append(self._table([u'Priority', u'Waiting', u'Oldest', u'Started',
+                                    u'Mean wait', u'Max wait'], rows))
+        widgets.append(urwid.Divider())
+
+        rows = []
+        for method, request in sorted(stats['requests'].items()):
+            rows.append([method, str(request['count']), str(request['errors']),
+                         format_size(request['bytes']), format_seconds(request['p50']),
+                         format_seconds(request['p90']), format_seconds(request['p99']),
+                         format_seconds(request['max'])])
+        widgets.append(urwid.Text(u'HTTP requests'))
+        widgets.append(self._table([u'Method', u'Count', u'Errors', u'Received',
+                                    u'p50', u'p90', u'p99', u'Max'], rows))
+        widgets.append(urwid.Divider())
+
+        # List the tasks which have taken the most time first.
+        rows = []
+        tasks = sorted(stats['tasks'].items(), key=lambda x: x[1]['run_time'],
+                       reverse=True)
+        for name, task in tasks:
+            rows.append([name, str(task['count']), str(task['failures']),
+                         format_seconds(task['run_time']),
+                         format_seconds(task['run_time'] / task['count']),
+                         format_seconds(task['max_run_time']),
+                         format_seconds(task['wait_time'] / task['count']),
+                         format_seconds(task['db_time'])])
+        widgets.append(urwid.Text(u'Tasks'))
+        widgets.append(self._table([u'Task', u'Runs', u'Failures', u'Total',
+                                    u'Mean', u'Max', u'Mean wait', u'Database'],
+                                   rows))
+
+        self.listbox.body[:] = widgets
+
+    def keypress(self, size, key):
+        if not self.app.input_buffer:
+            key = super(SyncStatusView, self).keypress(size, key)
+        keys = self.app.input_buffer + [key]
+        commands = self.app.config.keymap.getCommands(keys)
+        if keymap.REFRESH in commands:
+            self.refresh()
+            return None
+        return key
@@ -19,6 +19,7 @@ from gertty import gitrepo
 from gertty import mywid
 from gertty.view.diff import BaseDiffCommentEdit, BaseDiffComment, BaseDiffLine
 from gertty.view.diff import BaseFileHeader, BaseFileReminder, BaseDiffView
+from gertty.view.diff import LazyDiffLine
 
 LN_COL_WIDTH = 5
 
@@ -123,58 +124,58 @@ class UnifiedFileReminder(BaseFileReminder):
         self.col._invalidate()
 
 class UnifiedDiffView(BaseDiffView):
+    def makeDiffLine(self, diff, oldnew, old, new):
+        context = self.makeContext(diff, old[0], new[0])
+        return UnifiedDiffLine(self.app, context, oldnew, old, new,
+                               callback=self.onSelect)
+
     def makeLines(self, diff, lines_to_add, comment_lists):
         lines = []
         old_cache = []
         new_cache = []
         for old, new in lines_to_add:
-            context = self.makeContext(diff, old[0], new[0])
-            if context.old_ln is not None:
-                old_cache.append(UnifiedDiffLine(self.app, context, gitrepo.OLD, old, new,
-                                                 callback=self.onSelect))
+            # see if there are any comments or draft comments for this line
+            old_list = comment_lists.pop('old-%s-%s' % (old[0], diff.oldname), [])
+            old_draft_list = comment_lists.pop('olddraft-%s-%s' % (old[0], diff.oldname), [])
+            new_list = comment_lists.pop('new-%s-%s' % (new[0], diff.newname), [])
+            new_draft_list = comment_lists.pop('newdraft-%s-%s' % (new[0], diff.newname), [])
+            context = None
+            if old_list or old_draft_list or new_list or new_draft_list:
+                context = self.makeContext(diff, old[0], new[0])
+            if old[0] is not None:
+                old_cache.append(LazyDiffLine([old[2]], self.makeDiffLine,
+                                              diff, gitrepo.OLD, old, new))
             else:
                 lines.extend(old_cache)
                 lines.extend(new_cache)
                 old_cache = []
                 new_cache = []
-            # see if there are any comments for this line
-            key = 'old-%s-%s' % (old[0], diff.oldname)
-            old_list = comment_lists.pop(key, [])
             while old_list:
                 (old_comment_key, old_comment) = old_list.pop(0)
                 old_cache.append(UnifiedDiffComment(context, gitrepo.OLD, old_comment))
-            # see if there are any draft comments for this line
-            key = 'olddraft-%s-%s' % (old[0], diff.oldname)
-            old_list = comment_lists.pop(key, [])
-            while old_list:
-                (old_comment_key, old_comment) = old_list.pop(0)
+            while old_draft_list:
+                (old_comment_key, old_comment) = old_draft_list.pop(0)
                 old_cache.append(UnifiedDiffCommentEdit(self.app,
                                                     context,
                                                     gitrepo.OLD,
                                                     old_comment_key,
                                                     old_comment))
             # new line
-            if context.new_ln is not None and new[1] != ' ':
+            if new[0] is not None and new[1] != ' ':
+                line = LazyDiffLine([new[2]], self.makeDiffLine,
+                                    diff, gitrepo.NEW, old, new)
                 if old_cache:
-                    new_cache.append(UnifiedDiffLine(self.app, context, gitrepo.NEW, old, new,
-                                                     callback=self.onSelect))
+                    new_cache.append(line)
                 else:
-                    lines.append(UnifiedDiffLine(self.app, context, gitrepo.NEW, old, new,
-                                                 callback=self.onSelect))
-            # see if there are any comments for this line
-            key = 'new-%s-%s' % (new[0], diff.newname)
-            new_list = comment_lists.pop(key, [])
+                    lines.append(line)
             while new_list:
                 (new_comment_key, new_comment) = new_list.pop(0)
                 if old_cache:
                     new_cache.append(UnifiedDiffComment(context, gitrepo.NEW, new_comment))
                 else:
                     lines.append(UnifiedDiffComment(context, gitrepo.NEW, new_comment))
-            # see if there are any draft comments for this line
-            key = 'newdraft-%s-%s' % (new[0], diff.newname)
-            new_list = comment_lists.pop(key, [])
-            while new_list:
-                (new_comment_key, new_comment) = new_list.pop(0)
+            while new_draft_list:
+                (new_comment_key, new_comment) = new_draft_list.pop(0)
                 if old_cache:
                     new_cache.append(UnifiedDiffCommentEdit(self.app,
                                                             context,
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright 2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measure the memory held by computed diffs.
+
+The diffs are of a commit which reformats many files, with full
+context, and of a commit changing one line of a very large file, with
+the default and with full context.  The memory still allocated once the
+diff has been returned is measured with tracemalloc, along with the
+peak while it was computed.  Requires Python 3.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+import benchutil
+
+# Enough lines of context to show every file in full.
+FULL_CONTEXT = 1 << 30
+
+
+def make_large_file(path, lines):
+    benchutil.init_repo(path)
+    text = ['line %d of a large file\n' % i for i in range(lines)]
+    fi = benchutil.FastImport(path)
+    parent = fi.commit('refs/heads/master', {'large.txt': ''.join(text)},
+                       'Initial commit\n')
+    text[lines // 2] = 'a changed line\n'
+    fi.commit('refs/heads/master', {'large.txt': ''.join(text)},
+              'Change one line\n', parent)
+    fi.close()
+    return benchutil.git(path, 'rev-parse', 'master~1', 'master').split()
+
+
+def measure(name, repo, old, new, **kw):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    files = repo.diff(old, new, **kw)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-28s %4d files: %7.1f MB held, %7.1f MB peak' % (
+        name, len(files), (current - start) / 1e6, (peak - start) / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    benchutil.add_arguments(parser)
+    parser.add_argument('--files', type=int, default=300,
+                        help='files changed by the refactor')
+    parser.add_argument('--lines', type=int, default=200000,
+                        help='lines in the large file')
+    args = parser.parse_args()
+    benchutil.setup(args)
+    from gertty import gitrepo
+
+    path = tempfile.mkdtemp(prefix='gertty-bench-')
+    try:
+        cases = [('refactor', benchutil.make_refactor(
+                    os.path.join(path, 'refactor'), args.files)),
+                 ('large', make_large_file(os.path.join(path, 'large'),
+                                           args.lines))]
+        for name, (old, new) in cases:
+            repo = gitrepo.Repo(None, os.path.join(path, name))
+            if hasattr(repo, 'intraline'):
+                repo.intraline.pool = None
+            if name == 'large':
+                measure('large, default context', repo, old, new)
+            measure('%s, full context' % name, repo, old, new,
+                    context=FULL_CONTEXT)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
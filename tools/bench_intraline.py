@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# Copyright 2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Time the intraline highlighting of large hunks.
+
+Each hunk replaces the given number of lines of code-like text with
+an edited copy in which every line was changed, as in a reformat or a
+rename, which is the worst case for highlighting.  The hunk size
+cutoff (intraline-max-lines) is lifted so that the highlighting itself
+is measured.  The markup is checked to reproduce the lines of the hunk
+using only the usual attributes.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+import benchutil
+
+ATTRIBUTES = set(['removed-line', 'removed-word', 'added-line', 'added-word',
+                  'context-line', 'trailing-ws'])
+
+
+def make_hunk(size, seed=0):
+    rand = random.Random(seed)
+    names = ['value', 'result', 'count', 'index', 'item', 'node', 'path',
+             'config', 'session', 'change', 'revision', 'project']
+    old = []
+    new = []
+    for i in range(size):
+        a, b, c = [rand.choice(names) for x in range(3)]
+        line = '        %s_%d = self.%s(%s, %d)  # %s' % (
+            a, i, b, c, rand.randint(0, 1000), ' '.join(rand.sample(names, 4)))
+        old.append(line)
+        words = line.split(' ')
+        for x in range(2):
+            w = rand.randrange(8, len(words))
+            words[w] = rand.choice(names) + words[w][-1:]
+        new.append(' '.join(words).replace('self.', 'self._', 1))
+    return old, new
+
+
+def check(lines, markup, sides):
+    for line, result in zip(lines, markup):
+        if isinstance(result, tuple):
+            result = [result]
+        spans = []
+        for item in result:
+            spans.extend(item if isinstance(item, list) else [item])
+        for attr, text in spans:
+            if attr not in ATTRIBUTES or not attr.startswith(sides):
+                raise Exception("Unexpected attribute %s" % (attr,))
+        if ''.join(text for attr, text in spans) != line:
+            raise Exception("Markup does not match %r" % (line,))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    benchutil.add_arguments(parser)
+    parser.add_argument('--lines', type=int, nargs='+',
+                        default=[100, 500, 1000, 2000],
+                        help='the numbers of lines replaced by each hunk')
+    args = parser.parse_args()
+    benchutil.setup(args)
+    from gertty import gitrepo
+
+    path = tempfile.mkdtemp(prefix='gertty-bench-')
+    try:
+        benchutil.init_repo(os.path.join(path, 'repo'))
+        repo = gitrepo.Repo(None, os.path.join(path, 'repo'))
+        if hasattr(repo, 'intraline'):
+            repo.intraline.max_lines = sys.maxsize
+            repo.intraline.pool = None
+        for size in args.lines:
+            old, new = make_hunk(size)
+            elapsed, (old_markup, new_markup) = benchutil.timed(
+                repo.intralineDiff, old, new)
+            check(old, old_markup, ('removed', 'context'))
+            check(new, new_markup, ('added', 'context', 'trailing'))
+            print('%5d lines: %0.3fs' % (size, elapsed))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
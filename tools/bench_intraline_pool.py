@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Copyright 2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Time the diff of a large refactor with several intraline processes.
+
+The diff of a commit which reformats many files is computed with the
+intraline highlighting done in this process (0) and then spread over
+pools of the given numbers of processes, and the best of --repeat runs
+is reported for each.  The highlighting from every pool is checked
+against the one done in this process.
+
+Trees without the intraline-processes option can only be measured
+with 0.
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+import benchutil
+
+
+def changed_lines(files):
+    ret = []
+    for f in files:
+        for chunk in f.chunks:
+            if not chunk.context:
+                ret.append(chunk.getLines() if hasattr(chunk, 'getLines')
+                           else chunk.lines)
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    benchutil.add_arguments(parser)
+    parser.add_argument('--processes', type=int, nargs='+', default=[0, 2, 4, 8],
+                        help='the numbers of worker processes to measure')
+    parser.add_argument('--files', type=int, default=300)
+    parser.add_argument('--lines', type=int, default=300,
+                        help='lines per file')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    benchutil.setup(args)
+    from gertty import gitrepo
+
+    print('%d CPUs' % (multiprocessing.cpu_count(),))
+    path = tempfile.mkdtemp(prefix='gertty-bench-')
+    try:
+        repo_path = os.path.join(path, 'repo')
+        old, new = benchutil.make_refactor(repo_path, args.files, args.lines)
+        expected = None
+        serial = None
+        for processes in args.processes:
+            repo = gitrepo.Repo(None, repo_path)
+            if not hasattr(repo, 'intraline'):
+                if processes:
+                    print("This tree has no intraline-processes option; "
+                          "skipping %s processes" % (processes,))
+                    continue
+            pool = None
+            if processes:
+                pool = multiprocessing.Pool(processes)
+            if hasattr(repo, 'intraline'):
+                repo.intraline.pool = pool
+            try:
+                best = None
+                for i in range(args.repeat):
+                    elapsed, files = benchutil.timed(repo.diff, old, new)
+                    if best is None or elapsed < best:
+                        best = elapsed
+            finally:
+                if pool:
+                    pool.terminate()
+            result = changed_lines(files)
+            if expected is None:
+                expected = result
+            elif result != expected:
+                raise Exception("The highlighting with %s processes differs" %
+                                (processes,))
+            if serial is None:
+                serial = best
+            print('%2d processes: %d files in %0.2fs, %0.1fx' % (
+                processes, len(files), best, serial / best))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
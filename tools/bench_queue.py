@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright 2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Time the sync queue with many queued tasks.
+
+For each size, that many SyncChangeTasks are queued, then queued again
+(as duplicates, which the queue must reject), a few SyncProjectTasks
+are looked up with find() as the sync does for batch tasks, and finally
+every task is taken with get() and marked complete.
+
+A queue which scans itself is quadratic, so once one size takes longer
+than --limit seconds the larger sizes are skipped.
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+import benchutil
+
+
+def run(count, finds):
+    from gertty import sync
+
+    queue = sync.MultiQueue([sync.HIGH_PRIORITY, sync.NORMAL_PRIORITY,
+                             sync.LOW_PRIORITY])
+    priority = sync.NORMAL_PRIORITY
+    tasks = [sync.SyncChangeTask('change%d' % i, priority=priority)
+             for i in range(count)]
+    duplicates = [sync.SyncChangeTask('change%d' % i, priority=priority)
+                  for i in range(count)]
+    for i in range(10):
+        queue.put(sync.SyncProjectTask(i, priority), priority)
+
+    def put(items):
+        return sum(1 for item in items if queue.put(item, priority))
+
+    def find():
+        for i in range(finds):
+            queue.find(sync.SyncProjectTask, priority)
+
+    def drain():
+        for i in range(count + 10):
+            queue.complete(queue.get())
+
+    results = []
+    for name, func, args in [('put', put, (tasks,)),
+                             ('put duplicate', put, (duplicates,)),
+                             ('%d finds' % finds, find, ()),
+                             ('get and complete', drain, ())]:
+        elapsed, ret = benchutil.timed(func, *args)
+        if func is put and ret != (count if args[0] is tasks else 0):
+            raise Exception("%s added %s of %s tasks" % (name, ret, count))
+        results.append((name, elapsed))
+    if queue.qsize():
+        raise Exception("%s items left in the queue" % (queue.qsize(),))
+    print('%7d tasks: %s, total %0.3fs' % (
+        count, ', '.join('%s %0.3fs' % r for r in results),
+        sum(r[1] for r in results)))
+    return sum(r[1] for r in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    benchutil.add_arguments(parser)
+    parser.add_argument('--tasks', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='the numbers of tasks to queue')
+    parser.add_argument('--finds', type=int, default=1000,
+                        help='the number of find() calls')
+    parser.add_argument('--limit', type=float, default=60,
+                        help='skip larger sizes after one takes this many '
+                        'seconds')
+    args = parser.parse_args()
+    benchutil.setup(args)
+    for count in sorted(args.tasks):
+        if run(count, args.finds) > args.limit:
+            print("Skipping larger sizes")
+            break
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# Copyright 2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measure how many changes per second a cold sync stores.
+
+A fake Gerrit server on localhost answers the REST calls made while
+syncing a change, waiting --latency seconds before each reply, and
+serves the changes' commits from local repositories.  For each worker
+count a new empty database is synced with every change, and the time
+is taken from the first change being queued until all of them are in
+the database and their commits have been fetched.
+
+Trees without the sync-workers option can only be measured with one
+worker.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse as urlparse
+
+import benchutil
+
+
+class FakeGerrit(object):
+    def __init__(self, path, projects, changes, latency):
+        self.latency = latency
+        self.changes = {}
+        self.commits = {}
+        for p in range(projects):
+            name = 'bench/project%d' % p
+            remote = os.path.join(path, 'remote', name)
+            benchutil.init_repo(remote, bare=True)
+            fi = benchutil.FastImport(remote)
+            base = fi.commit('refs/heads/master', {'README': 'base\n'},
+                             'Initial commit\n')
+            for c in range(changes):
+                number = p * changes + c + 1
+                ref = 'refs/changes/%02d/%d/1' % (number % 100, number)
+                files = {'file%d.txt' % c: 'change %d\n' % number}
+                fi.commit(ref, files, 'Change %d\n' % number, base)
+            fi.close()
+            refs = benchutil.git(remote, 'for-each-ref',
+                                 '--format=%(objectname) %(refname)')
+            shas = dict(reversed(l.split()) for l in refs.splitlines())
+            self.commits[name] = (remote, list(shas.values()))
+            for c in range(changes):
+                number = p * changes + c + 1
+                ref = 'refs/changes/%02d/%d/1' % (number % 100, number)
+                change = self.makeChange(name, remote, number, ref, shas[ref],
+                                         shas['refs/heads/master'],
+                                         'file%d.txt' % c)
+                self.changes[urlparse.unquote(change['id'])] = change
+
+    def makeChange(self, project, remote, number, ref, sha, parent, path):
+        owner = dict(_account_id=number % 10 + 2, name='Owner %d' % (number % 10),
+                     username='owner%d' % (number % 10),
+                     email='owner%d@example.com' % (number % 10))
+        change_id = 'I%040x' % number
+        date = '2015-01-01 00:00:00.000000000'
+        messages = [dict(id='m%d-%d' % (number, i), author=owner, date=date,
+                         message='Patch Set 1: message %d' % i,
+                         _revision_number=1)
+                    for i in range(3)]
+        comments = {path: [dict(id='c%d' % number, author=owner, updated=date,
+                                line=1, message='A comment', patch_set=1)]}
+        revision = dict(_number=1, ref=ref,
+                        fetch={'anonymous http': dict(url='file://' + remote,
+                                                      ref=ref)},
+                        commit=dict(message='Change %d\n' % number,
+                                    parents=[dict(commit=parent)]),
+                        files={path: dict(status='A', lines_inserted=1)})
+        labels = {'Code-Review': dict(
+            all=[dict(value=1, date=date, **owner)],
+            values={'-1': 'No', ' 0': 'No score', '+1': 'Yes'})}
+        return dict(id='%s~master~%s' % (urlparse.quote_plus(project), change_id),
+                    project=project, branch='master', change_id=change_id,
+                    subject='Change %d' % number, status='NEW',
+                    created=date, updated=date, _number=number, owner=owner,
+                    revisions={sha: revision}, messages=messages,
+                    labels=labels, permitted_labels={},
+                    _bench_comments=comments)
+
+    def handle(self, path):
+        # Returns the JSON reply to a GET request, or None for a 404.
+        path = path.partition('?')[0]
+        if not path.startswith('/a/'):
+            return None
+        parts = [urlparse.unquote(p) for p in path[3:].split('/')]
+        if parts == ['config', 'server', 'version']:
+            return '2.16.0'
+        if parts == ['accounts', 'self']:
+            return dict(_account_id=1, name='Bench', username='bench',
+                        email='bench@example.com')
+        if parts[0] == 'projects' and len(parts) == 2:
+            return dict(name=parts[1], description='')
+        if parts[0] == 'changes':
+            if parts[1] == '':
+                # Queries, such as for the parents of changes.
+                return []
+            change = self.changes.get(parts[1])
+            if change is None:
+                return None
+            if len(parts) == 2:
+                return dict((k, v) for k, v in change.items()
+                            if not k.startswith('_bench'))
+            if parts[2:] == ['comments']:
+                return change['_bench_comments']
+            if parts[2] == 'revisions' and parts[4:] == ['comments']:
+                return change['_bench_comments']
+        return None
+
+    def serve(self):
+        gerrit = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                time.sleep(gerrit.latency)
+                ret = gerrit.handle(self.path)
+                if ret is None:
+                    self.send_response(404)
+                    body = b'Not found'
+                else:
+                    self.send_response(200)
+                    body = (")]}'\n" + json.dumps(ret)).encode('utf8')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        server = Server(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        return 'http://127.0.0.1:%d/' % server.server_address[1]
+
+
+class Status(object):
+    def update(self, *args, **kw):
+        pass
+
+
+class App(object):
+    # Just enough of gertty.app.App for the sync workers.
+    def __init__(self, config):
+        from gertty import app
+        from gertty import db
+        from gertty import search
+        self.config = config
+        self.status = Status()
+        self.project_cache = app.ProjectCache()
+        self.fetch_missing_refs = False
+        self.search = search.SearchCompiler(config.username)
+        self.db = db.Database(self, config.dburi, self.search)
+
+
+def write_config(path, url):
+    config_path = os.path.join(path, 'gertty.yaml')
+    server = {'name': 'bench', 'url': url, 'username': 'bench',
+              'password': 'bench', 'auth-type': 'basic',
+              'git-root': os.path.join(path, 'git'),
+              'dburi': 'sqlite:///' + os.path.join(path, 'gertty.db')}
+    with open(config_path, 'w') as f:
+        # JSON is a subset of YAML.
+        json.dump({'servers': [server]}, f)
+    os.chmod(config_path, 0o600)
+    return config_path
+
+
+def missing_commits(gerrit, git_root):
+    missing = 0
+    for project, (remote, shas) in gerrit.commits.items():
+        out = benchutil.git(os.path.join(git_root, project), 'cat-file',
+                            '--batch-check',
+                            input=('\n'.join(shas) + '\n').encode('utf8'))
+        missing += out.count(' missing')
+    return missing
+
+
+def run(gerrit, url, workers, path):
+    from gertty import config as gertty_config
+    from gertty import sync
+
+    config = gertty_config.Config('bench', path=write_config(path, url))
+    if workers > 1 and not hasattr(config, 'sync_workers'):
+        print("This tree has no sync-workers option; skipping %s workers" %
+              (workers,))
+        return
+    for project, (remote, shas) in gerrit.commits.items():
+        local = os.path.join(config.git_root, project)
+        benchutil.git(path, 'clone', '-q', remote, local)
+    app = App(config)
+    with app.db.getSession() as session:
+        for project in gerrit.commits:
+            session.createProject(project, subscribed=True)
+    s = sync.Sync(app, True)
+    app.sync = s
+    read_fd, write_fd = os.pipe()
+
+    def drain():
+        while os.read(read_fd, 4096):
+            pass
+    threads = [threading.Thread(target=drain)]
+    threads += [threading.Thread(target=s.run, args=(write_fd,))
+                for i in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    # Wait for the version and account to be fetched first.
+    while s.account_id is None or s.version == (0, 0, 0):
+        time.sleep(0.01)
+
+    start = time.time()
+    tasks = [sync.SyncChangeTask(change_id, priority=sync.NORMAL_PRIORITY)
+             for change_id in sorted(c['id'] for c in gerrit.changes.values())]
+    for task in tasks:
+        s.submitTask(task)
+    failed = 0
+    for task in tasks:
+        if not task.wait(300):
+            failed += 1
+    while missing_commits(gerrit, config.git_root):
+        if time.time() - start > 300:
+            raise Exception("Timed out waiting for commits to be fetched")
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    if failed:
+        print("%s tasks failed; see the log for details" % (failed,))
+    count = len(tasks) - failed
+    print("%2d workers: %d changes in %0.2fs, %0.1f changes/s" %
+          (workers, count, elapsed, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    benchutil.add_arguments(parser)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='the numbers of sync workers to measure')
+    parser.add_argument('--projects', type=int, default=4)
+    parser.add_argument('--changes', type=int, default=50,
+                        help='changes per project')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the server waits before each reply')
+    parser.add_argument('--log', metavar='FILE',
+                        help='write the gertty debug log to FILE')
+    args = parser.parse_args()
+    benchutil.setup(args)
+    if args.log:
+        logging.basicConfig(filename=args.log, level=logging.DEBUG)
+    path = tempfile.mkdtemp(prefix='gertty-bench-')
+    try:
+        gerrit = FakeGerrit(path, args.projects, args.changes, args.latency)
+        url = gerrit.serve()
+        for i, workers in enumerate(args.workers):
+            run_path = os.path.join(path, 'run%d' % i)
+            os.makedirs(run_path)
+            run(gerrit, url, workers, run_path)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+# Copyright 2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Helpers shared by the benchmarks in this directory.
+
+Every benchmark takes a --gertty option naming the source tree to
+measure, so the same script can be run against an older checkout,
+for instance one made with:
+
+  git worktree add /tmp/gertty-base <commit>
+  python tools/bench_sync.py --gertty /tmp/gertty-base
+"""
+
+import os
+import random
+import subprocess
+import sys
+import time
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def add_arguments(parser):
+    parser.add_argument('--gertty', default=TOP, metavar='PATH',
+                        help='the gertty source tree to benchmark '
+                        '(default: %(default)s)')
+
+
+def setup(args):
+    # Import gertty from the tree being measured rather than whatever
+    # is installed.
+    sys.path.insert(0, os.path.abspath(args.gertty))
+    import gertty
+    print('Benchmarking %s' % (os.path.dirname(os.path.dirname(
+        os.path.abspath(gertty.__file__))),))
+
+
+def git(path, *args, **kw):
+    stdin = kw.get('input')
+    proc = subprocess.Popen(('git',) + args, cwd=path,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, _ = proc.communicate(stdin)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args[0])
+    return out.decode('utf8')
+
+
+def init_repo(path, bare=False):
+    os.makedirs(path)
+    args = ['init', '-q']
+    if bare:
+        args.append('--bare')
+    git(path, *args)
+    git(path, 'config', 'user.name', 'Bench')
+    git(path, 'config', 'user.email', 'bench@example.com')
+
+
+class FastImport(object):
+    """Write commits to a repository with git fast-import."""
+
+    def __init__(self, path):
+        self.proc = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                                     cwd=path, stdin=subprocess.PIPE)
+        self.mark = 0
+        self.when = 1400000000
+
+    def _data(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf8')
+        self.proc.stdin.write(('data %d\n' % len(data)).encode('utf8'))
+        self.proc.stdin.write(data + b'\n')
+
+    def commit(self, ref, files, message, parent=None):
+        """Commit files (a dict of path to contents) on top of parent.
+
+        Returns the mark of the new commit, which may be used as the
+        parent of a later one.  Files not mentioned are carried over
+        from the parent.
+        """
+        self.mark += 1
+        self.when += 1
+        w = self.proc.stdin.write
+        w(('commit %s\nmark :%d\n' % (ref, self.mark)).encode('utf8'))
+        w(('committer Bench <bench@example.com> %d +0000\n' %
+           self.when).encode('utf8'))
+        self._data(message)
+        if parent is not None:
+            w(('from :%d\n' % parent).encode('utf8'))
+        for path, contents in sorted(files.items()):
+            w(('M 100644 inline %s\n' % path).encode('utf8'))
+            self._data(contents)
+        w(b'\n')
+        return self.mark
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait():
+            raise Exception("git fast-import failed")
+
+
+def make_refactor(path, files=300, lines=300, seed=0):
+    """Create a repository whose last commit reformats many files.
+
+    Nine of every ten lines of each file are reindented, and a widely
+    used method is renamed.  Returns the (old, new) commits.
+    """
+    rand = random.Random(seed)
+    names = ['value', 'result', 'count', 'index', 'item', 'node', 'path',
+             'config', 'session', 'change', 'revision', 'project']
+    init_repo(path)
+    old = {}
+    new = {}
+    for f in range(files):
+        old_lines = []
+        new_lines = []
+        for i in range(lines):
+            a, b, c = [rand.choice(names) for x in range(3)]
+            line = '    %s_%d = self.%s(%s, %d)\n' % (
+                a, i, b, c, rand.randint(0, 1000))
+            old_lines.append(line)
+            if i % 10:
+                line = '    ' + line.replace('self.', 'self.get_', 1)
+            new_lines.append(line)
+        name = 'module%d/file%d.py' % (f % 10, f)
+        old[name] = ''.join(old_lines)
+        new[name] = ''.join(new_lines)
+    fi = FastImport(path)
+    parent = fi.commit('refs/heads/master', old, 'Initial commit\n')
+    fi.commit('refs/heads/master', new, 'Rename methods\n', parent)
+    fi.close()
+    return git(path, 'rev-parse', 'master~1', 'master').split()
+
+
+def timed(func, *args, **kw):
+    start = time.time()
+    ret = func(*args, **kw)
+    return time.time() - start, ret